@@ -0,0 +1,214 @@
+"""Local playground for benchmarks
+
+Two ReUDP tunnels talking over loopback, no rendezvous server involved.
+"""
+
+from __future__ import annotations
+
+import collections
+import random
+import select
+import socket
+import threading
+import time
+from typing import Any, Optional, Self
+
+from denat.net import Addr
+from denat.reudp import ReUDP
+
+# nobody listens here, server messages just vanish
+NOWHERE: Addr = ("127.0.0.1", 9)
+
+
+class LossySocket(socket.socket):
+    """UDP socket that drops outgoing datagrams with `loss` probability"""
+
+    def __init__(self, loss: float = 0.0, seed: Optional[int] = None):
+        super().__init__(socket.AF_INET, socket.SOCK_DGRAM)
+        self.loss = loss
+        self.rng = random.Random(seed)
+        self.dropped = 0
+
+    def sendto(self, data: Any, *args: Any) -> int:  # type: ignore[override]
+        if self.rng.random() < self.loss:
+            self.dropped += 1
+            return len(data)
+        return super().sendto(data, *args)
+
+
+class DirectReUDP(ReUDP):
+    """ReUDP that already knows its peer"""
+
+    def __init__(self, s: socket.socket, peer: Addr, **kwargs: Any) -> None:
+        self.direct_peer = peer
+        if isinstance(s, LossySocket):
+            # sendmmsg would go around the loss
+            kwargs.setdefault("mmsg", False)
+        super().__init__(s, "bench-a", "bench-b", NOWHERE, **kwargs)
+
+    def first_peer_fetch(self) -> tuple[Addr, Addr]:
+        return self.direct_peer, NOWHERE
+
+    def try_to_reconnect(self) -> None:
+        # there's no NAT to re-punch on loopback
+        pass
+
+
+def lossy_pair(
+    loss: float = 0.0, seed: int = 0, **kwargs: Any
+) -> tuple[DirectReUDP, DirectReUDP]:
+    a = LossySocket(loss, seed)
+    b = LossySocket(loss, seed + 1)
+    a.bind(("127.0.0.1", 0))
+    b.bind(("127.0.0.1", 0))
+
+    return (
+        DirectReUDP(a, b.getsockname(), **kwargs),
+        DirectReUDP(b, a.getsockname(), **kwargs),
+    )
+
+
+def direct_pair(**kwargs: Any) -> tuple[DirectReUDP, DirectReUDP]:
+    """Plain sockets, nothing in the way"""
+    a = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    b = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    a.bind(("127.0.0.1", 0))
+    b.bind(("127.0.0.1", 0))
+
+    return (
+        DirectReUDP(a, b.getsockname(), **kwargs),
+        DirectReUDP(b, a.getsockname(), **kwargs),
+    )
+
+
+class Bottleneck:
+    """Router with limited rate, finite queue and propagation delay
+
+    Tunnels talk to `a_side`/`b_side` addresses instead of each other,
+    and the router forwards between them in a background thread, dropping
+    what doesn't fit into the queue.
+    """
+
+    def __init__(
+        self,
+        *,
+        rate: float = 5_000,
+        queue: int = 50,
+        delay: float = 0.005,
+        loss: float = 0.0,
+        seed: int = 0,
+    ) -> None:
+        self.rate = rate
+        self.queue = queue
+        self.delay = delay
+        self.loss = loss
+        self.rng = random.Random(seed)
+
+        self.a = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.b = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.a.bind(("127.0.0.1", 0))
+        self.b.bind(("127.0.0.1", 0))
+        self.a_side: Addr = self.a.getsockname()
+        self.b_side: Addr = self.b.getsockname()
+
+        # where to forward, learned from the first datagram on each side
+        self.a_peer: Optional[Addr] = None
+        self.b_peer: Optional[Addr] = None
+
+        self.dropped = 0
+        self.forwarded = 0
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self) -> Self:
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.done.set()
+        self.thread.join()
+        self.a.close()
+        self.b.close()
+
+    def run(self) -> None:
+        # arrival time and datagram, keyed by the side it goes out of
+        pipes: dict[str, collections.deque[tuple[float, bytes]]] = {
+            "a": collections.deque(),
+            "b": collections.deque(),
+        }
+        last_departure = {"a": 0.0, "b": 0.0}
+        gap = 1 / self.rate
+
+        while not self.done.is_set():
+            now = time.monotonic()
+            deadlines = [p[0][0] for p in pipes.values() if p]
+            timeout = max(0.0, min(deadlines) - now) if deadlines else 0.01
+            ok_read, _, _ = select.select([self.a, self.b], [], [], timeout)
+
+            now = time.monotonic()
+            for s in ok_read:
+                data, addr = s.recvfrom(65_536)
+                # came from a, so it goes out of b and vice versa
+                if s is self.a:
+                    self.a_peer, side = addr, "b"
+                else:
+                    self.b_peer, side = addr, "a"
+
+                pipe = pipes[side]
+                if len(pipe) >= self.queue or self.rng.random() < self.loss:
+                    self.dropped += 1
+                    continue
+                departure = max(now, last_departure[side]) + gap
+                last_departure[side] = departure
+                pipe.append((departure + self.delay, data))
+
+            for side, pipe in pipes.items():
+                while pipe and pipe[0][0] <= now:
+                    _, data = pipe.popleft()
+                    if side == "b" and self.b_peer is not None:
+                        self.b.sendto(data, self.b_peer)
+                    elif side == "a" and self.a_peer is not None:
+                        self.a.sendto(data, self.a_peer)
+                    self.forwarded += 1
+
+
+def bottleneck_pair(
+    link: Bottleneck, **kwargs: Any
+) -> tuple[DirectReUDP, DirectReUDP]:
+    a = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    b = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    a.bind(("127.0.0.1", 0))
+    b.bind(("127.0.0.1", 0))
+
+    return (
+        DirectReUDP(a, link.a_side, **kwargs),
+        DirectReUDP(b, link.b_side, **kwargs),
+    )
+
+
+def transfer(sender: ReUDP, receiver: ReUDP, count: int) -> float:
+    """Push `count` messages one way, returns goodput in messages/s"""
+    done = threading.Event()
+
+    def pump() -> None:
+        for i in range(count):
+            sender.send(f"{i}")
+        while not done.is_set():
+            sender.handle_messages(timeout=0.01)
+            sender.service_timers()
+
+    start = time.monotonic()
+    thread = threading.Thread(target=pump)
+    thread.start()
+    try:
+        for i in range(count):
+            msg, _ = receiver.get_blocking()
+            assert msg == f"{i}", f"{msg} != {i}"
+        elapsed = time.monotonic() - start
+    finally:
+        done.set()
+        thread.join()
+
+    sender.s.close()
+    receiver.s.close()
+    return count / elapsed
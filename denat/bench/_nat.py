@@ -0,0 +1,436 @@
+"""Emulated NATs for benchmarks
+
+Every link joins two tunnels, A and B, through the NATs in front of them.
+A talks to `a_side`, which stands for B's public address, and B talks to
+`b_side`, which stands for A's. A side whose NAT has seen nothing going
+out of it for `timeout` seconds gets nothing in, until it sends something
+again (the NAT gives the same port back, what most of them try to do).
+`rebind` gives a side a new public port instead, as a NAT does when it
+restarts or runs out of them, and the other side sees it come from a new
+address.
+
+The server is a function call: `NatTunnel` asking for the peer gets both
+sides the addresses they have for each other, after `SERVER_RTT`.
+
+Links are already punched through. To see how tunnels find each other in
+the first place, `Internet` runs `Gateway`s, whole NATs with public
+addresses of their own (on 127.0.1.x, Linux answers all of 127/8), and
+whatever else needs to be reachable from the outside, like servers.
+Hosts behind a gateway use a `NattedSocket`.
+"""
+
+from __future__ import annotations
+
+import heapq
+import itertools
+import math
+import random
+import selectors
+import socket
+import struct
+import threading
+import time
+from collections.abc import Callable
+from typing import Any, Optional, Self
+
+from denat.aioreudp import AsyncReUDP
+from denat.net import Addr
+from denat.server import encode_reply
+from denat.wire import HEADER, Kind
+
+from ._link import NOWHERE
+
+SERVER_RTT = 0.05
+
+
+def bound() -> socket.socket:
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(("127.0.0.1", 0))
+    return s
+
+
+class Link:
+    def __init__(self, sel: selectors.BaseSelector) -> None:
+        self.sel = sel
+        # side i reads what its tunnel sends out, and passes to it what
+        # the other side sent
+        self.socks = [bound(), bound()]
+        for side, s in enumerate(self.socks):
+            sel.register(s, selectors.EVENT_READ, (self, side))
+
+        # where the tunnels are, learned from what they send
+        self.inside: list[Optional[Addr]] = [None, None]
+        # when the binding of each side last saw outgoing traffic
+        self.last_out = [-math.inf, -math.inf]
+
+    @property
+    def a_side(self) -> Addr:
+        return self.socks[0].getsockname()
+
+    @property
+    def b_side(self) -> Addr:
+        return self.socks[1].getsockname()
+
+    def outside(self, side: int) -> Addr:
+        """Where the tunnel on `side` sees the other one"""
+        return self.socks[side].getsockname()
+
+    def rebind(self, side: int) -> None:
+        """Move the tunnel on `side` to a new public port"""
+        # it's what the other side gets it from
+        other = 1 - side
+        old = self.socks[other]
+        # bound before the old one is closed, or it may get its port back
+        self.socks[other] = bound()
+        self.sel.unregister(old)
+        old.close()
+        self.sel.register(
+            self.socks[other], selectors.EVENT_READ, (self, other)
+        )
+
+    def close(self) -> None:
+        for s in self.socks:
+            self.sel.unregister(s)
+            s.close()
+
+
+class Nat:
+    """NATs of both sides of `links` pairs, in a background thread
+
+    Datagrams take `delay` seconds to go through, one way.
+    """
+
+    def __init__(
+        self, links: int, *, timeout: float = math.inf, delay: float = 0.0
+    ) -> None:
+        self.timeout = timeout
+        self.delay = delay
+        self.sel = selectors.DefaultSelector()
+        self.links = [Link(self.sel) for _ in range(links)]
+        # links change sockets under the thread's feet
+        self.lock = threading.Lock()
+
+        # when heartbeats went through
+        self.beats: list[float] = []
+        self.dropped = 0
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self) -> Self:
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.done.set()
+        self.thread.join()
+        for link in self.links:
+            link.close()
+        self.sel.close()
+
+    def rebind(self, link: Link, side: int) -> None:
+        with self.lock:
+            link.rebind(side)
+
+    def run(self) -> None:
+        # (when, order, link, side to go out of, datagram)
+        pipe: list[tuple[float, int, Link, int, bytes]] = []
+        order = itertools.count()
+        while not self.done.is_set():
+            timeout = 0.05
+            if pipe:
+                timeout = min(timeout, max(0.0, pipe[0][0] - time.monotonic()))
+            events = self.sel.select(timeout)
+
+            with self.lock:
+                now = time.monotonic()
+                for key, _ in events:
+                    link, side = key.data
+                    if key.fileobj is not link.socks[side]:
+                        # rebound since
+                        continue
+                    data, addr = link.socks[side].recvfrom(65_536)
+                    link.inside[side] = addr
+                    link.last_out[side] = now
+                    if len(data) == HEADER.size and data[0] == Kind.PROBE:
+                        self.beats.append(now)
+                    item = (now + self.delay, next(order), link, 1 - side, data)
+                    heapq.heappush(pipe, item)
+
+                while pipe and pipe[0][0] <= now:
+                    _, _, link, other, data = heapq.heappop(pipe)
+                    inside = link.inside[other]
+                    if (
+                        inside is None
+                        or now - link.last_out[other] > self.timeout
+                    ):
+                        self.dropped += 1
+                        continue
+                    link.socks[other].sendto(data, inside)
+
+
+class NatTunnel(AsyncReUDP):
+    """AsyncReUDP on the `side` of the `link`, the server is a call away"""
+
+    partner: NatTunnel
+    link: Link
+    side: int
+    asked = 0
+    # when it first went to the server for the peer
+    reconnected_at: Optional[float] = None
+
+    @classmethod
+    async def behind(cls, link: Link, side: int, **kwargs: Any) -> NatTunnel:
+        tunnel = await cls.open_direct(
+            bound(),
+            link.outside(side),
+            remote=NOWHERE,
+            ids=("a", "b") if side == 0 else ("b", "a"),
+            **kwargs,
+        )
+        tunnel.link = link
+        tunnel.side = side
+        return tunnel
+
+    def try_to_reconnect(self) -> None:
+        super().try_to_reconnect()
+        self.ask_server()
+
+    def binding_lost(self) -> None:
+        super().binding_lost()
+        self.ask_server()
+
+    def ask_server(self) -> None:
+        if self.reconnected_at is None:
+            self.reconnected_at = time.perf_counter()
+        self.asked += 1
+        for tunnel in (self, self.partner):
+            self.loop.call_later(SERVER_RTT, tunnel.server_reply)
+
+    def server_reply(self) -> None:
+        if self.closed:
+            return
+        peer_id = self.ids[1] if self.ids is not None else ""
+        reply = encode_reply(NOWHERE, self.link.outside(self.side), peer_id)
+        self.datagram_received(reply, NOWHERE)
+
+
+async def nat_pair(
+    link: Link,
+    a_kwargs: Optional[dict[str, Any]] = None,
+    b_kwargs: Optional[dict[str, Any]] = None,
+) -> tuple[NatTunnel, NatTunnel]:
+    """Tunnels on both sides of the link"""
+    a = await NatTunnel.behind(link, 0, **(a_kwargs or {}))
+    b = await NatTunnel.behind(link, 1, **(b_kwargs or {}))
+    a.partner, b.partner = b, a
+    return a, b
+
+
+# real address of the other end, in front of what goes through a gateway
+ENVELOPE = struct.Struct("!4sH")
+
+
+def envelope(addr: Addr) -> bytes:
+    host, port = addr
+    return ENVELOPE.pack(socket.inet_aton(host), port)
+
+
+class NattedSocket(socket.socket):
+    """UDP socket of a host behind `gateway`
+
+    Everything goes to the gateway, with the real destination in the
+    envelope, and comes back from it with the real source in there.
+    `sendto`, `recvfrom` and `recvfrom_into` hide the envelope, so for
+    `net` it's a socket like any other. Nothing else does, `BatchIO`
+    needs `mmsg=False`.
+    """
+
+    gateway: Gateway
+
+    def sendto(self, data: Any, addr: Any, /) -> int:  # type: ignore[override]
+        sent = super().sendto(envelope(addr) + bytes(data), self.gateway.inside)
+        return sent - ENVELOPE.size
+
+    def recvfrom(  # type: ignore[override]
+        self, bufsize: int, flags: int = 0, /
+    ) -> tuple[bytes, Addr]:
+        data, _ = super().recvfrom(bufsize + ENVELOPE.size, flags)
+        host, port = ENVELOPE.unpack_from(data)
+        return data[ENVELOPE.size :], (socket.inet_ntoa(host), port)
+
+    def recvfrom_into(  # type: ignore[override]
+        self, buffer: Any, nbytes: int = 0, flags: int = 0, /
+    ) -> tuple[int, Addr]:
+        data, addr = self.recvfrom(nbytes or len(buffer), flags)
+        memoryview(buffer)[: len(data)] = data
+        return len(data), addr
+
+
+class Binding:
+    """Public port of a gateway and who it lets in"""
+
+    def __init__(self, sock: socket.socket, inside: Addr) -> None:
+        self.sock = sock
+        self.inside = inside
+        # hosts it sent something to
+        self.allowed: set[str] = set()
+
+
+class Gateway:
+    """NAT with the public address `host`
+
+    A `symmetric` one gives every destination a port of its own, `step`
+    after the last one it gave out, otherwise a host gets a single port
+    for everything. Either way a port lets in only hosts it sent something
+    to (address-dependent filtering, the usual kind).
+    """
+
+    def __init__(
+        self,
+        host: str,
+        sel: selectors.BaseSelector,
+        *,
+        symmetric: bool = False,
+        step: int = 1,
+    ) -> None:
+        self.host = host
+        self.sel = sel
+        self.symmetric = symmetric
+        self.step = step
+        self.next_port = random.randrange(20_000, 40_000)
+
+        self.inside_sock = bound()
+        self.inside: Addr = self.inside_sock.getsockname()
+        sel.register(self.inside_sock, selectors.EVENT_READ, (self, None))
+        # by the inside address and, if symmetric, the destination
+        self.bindings: dict[tuple[Addr, Optional[Addr]], Binding] = {}
+
+    def socket(self) -> NattedSocket:
+        s = NattedSocket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind(("127.0.0.1", 0))
+        s.gateway = self
+        return s
+
+    def binding(self, inside: Addr, dest: Addr) -> Binding:
+        key = (inside, dest if self.symmetric else None)
+        if (binding := self.bindings.get(key)) is not None:
+            return binding
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        while True:
+            port = self.next_port
+            self.next_port += self.step
+            try:
+                sock.bind((self.host, port))
+                break
+            except OSError:
+                # taken, a real NAT skips it as well
+                continue
+        binding = self.bindings[key] = Binding(sock, inside)
+        self.sel.register(sock, selectors.EVENT_READ, (self, binding))
+        return binding
+
+    def close(self) -> None:
+        for s in (self.inside_sock, *(b.sock for b in self.bindings.values())):
+            self.sel.unregister(s)
+            s.close()
+
+
+class Internet:
+    """Gateways and public services, in a background thread
+
+    Every gateway holds datagrams for `delay` seconds each way, so peers
+    behind two of them are `4 * delay` apart and a server is `2 * delay`
+    away.
+    """
+
+    def __init__(self, *, delay: float = 0.0) -> None:
+        self.delay = delay
+        self.sel = selectors.DefaultSelector()
+        self.gateways: list[Gateway] = []
+        self.services: list[socket.socket] = []
+        self.dropped = 0
+        # pairs of public hosts that can't reach each other, see `cut`
+        self.cuts: set[frozenset[str]] = set()
+        # (when, order, socket, datagram, where to)
+        self.pipe: list[tuple[float, int, socket.socket, bytes, Addr]] = []
+        self.order = itertools.count()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self) -> Self:
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.done.set()
+        self.thread.join()
+        for gateway in self.gateways:
+            gateway.close()
+        for s in self.services:
+            self.sel.unregister(s)
+            s.close()
+        self.sel.close()
+
+    def gateway(self, *, symmetric: bool = False, step: int = 1) -> Gateway:
+        host = f"127.0.1.{len(self.gateways) + 1}"
+        gateway = Gateway(host, self.sel, symmetric=symmetric, step=step)
+        self.gateways.append(gateway)
+        return gateway
+
+    def cut(self, a: Gateway, b: Gateway) -> None:
+        """Drop everything between the two, a firewall punching can't beat"""
+        self.cuts.add(frozenset((a.host, b.host)))
+
+    def heal(self, a: Gateway, b: Gateway) -> None:
+        self.cuts.discard(frozenset((a.host, b.host)))
+
+    def serve(
+        self, handler: Callable[[socket.socket, bytes, Addr], None]
+    ) -> Addr:
+        """Public socket that passes whatever comes to `handler`"""
+        s = bound()
+        self.services.append(s)
+        self.sel.register(s, selectors.EVENT_READ, handler)
+        return s.getsockname()
+
+    def later(self, s: socket.socket, data: bytes, addr: Addr) -> None:
+        item = (time.monotonic() + self.delay, next(self.order), s, data, addr)
+        heapq.heappush(self.pipe, item)
+
+    def run(self) -> None:
+        while not self.done.is_set():
+            timeout = 0.05
+            if self.pipe:
+                left = self.pipe[0][0] - time.monotonic()
+                timeout = min(timeout, max(0.0, left))
+            for key, _ in self.sel.select(timeout):
+                self.received(key.fileobj, key.data)  # type: ignore[arg-type]
+
+            now = time.monotonic()
+            while self.pipe and self.pipe[0][0] <= now:
+                _, _, s, data, addr = heapq.heappop(self.pipe)
+                s.sendto(data, addr)
+
+    def received(self, s: socket.socket, data: Any) -> None:
+        payload, addr = s.recvfrom(65_536)
+        if callable(data):
+            data(s, payload, addr)
+            return
+
+        gateway, binding = data
+        if binding is None:
+            # going out
+            host, port = ENVELOPE.unpack_from(payload)
+            dest = (socket.inet_ntoa(host), port)
+            if frozenset((gateway.host, dest[0])) in self.cuts:
+                self.dropped += 1
+                return
+            binding = gateway.binding(addr, dest)
+            binding.allowed.add(dest[0])
+            self.later(binding.sock, payload[ENVELOPE.size :], dest)
+        elif addr[0] in binding.allowed:
+            wrapped = envelope(addr) + payload
+            self.later(gateway.inside_sock, wrapped, binding.inside)
+        else:
+            self.dropped += 1
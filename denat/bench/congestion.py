@@ -0,0 +1,49 @@
+"""Bulk transfer through a bottleneck with and without congestion control
+
+The link forwards `--rate` datagrams per second and drops whatever doesn't
+fit into its queue, like a home router or a NAT box would.
+
+Run from the project root:
+    $ python -m bench.congestion
+"""
+
+import argparse
+
+from denat.congestion import CongestionControl, NewReno
+
+from ._link import Bottleneck, bottleneck_pair, transfer
+
+CONTROLLERS = {
+    "none": CongestionControl,
+    "newreno": NewReno,
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=8_000)
+    parser.add_argument("--window", type=int, default=256)
+    parser.add_argument("--rate", type=float, default=3_000)
+    parser.add_argument("--queue", type=int, default=100)
+    parser.add_argument("--delay", type=float, default=0.01)
+    args = parser.parse_args()
+
+    print(
+        f"bottleneck: {args.rate:.0f} pps, queue {args.queue},"
+        f" delay {args.delay * 1000:.0f} ms, window {args.window}"
+    )
+    print(f"{'cc':>8} {'msg/s':>10} {'resent':>8} {'dropped':>8}")
+    for name, controller in CONTROLLERS.items():
+        with Bottleneck(
+            rate=args.rate, queue=args.queue, delay=args.delay
+        ) as link:
+            sender, receiver = bottleneck_pair(
+                link, window=args.window, congestion=controller()
+            )
+            goodput = transfer(sender, receiver, args.count)
+            resent = sender.stats.resent_counter
+            print(f"{name:>8} {goodput:>10.0f} {resent:>8} {link.dropped:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""CPU cost of one datagram in the rendezvous server, no sockets
+
+Feeds `handle_datagram` the datagrams of `--pairs` pairs going through
+their whole life: one side JOINs and waits, the other one completes the
+pair (and both get a reply), both JOIN again as reconnecting clients do,
+send ALIVE, and leave with EXIT. Reports the CPU time per datagram of
+every phase, and how much of one core 100k datagrams per second of it
+would take.
+
+Run from the project root:
+    $ python -m bench.dispatch
+"""
+
+import argparse
+import time
+from collections.abc import Callable
+
+from denat import log
+from denat.server import Mapping, handle_datagram
+
+from .mapping import NullSocket, addr_of
+
+RATE = 100_000
+
+
+def phases(pairs: int) -> list[tuple[str, list[tuple[bytes, tuple]]]]:
+    def each(make: Callable[[int], list[tuple[bytes, tuple]]]) -> list:
+        return [datagram for i in range(pairs) for datagram in make(i)]
+
+    return [
+        ("JOIN, new", each(lambda i: [(b"JOIN#a%d@b%d" % (i, i), addr_of(i))])),
+        (
+            "JOIN, completes",
+            each(lambda i: [(b"JOIN#b%d@a%d" % (i, i), addr_of(pairs + i))]),
+        ),
+        (
+            "JOIN, again",
+            each(
+                lambda i: [
+                    (b"JOIN#a%d@b%d" % (i, i), addr_of(i)),
+                    (b"JOIN#b%d@a%d" % (i, i), addr_of(pairs + i)),
+                ]
+            ),
+        ),
+        (
+            "ALIVE",
+            each(
+                lambda i: [
+                    (b"ALIVE#a%d" % i, addr_of(i)),
+                    (b"ALIVE#b%d" % i, addr_of(pairs + i)),
+                ]
+            ),
+        ),
+        (
+            "EXIT",
+            each(
+                lambda i: [
+                    (b"EXIT#a%d@b%d" % (i, i), addr_of(i)),
+                    (b"EXIT#b%d@a%d" % (i, i), addr_of(pairs + i)),
+                ]
+            ),
+        ),
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pairs", type=int, default=100_000)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+    log.setup(None)
+
+    print(f"{'phase':>16} {'us/datagram':>12} {'CPU at 100k/s':>14}")
+    totals: dict[str, float] = {}
+    for _ in range(args.rounds):
+        mapping = Mapping(max_entries=args.pairs)
+        s = NullSocket()
+        for name, datagrams in phases(args.pairs):
+            start = time.process_time()
+            for payload, addr in datagrams:
+                handle_datagram(s, mapping, addr, payload)
+            took = (time.process_time() - start) / len(datagrams)
+            # the best round, the others had the noise
+            totals[name] = min(totals.get(name, took), took)
+
+    for name, took in totals.items():
+        print(f"{name:>16} {took * 1e6:>12.2f} {took * RATE:>14.0%}")
+
+
+if __name__ == "__main__":
+    main()
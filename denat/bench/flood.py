@@ -0,0 +1,86 @@
+"""Server mapping memory under churn and under a flood of made up ids
+
+Simulated time, no sockets. Every step some clients join and leave
+properly, some crash without EXIT, and an attacker sends JOINs with
+fresh random ids, either from a few addresses or from spoofed ones. The
+mapping should stay under its cap, and peak memory should stop growing
+once it's reached.
+
+Run from the project root:
+    $ python -m bench.flood
+"""
+
+import argparse
+import random
+
+from denat import log
+from denat.server import Mapping, handle_exit, handle_join
+
+from .mapping import NullSocket, addr_of
+from .soak import rss_mb
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", type=int, default=60)
+    parser.add_argument("--per-step", type=int, default=20_000)
+    parser.add_argument("--max-entries", type=int, default=100_000)
+    parser.add_argument("--ttl", type=float, default=10.0)
+    parser.add_argument(
+        "--spoofed",
+        action="store_true",
+        help="attacker uses a new source address every time",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    # the server would log every ignored JOIN
+    log.setup(None)
+
+    clock = FakeClock()
+    mapping = Mapping(ttl=args.ttl, max_entries=args.max_entries, clock=clock)
+    s = NullSocket()
+    rng = random.Random(args.seed)
+    client = 0
+
+    print(f"{'time':>6} {'entries':>8} {'addrs':>8} {'peak MB':>8}")
+    for step in range(args.steps):
+        clock.now = float(step)
+        for _ in range(args.per_step // 4):
+            # a pair meets and leaves
+            a, b = addr_of(client), addr_of(client + 1)
+            handle_join(s, mapping, a, b"c%d@c%d" % (client, client + 1))
+            handle_join(s, mapping, b, b"c%d@c%d" % (client + 1, client))
+            handle_exit(mapping, a, b"c%d@c%d" % (client, client + 1))
+            handle_exit(mapping, b, b"c%d@c%d" % (client + 1, client))
+            # and one that crashed waiting for its peer
+            crashed = addr_of(client + 2)
+            handle_join(s, mapping, crashed, b"c%d@gone" % (client + 2))
+            client += 3
+
+        for _ in range(args.per_step):
+            spoofed = rng.getrandbits(32)
+            if args.spoofed:
+                addr = addr_of(spoofed)
+            else:
+                addr = addr_of(rng.randrange(16))
+            handle_join(s, mapping, addr, b"x%d@y%d" % (spoofed, spoofed))
+
+        mapping.expire()
+
+        if step % 10 == 9:
+            print(
+                f"{clock.now:>6.0f} {len(mapping):>8}"
+                f" {len(mapping.by_addr):>8} {rss_mb():>8.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Throughput for messages from 1 KB to 16 MB, split into fragments
+
+Run from the project root:
+    $ python -m bench.fragments
+"""
+
+import argparse
+import threading
+import time
+
+from ._link import lossy_pair
+
+SIZES = [2**10, 2**14, 2**18, 2**20, 2**24]
+
+
+def run(size: int, total: int, loss: float, window: int) -> float:
+    sender, receiver = lossy_pair(loss, window=window)
+    count = max(1, total // size)
+    payload = bytes(range(256)) * (size // 256)
+    done = threading.Event()
+
+    def pump() -> None:
+        for _ in range(count):
+            sender.send_bytes(payload)
+        while not done.is_set():
+            sender.handle_messages(timeout=0.01)
+            sender.service_timers()
+
+    start = time.monotonic()
+    thread = threading.Thread(target=pump)
+    thread.start()
+    try:
+        for _ in range(count):
+            receiver.wait()
+            res = receiver.get_bytes()
+            assert res is not None and res[0] == payload
+        elapsed = time.monotonic() - start
+    finally:
+        done.set()
+        thread.join()
+
+    sender.s.close()
+    receiver.s.close()
+    return count * size / elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--total", type=int, default=32 * 2**20)
+    parser.add_argument("--loss", type=float, default=0.0)
+    parser.add_argument("--window", type=int, default=64)
+    args = parser.parse_args()
+
+    print(f"{'size':>10} {'MB/s':>8}")
+    for size in SIZES:
+        throughput = run(size, args.total, args.loss, args.window)
+        print(f"{size:>10} {throughput / 2**20:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
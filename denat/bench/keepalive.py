@@ -0,0 +1,142 @@
+"""Idle tunnels behind NATs that forget bindings, with and without heartbeats
+
+Pairs of asyncio tunnels talk through an emulated NAT on each side. It
+drops whatever comes for a side that has sent nothing for `--timeout`
+seconds, until that side sends something again (a NAT that gives the
+same port back, which is what most of them try to do). The pairs say hi,
+stay idle for `--idle` seconds and a bit, then B sends A one more message.
+
+Only A sends heartbeats, B just echoes them, which is what happens most of
+the time when the heartbeats of two machines aren't lined up. The server
+is a function call, see `_nat`.
+
+Reported: how long the message after the pause took, how many times per
+pair the server was needed, heartbeats per pair per minute of idling, in
+how many bursts they went out, and the interval A ended up with. Times
+are scaled down, a NAT timeout of 2 seconds stands for 30.
+
+Run from the project root:
+    $ python -m bench.keepalive --pairs 100
+"""
+
+import argparse
+import asyncio
+import math
+import random
+import statistics
+import time
+from typing import Any, Optional
+
+from denat import log
+from denat.keepalive import Lifetime
+
+from ._nat import Nat, NatTunnel, nat_pair
+
+# heartbeats closer than that went out on the same wakeup
+BURST = 0.005
+
+# initial interval, floor and ceiling, None for no heartbeats
+MODES: dict[str, Optional[tuple[float, float, float]]] = {
+    "off": None,
+    "fixed": (1.0, 1.0, 1.0),
+    "adaptive, low": (1.0, 0.25, 10.0),
+    "adaptive, high": (4.0, 0.25, 10.0),
+}
+
+
+async def run(
+    pairs: int,
+    params: Optional[tuple[float, float, float]],
+    timeout: float,
+    idle: float,
+    seed: int,
+) -> tuple[list[float], float, float, int, list[float]]:
+    """Returns wake up latencies, server asks and heartbeats per pair,
+    heartbeat bursts and the intervals A learned
+    """
+    rng = random.Random(seed)
+    with Nat(pairs, timeout=timeout) as nat:
+        tunnels = []
+        for link in nat.links:
+            if params is None:
+                kwargs: dict[str, Any] = {"keepalive": False}
+            else:
+                initial, floor, ceiling = params
+                lifetime = Lifetime(
+                    initial, floor=floor, ceiling=ceiling, slot=0.25
+                )
+                kwargs = {"lifetime": lifetime}
+            tunnels.append(await nat_pair(link, kwargs, {"keepalive": False}))
+
+        for a, _ in tunnels:
+            await a.send("hi")
+        for _, b in tunnels:
+            await b.recv()
+
+        start = time.monotonic()
+        nat.beats.clear()
+        for a, b in tunnels:
+            a.asked = b.asked = 0
+
+        async def wake(a: NatTunnel, b: NatTunnel) -> float:
+            # not in step with the heartbeats
+            await asyncio.sleep(idle + rng.uniform(0, timeout))
+            sent = time.perf_counter()
+            await b.send("wake")
+            await a.recv()
+            return time.perf_counter() - sent
+
+        latencies = await asyncio.gather(*(wake(a, b) for a, b in tunnels))
+        took = time.monotonic() - start
+
+        beats = [t for t in nat.beats if t <= start + idle]
+        bursts = sum(
+            1
+            # one longer, the first beat has nothing before it
+            for prev, t in zip([-math.inf, *beats], beats, strict=False)
+            if t - prev > BURST
+        )
+        asked = sum(a.asked + b.asked for a, b in tunnels) / pairs
+        intervals = [
+            a.heartbeat.lifetime.interval
+            for a, _ in tunnels
+            if a.heartbeat is not None
+        ]
+        for a, b in tunnels:
+            a.close()
+            b.close()
+
+    per_minute = len(beats) / pairs / (min(took, idle) / 60)
+    return list(latencies), asked, per_minute, bursts, intervals
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pairs", type=int, default=100)
+    parser.add_argument(
+        "--timeout", type=float, default=2.0, help="NAT binding timeout"
+    )
+    parser.add_argument("--idle", type=float, default=30.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--modes", nargs="+", default=list(MODES))
+    args = parser.parse_args()
+    log.setup(None)
+
+    print(
+        f"{'mode':>15} {'wake p50 ms':>12} {'wake max ms':>12}"
+        f" {'asked':>6} {'beats/min':>10} {'bursts':>7} {'interval':>9}"
+    )
+    for mode in args.modes:
+        latencies, asked, per_minute, bursts, intervals = asyncio.run(
+            run(args.pairs, MODES[mode], args.timeout, args.idle, args.seed)
+        )
+        interval = f"{statistics.mean(intervals):.2f}" if intervals else "-"
+        print(
+            f"{mode:>15} {statistics.median(latencies) * 1000:>12.1f}"
+            f" {max(latencies) * 1000:>12.1f} {asked:>6.2f}"
+            f" {per_minute:>10.1f} {bursts:>7} {interval:>9}"
+        )
+
+
+if __name__ == "__main__":
+    main()
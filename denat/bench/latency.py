@@ -0,0 +1,120 @@
+"""Round trip latency of the blocking ReUDP against the asyncio one
+
+A ping-pong over loopback, one tunnel pair with a thread per side for
+the blocking flavour and `--tunnels` pairs on a single event loop for
+the asyncio one.
+
+Run from the project root:
+    $ python -m bench.latency --tunnels 1 100 1000
+"""
+
+import argparse
+import asyncio
+import socket
+import statistics
+import threading
+import time
+
+from denat.aioreudp import AsyncReUDP
+
+from ._link import lossy_pair
+
+STOP = "stop"
+
+
+def percentiles(samples: list[float]) -> tuple[float, float]:
+    """p50 and p99, in milliseconds"""
+    cuts = statistics.quantiles(samples, n=100)
+    return cuts[49] * 1000, cuts[98] * 1000
+
+
+def sync_pings(count: int) -> list[float]:
+    client, server = lossy_pair()
+
+    def echo() -> None:
+        while True:
+            msg, _ = server.get_blocking()
+            server.send(msg)
+            if msg == STOP:
+                break
+
+    echoer = threading.Thread(target=echo, daemon=True)
+    echoer.start()
+
+    samples = []
+    for i in range(count):
+        start = time.perf_counter()
+        client.send(str(i))
+        client.get_blocking()
+        samples.append(time.perf_counter() - start)
+
+    client.send(STOP)
+    client.get_blocking()
+    echoer.join()
+    return samples
+
+
+def bound() -> socket.socket:
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(("127.0.0.1", 0))
+    return s
+
+
+async def async_pair() -> tuple[AsyncReUDP, AsyncReUDP]:
+    a, b = bound(), bound()
+    return (
+        await AsyncReUDP.open_direct(a, b.getsockname()),
+        await AsyncReUDP.open_direct(b, a.getsockname()),
+    )
+
+
+async def async_pings(count: int, tunnels: int) -> list[float]:
+    pairs = [await async_pair() for _ in range(tunnels)]
+
+    async def echo(server: AsyncReUDP) -> None:
+        async for msg, _ in server:
+            await server.send_bytes(msg)
+
+    async def ping(client: AsyncReUDP) -> list[float]:
+        samples = []
+        for i in range(count):
+            start = time.perf_counter()
+            await client.send(str(i))
+            await client.recv_bytes()
+            samples.append(time.perf_counter() - start)
+        return samples
+
+    echoers = [asyncio.create_task(echo(server)) for _, server in pairs]
+    results = await asyncio.gather(*(ping(client) for client, _ in pairs))
+
+    for client, server in pairs:
+        client.close()
+        server.close()
+    await asyncio.gather(*echoers)
+
+    return [sample for samples in results for sample in samples]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=1_000)
+    parser.add_argument(
+        "--tunnels", type=int, nargs="+", default=[1, 100, 1000]
+    )
+    args = parser.parse_args()
+
+    print(f"{'flavour':>8} {'tunnels':>8} {'p50 ms':>8} {'p99 ms':>8}")
+
+    p50, p99 = percentiles(sync_pings(args.count))
+    print(f"{'sync':>8} {1:>8} {p50:>8.3f} {p99:>8.3f}")
+
+    for tunnels in args.tunnels:
+        # fewer pings per tunnel, so the big runs finish in reasonable time
+        count = max(10, args.count // tunnels)
+        samples = asyncio.run(async_pings(count, tunnels))
+        p50, p99 = percentiles(samples)
+        print(f"{'asyncio':>8} {tunnels:>8} {p50:>8.3f} {p99:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Rendezvous server mapping under a lot of registered pairs
+
+Fills the mapping with `--sizes` half-registered pairs, then floods it
+with JOINs: half complete a pair (and send both replies), half refresh
+a pair that's still waiting. The server doesn't get slower as the
+mapping grows.
+
+Run from the project root:
+    $ python -m bench.mapping
+"""
+
+import argparse
+import random
+import time
+from typing import Any
+
+from denat import log
+from denat.server import Mapping, handle_join
+
+from .soak import rss_mb
+
+
+class NullSocket:
+    """Swallows the replies"""
+
+    def __init__(self) -> None:
+        self.sent = 0
+
+    def sendto(self, data: Any, addr: Any) -> int:
+        self.sent += 1
+        return len(data)
+
+
+def addr_of(i: int) -> tuple[str, int]:
+    return f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}", 1024 + i % 50_000
+
+
+def run(size: int, joins: int, seed: int) -> tuple[float, float, float]:
+    """Returns registers/s, JOINs/s and peak RSS so far"""
+    mapping = Mapping(max_entries=size)
+    s = NullSocket()
+    rng = random.Random(seed)
+
+    start = time.monotonic()
+    for i in range(size):
+        mapping.register((f"a{i}", f"b{i}"), addr_of(i))
+    registered_in = time.monotonic() - start
+
+    start = time.monotonic()
+    for _ in range(joins):
+        i = rng.randrange(size)
+        if rng.random() < 0.5:
+            handle_join(s, mapping, addr_of(size + i), b"b%d@a%d" % (i, i))
+        else:
+            handle_join(s, mapping, addr_of(i), b"a%d@b%d" % (i, i))
+    joined_in = time.monotonic() - start
+
+    return size / registered_in, joins / joined_in, rss_mb()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    parser.add_argument("--joins", type=int, default=200_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    log.setup(None)
+
+    print(f"{'pairs':>10} {'register/s':>12} {'JOIN/s':>10} {'peak MB':>8}")
+    for size in args.sizes:
+        registers, joins, rss = run(size, args.joins, args.seed)
+        print(f"{size:>10} {registers:>12.0f} {joins:>10.0f} {rss:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
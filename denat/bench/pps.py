@@ -0,0 +1,133 @@
+"""Packets per second over loopback, one by one against batched I/O
+
+First raw sockets: a sender floods small datagrams and the receiver
+counts them with a `select` + `recvfrom` per datagram, with nonblocking
+drain loops and with recvmmsg/sendmmsg. Then whole ReUDP tunnels with
+bursts of one datagram against the default.
+
+Run from the project root:
+    $ python -m bench.pps
+"""
+
+import argparse
+import socket
+import threading
+import time
+from collections.abc import Callable
+
+from denat.mmsg import available as mmsg_available
+from denat.net import BATCH, BatchIO, BufferPool, wait_readable
+
+from ._link import direct_pair, transfer
+
+PAYLOAD = bytes(64)
+# a big receive buffer, so we measure the receiver and not kernel drops
+RCVBUF = 4 * 2**20
+# nothing came for that long, the rest is lost
+IDLE = 0.2
+
+
+def recv_single(s: socket.socket, count: int) -> int:
+    got = 0
+    buf = bytearray(1500)
+    while got < count and wait_readable(s, IDLE):
+        s.recvfrom_into(buf)
+        got += 1
+    return got
+
+
+def recv_batched(mmsg: bool) -> Callable[..., int]:
+    def recv(s: socket.socket, count: int) -> int:
+        io = BatchIO(BufferPool(2 * BATCH, 1500), mmsg=mmsg)
+        got = 0
+        while got < count and wait_readable(s, IDLE):
+            batch = io.recv(s)
+            got += len(batch)
+            for view, _ in batch:
+                io.pool.release(view)
+        return got
+
+    return recv
+
+
+def send_single(s: socket.socket, addr: tuple[str, int], count: int) -> None:
+    for _ in range(count):
+        s.sendto(PAYLOAD, addr)
+
+
+def send_batched(mmsg: bool) -> Callable[..., None]:
+    def send(s: socket.socket, addr: tuple[str, int], count: int) -> None:
+        io = BatchIO(BufferPool(0, 1500), mmsg=mmsg)
+        packets = [(PAYLOAD, addr)] * BATCH
+        for _ in range(count // BATCH):
+            io.send(s, packets)
+
+    return send
+
+
+def flood(
+    send: Callable[..., None], recv: Callable[..., int], count: int
+) -> tuple[float, float, float]:
+    """Returns sent and received datagrams per second, and the loss"""
+    a = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    b = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    b.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF)
+    a.bind(("127.0.0.1", 0))
+    b.bind(("127.0.0.1", 0))
+
+    got = 0
+    recv_in = 0.0
+
+    def receiver() -> None:
+        nonlocal got, recv_in
+        got = recv(b, count)
+        recv_in = time.monotonic() - start
+        if got < count:
+            recv_in -= IDLE
+
+    start = time.monotonic()
+    thread = threading.Thread(target=receiver)
+    thread.start()
+    send(a, b.getsockname(), count)
+    sent_in = time.monotonic() - start
+    thread.join()
+
+    a.close()
+    b.close()
+    return count / sent_in, got / recv_in, 1 - got / count
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=200_000)
+    parser.add_argument("--messages", type=int, default=20_000)
+    args = parser.parse_args()
+
+    modes = [
+        ("single", send_single, recv_single),
+        ("drain", send_batched(False), recv_batched(False)),
+    ]
+    if mmsg_available:
+        modes.append(("mmsg", send_batched(True), recv_batched(True)))
+
+    print(f"{'raw':>8} {'sent pps':>10} {'recv pps':>10} {'lost':>6}")
+    for name, send, recv in modes:
+        sent, got, lost = flood(send, recv, args.count)
+        print(f"{name:>8} {sent:>10.0f} {got:>10.0f} {lost:>6.1%}")
+
+    print()
+    print(f"{'reudp':>8} {'msg/s':>10}")
+    for name, batch, mmsg in [
+        ("single", 1, False),
+        ("drain", BATCH, False),
+        ("mmsg", BATCH, True),
+    ]:
+        if mmsg and not mmsg_available:
+            continue
+        sender, receiver = direct_pair(window=64, batch=batch, mmsg=mmsg)
+        goodput = transfer(sender, receiver, args.messages)
+        print(f"{name:>8} {goodput:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
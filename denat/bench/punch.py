@@ -0,0 +1,204 @@
+"""Time to connect through emulated NATs, with and without punching
+
+Every pair of peers sits behind two gateways of its own, see `_nat`, and
+finds each other through a server with `--nodes` nodes sharing one
+mapping, like a `cluster` does. Both sides start `first_peer_fetch` at
+the same time, then say hello to whatever address it returned until
+the hello of the other one comes from there too.
+
+Modes:
+    cone, server            one public port per host, the address the
+                            server saw is trusted, as before punching
+    cone, punch             same NATs, the peer is raced for
+    symmetric, server       A's NAT gives every destination a new port,
+                            `--step` after the last one, so the address
+                            the server saw lets nothing from B in, and B
+                            hears A from a port it doesn't know
+    symmetric, punch        same NATs, ports after the last one the server
+                            saw are raced for too
+    both symmetric, punch   B's NAT does the same, and what one side hears
+                            the other from rarely is where the other one
+                            sends to, prediction alone isn't enough there
+
+Reported: how many pairs connected within `GIVE_UP` seconds, and the
+time to connect of those that did.
+
+Run from the project root:
+    $ python -m bench.punch --pairs 20 --delay 0.005
+"""
+
+import argparse
+import socket
+import statistics
+import threading
+import time
+from typing import Optional
+
+from denat import log
+from denat.net import Addr, conn_id, first_peer_fetch, timeout_recv
+from denat.server import Mapping, handle_datagram
+from denat.wire import HEADER, WireError, conn_of, probe
+
+from ._nat import Gateway, Internet
+
+# after that the pair counts as never connected
+GIVE_UP = 5.0
+# how often the hellos go out
+HELLO_EVERY = 0.05
+
+# whether A's and B's NATs are symmetric, and whether to punch
+MODES: dict[str, tuple[bool, bool, bool]] = {
+    "cone, server": (False, False, False),
+    "cone, punch": (False, False, True),
+    "symmetric, server": (True, False, False),
+    "symmetric, punch": (True, False, True),
+    "both symmetric, punch": (True, True, True),
+}
+
+
+class Rendezvous:
+    """Nodes of one server sharing the mapping, replies go back through
+    the node the address came through
+    """
+
+    def __init__(self, internet: Internet, nodes: int) -> None:
+        self.mapping = Mapping()
+        self.via: dict[Addr, socket.socket] = {}
+        self.nodes = [internet.serve(self.handle) for _ in range(nodes)]
+
+    def handle(self, s: socket.socket, payload: bytes, addr: Addr) -> None:
+        self.via[addr] = s
+        handle_datagram(self, self.mapping, addr, payload)
+
+    def sendto(self, data: bytes | memoryview, addr: Addr) -> int:
+        return self.via[addr].sendto(data, addr)
+
+
+class Side(threading.Thread):
+    def __init__(
+        self,
+        gateway: Gateway,
+        ids: tuple[str, str],
+        nodes: list[Addr],
+        punch: bool,
+        start_at: float,
+        done: threading.Event,
+    ) -> None:
+        super().__init__(daemon=True)
+        self.gateway = gateway
+        self.ids = ids
+        self.nodes = nodes
+        self.punch = punch
+        self.start_at = start_at
+        self.done = done
+        self.other: Side
+        # since the start, None until the other one's hello came
+        self.took: Optional[float] = None
+
+    def run(self) -> None:
+        s = self.gateway.socket()
+        time.sleep(max(0.0, self.start_at - time.perf_counter()))
+        our_id, peer_id = self.ids
+        peer, _ = first_peer_fetch(
+            s, our_id, peer_id, self.nodes, punch=self.punch
+        )
+
+        conn = conn_id(our_id, peer_id)
+        hello = probe(HEADER.size, conn)
+        deadline = self.start_at + GIVE_UP
+        next_hello = 0.0
+        while (now := time.perf_counter()) < deadline:
+            if self.done.is_set():
+                break
+            if now >= next_hello:
+                s.sendto(hello, peer)
+                next_hello = now + HELLO_EVERY
+            res = timeout_recv(s, timeout=min(deadline, next_hello) - now)
+            if res is None or self.took is not None:
+                continue
+            msg, addr = res
+            try:
+                ours = conn_of(msg) == conn
+            except WireError:
+                ours = False
+            if ours and addr == peer:
+                self.took = time.perf_counter() - self.start_at
+                if self.other.took is not None:
+                    self.done.set()
+        s.close()
+
+
+def run(
+    pairs: int,
+    mode: tuple[bool, bool, bool],
+    nodes: int,
+    step: int,
+    delay: float,
+) -> list[Optional[float]]:
+    """Returns the time to connect of every pair, None if it didn't"""
+    *symmetric, punch = mode
+    with Internet(delay=delay) as internet:
+        server = Rendezvous(internet, nodes)
+        start_at = time.perf_counter() + 0.1
+        sides = []
+        for i in range(pairs):
+            done = threading.Event()
+            a, b = (
+                Side(
+                    internet.gateway(symmetric=nat_symmetric, step=step),
+                    ids,
+                    server.nodes,
+                    punch,
+                    start_at,
+                    done,
+                )
+                for ids, nat_symmetric in zip(
+                    ((f"a{i}", f"b{i}"), (f"b{i}", f"a{i}")),
+                    symmetric,
+                    strict=True,
+                )
+            )
+            a.other, b.other = b, a
+            sides.append((a, b))
+
+        for a, b in sides:
+            a.start()
+            b.start()
+        for a, b in sides:
+            a.join()
+            b.join()
+
+    return [
+        None if a.took is None or b.took is None else max(a.took, b.took)
+        for a, b in sides
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pairs", type=int, default=20)
+    parser.add_argument(
+        "--delay", type=float, default=0.005, help="one way, per gateway"
+    )
+    parser.add_argument("--nodes", type=int, default=2)
+    parser.add_argument(
+        "--step", type=int, default=1, help="port step of symmetric NATs"
+    )
+    parser.add_argument("--modes", nargs="+", default=list(MODES))
+    args = parser.parse_args()
+    log.setup(None)
+
+    print(f"{'mode':>22} {'connected':>10} {'p50 ms':>8} {'max ms':>8}")
+    for mode in args.modes:
+        times = run(
+            args.pairs, MODES[mode], args.nodes, args.step, args.delay
+        )
+        took = [t for t in times if t is not None]
+        p50 = f"{statistics.median(took) * 1000:.1f}" if took else "-"
+        worst = f"{max(took) * 1000:.1f}" if took else "-"
+        connected = f"{len(took)}/{len(times)}"
+        print(f"{mode:>22} {connected:>10} {p50:>8} {worst:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Reconnect after the NAT moves a tunnel to a new port
+
+Pairs of asyncio tunnels talk through emulated NATs, see `_nat`. Once they
+said hi, A's NAT gives it a new public port and A sends B `--window`
+messages, which B drops, they come from an address it doesn't know. A
+notices after `SILENCE` and reconnects.
+
+Modes:
+    resume          RESUME to B from the new address, B moves the session
+                    over and both resend what's in flight right away
+    server          no RESUME, B learns A's address from the server, then
+                    A resends right away
+    server, timeout no RESUME, and A's messages wait for the resend timer,
+                    backed off by then, as before session resumption
+
+Reported: time from the reconnect (whichever side went to the server
+first) until B got the first and the last of the messages, and how many
+times per pair the server was asked. All the pairs share one event loop
+and one NAT thread, with many more of them it's those that get measured.
+
+Run from the project root:
+    $ python -m bench.reconnect --pairs 20 --delay 0.01
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+from denat import log
+
+from ._nat import Nat, NatTunnel
+
+
+class ServerOnly(NatTunnel):
+    def send_resume(self) -> None:
+        pass
+
+
+class Timeout(ServerOnly):
+    def resume(self) -> int:
+        return 0
+
+
+MODES: dict[str, type[NatTunnel]] = {
+    "resume": NatTunnel,
+    "server": ServerOnly,
+    "server, timeout": Timeout,
+}
+
+
+def percentiles(samples: list[float]) -> tuple[float, float]:
+    """p50 and p99, in milliseconds"""
+    cuts = statistics.quantiles(samples, n=100)
+    return cuts[49] * 1000, cuts[98] * 1000
+
+
+async def run(
+    pairs: int, tunnel: type[NatTunnel], delay: float, window: int
+) -> tuple[list[float], list[float], float]:
+    """Returns times to the first and the last message, and server asks
+    per pair
+    """
+    with Nat(pairs, delay=delay) as nat:
+        tunnels = []
+        for link in nat.links:
+            a = await tunnel.behind(link, 0)
+            b = await tunnel.behind(link, 1)
+            a.partner, b.partner = b, a
+            tunnels.append((a, b))
+
+        for a, b in tunnels:
+            await a.send("hi")
+            await b.send("hi")
+        for a, b in tunnels:
+            await a.recv()
+            await b.recv()
+        # the acks of the hi too, so that it's A's messages that notice
+        while any(a.sent or b.sent for a, b in tunnels):
+            await asyncio.sleep(0.01)
+
+        for link in nat.links:
+            nat.rebind(link, 0)
+
+        async def deliver(a: NatTunnel, b: NatTunnel) -> tuple[float, float]:
+            for i in range(window):
+                await a.send(str(i))
+            await b.recv()
+            first = time.perf_counter()
+            for _ in range(window - 1):
+                await b.recv()
+            last = time.perf_counter()
+            # whoever noticed first, B may be waiting for an ack too
+            noticed = min(
+                t for t in (a.reconnected_at, b.reconnected_at) if t is not None
+            )
+            return first - noticed, last - noticed
+
+        times = await asyncio.gather(*(deliver(a, b) for a, b in tunnels))
+        asked = sum(a.asked + b.asked for a, b in tunnels) / pairs
+        for a, b in tunnels:
+            a.close()
+            b.close()
+
+    return [first for first, _ in times], [last for _, last in times], asked
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pairs", type=int, default=20)
+    parser.add_argument(
+        "--delay", type=float, default=0.01, help="one way, between peers"
+    )
+    parser.add_argument("--window", type=int, default=16)
+    parser.add_argument("--modes", nargs="+", default=list(MODES))
+    args = parser.parse_args()
+    log.setup(None)
+
+    print(
+        f"{'mode':>16} {'first p50 ms':>13} {'first p99 ms':>13}"
+        f" {'last p50 ms':>12} {'last p99 ms':>12} {'asked':>6}"
+    )
+    for mode in args.modes:
+        firsts, lasts, asked = asyncio.run(
+            run(args.pairs, MODES[mode], args.delay, args.window)
+        )
+        first_p50, first_p99 = percentiles(firsts)
+        last_p50, last_p99 = percentiles(lasts)
+        print(
+            f"{mode:>16} {first_p50:>13.1f} {first_p99:>13.1f}"
+            f" {last_p50:>12.1f} {last_p99:>12.1f} {asked:>6.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+"""Peers that can't reach each other, through a relaying server
+
+Every pair of peers sits behind two cone NATs of its own, see `_nat`, and
+blocking tunnels find each other through one server. Unless the mode
+says otherwise, the two NATs can't reach each other at all (a firewall
+in between), so punching fails and the handshake only gets through once
+the tunnels fall back to the server relaying, see `relay`.
+
+A sends B `--messages` messages of `--size` bytes, B says it got them.
+In the healed mode the firewall goes away right after that, and both keep
+going until they notice and stop relaying.
+
+Modes:
+    direct                  nothing in between, the relay isn't needed
+    relayed                 the firewall stays
+    relayed, then healed    the firewall goes away after the messages
+    no relay                the firewall stays, and the server doesn't
+                            relay, which used to be the only way
+
+Reported: how many pairs got the messages through within `GIVE_UP`
+seconds, the time from the start until B got the first one, the time to
+get the rest through, how many pairs were relayed and the bytes the
+server relayed per pair, and in the healed mode the time from the healing
+until both sides were back on the direct path. Times are scaled down,
+tunnels relay after `--relay-after` seconds of reconnecting and look for
+the direct path every `DIRECT_EVERY` seconds.
+
+Run from the project root:
+    $ python -m bench.relay --pairs 10 --delay 0.005
+"""
+
+import argparse
+import socket
+import statistics
+import threading
+import time
+from typing import Optional
+
+from denat import log
+from denat.net import Addr, Backoff
+from denat.relay import Relay
+from denat.reudp import ReUDP
+from denat.server import Mapping, handle_datagram
+from denat.wire import is_packet
+
+from ._nat import Internet
+
+# after that the pair counts as failed
+GIVE_UP = 15.0
+
+# firewall in between, healed after the messages, server relays
+MODES: dict[str, tuple[bool, bool, bool]] = {
+    "direct": (False, False, True),
+    "relayed": (True, False, True),
+    "relayed, then healed": (True, True, True),
+    "no relay": (True, False, False),
+}
+
+
+class Tunnel(ReUDP):
+    DIRECT_EVERY = 0.5
+
+
+class Server:
+    """Single server, relaying unless told not to"""
+
+    def __init__(self, internet: Internet, relay: bool) -> None:
+        self.mapping = Mapping()
+        self.relay = Relay(self.mapping) if relay else None
+        self.addr = internet.serve(self.handle)
+
+    def handle(self, s: socket.socket, payload: bytes, addr: Addr) -> None:
+        if self.relay is not None and is_packet(payload):
+            self.relay.forward(s, payload, addr)
+        else:
+            handle_datagram(s, self.mapping, addr, payload)
+
+
+class Pair:
+    def __init__(self, internet: Internet, i: int, heal: bool) -> None:
+        self.ids = f"a{i}", f"b{i}"
+        self.internet = internet
+        self.heal = heal
+        self.gateways = internet.gateway(), internet.gateway()
+        self.transferred = threading.Event()
+        self.done = threading.Event()
+
+        # since the start, None if it didn't happen
+        self.first: Optional[float] = None
+        self.last: Optional[float] = None
+        self.healed_at: Optional[float] = None
+        # when each side stopped relaying
+        self.direct_at: list[Optional[float]] = [None, None]
+        self.relayed = False
+
+
+class Side(threading.Thread):
+    def __init__(
+        self,
+        pair: Pair,
+        side: int,
+        server: Addr,
+        start_at: float,
+        messages: int,
+        size: int,
+        relay_after: float,
+    ) -> None:
+        super().__init__(daemon=True)
+        self.pair = pair
+        self.side = side
+        self.server = server
+        self.start_at = start_at
+        self.messages = messages
+        self.size = size
+        self.relay_after = relay_after
+        self.deadline = start_at + GIVE_UP
+
+    def recv(self, t: Tunnel) -> Optional[bytes]:
+        while not t.read_queue:
+            if time.perf_counter() >= self.deadline:
+                return None
+            t.tick(attempts=1)
+        res = t.get_bytes()
+        assert res is not None
+        return res[0]
+
+    def run(self) -> None:
+        s = self.pair.gateways[self.side].socket()
+        time.sleep(max(0.0, self.start_at - time.perf_counter()))
+        a, b = self.pair.ids
+        ids = (a, b) if self.side == 0 else (b, a)
+        try:
+            t = Tunnel(
+                s,
+                *ids,
+                self.server,
+                mmsg=False,
+                backoff=Backoff(give_up=GIVE_UP),
+                relay_after=self.relay_after,
+            )
+            if self.side == 0:
+                self.send(t)
+            else:
+                self.receive(t)
+            if self.pair.heal:
+                self.back_to_direct(t)
+        except RuntimeError:
+            # gave up reconnecting
+            pass
+        finally:
+            self.pair.done.set()
+            s.close()
+
+    def send(self, t: Tunnel) -> None:
+        payload = bytes(self.size)
+        for _ in range(self.messages):
+            t.send_bytes(payload)
+        self.recv(t)
+
+    def receive(self, t: Tunnel) -> None:
+        pair = self.pair
+        for i in range(self.messages):
+            if self.recv(t) is None:
+                return
+            if i == 0:
+                pair.first = time.perf_counter() - self.start_at
+        pair.last = time.perf_counter() - self.start_at
+        pair.relayed = t.relayed
+        t.send("got them")
+        if pair.heal:
+            pair.internet.heal(*pair.gateways)
+            pair.healed_at = time.perf_counter() - self.start_at
+        pair.transferred.set()
+
+    def back_to_direct(self, t: Tunnel) -> None:
+        pair = self.pair
+        left = self.deadline - time.perf_counter()
+        if not pair.transferred.wait(max(0.0, left)):
+            return
+        while time.perf_counter() < self.deadline and not pair.done.is_set():
+            t.tick(attempts=1)
+            if not t.relayed and pair.direct_at[self.side] is None:
+                took = time.perf_counter() - self.start_at
+                pair.direct_at[self.side] = took
+            if None not in pair.direct_at:
+                # the other side may still be waiting for us
+                t.tick(attempts=1)
+                break
+
+
+def run(
+    pairs: int,
+    mode: tuple[bool, bool, bool],
+    messages: int,
+    size: int,
+    relay_after: float,
+    delay: float,
+) -> tuple[list[Pair], float]:
+    """Returns the pairs and the bytes relayed per pair"""
+    firewall, heal, relay = mode
+    with Internet(delay=delay) as internet:
+        server = Server(internet, relay)
+        start_at = time.perf_counter() + 0.1
+        sides = []
+        for i in range(pairs):
+            pair = Pair(internet, i, heal)
+            if firewall:
+                internet.cut(*pair.gateways)
+            for which in (0, 1):
+                sides.append(
+                    Side(
+                        pair,
+                        which,
+                        server.addr,
+                        start_at,
+                        messages,
+                        size,
+                        relay_after,
+                    )
+                )
+
+        for side in sides:
+            side.start()
+        for side in sides:
+            side.join()
+
+    relayed = 0.0
+    if server.relay is not None:
+        relayed = sum(p.bytes for p in server.relay.pairs.values()) / pairs
+    return [side.pair for side in sides[::2]], relayed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pairs", type=int, default=10)
+    parser.add_argument(
+        "--delay", type=float, default=0.005, help="one way, per gateway"
+    )
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--size", type=int, default=1000)
+    parser.add_argument("--relay-after", type=float, default=1.0)
+    parser.add_argument("--modes", nargs="+", default=list(MODES))
+    args = parser.parse_args()
+    log.setup(None)
+
+    def p50(samples: list[float]) -> str:
+        if not samples:
+            return "-"
+        return f"{statistics.median(samples) * 1000:.0f}"
+
+    print(
+        f"{'mode':>20} {'got them':>9} {'first ms':>9} {'rest ms':>8}"
+        f" {'relayed':>8} {'KB/pair':>8} {'direct ms':>10}"
+    )
+    for mode in args.modes:
+        done, relayed = run(
+            args.pairs,
+            MODES[mode],
+            args.messages,
+            args.size,
+            args.relay_after,
+            args.delay,
+        )
+        got = [p for p in done if p.last is not None]
+        firsts = [p.first for p in got if p.first is not None]
+        rests = [
+            p.last - p.first
+            for p in got
+            if p.last is not None and p.first is not None
+        ]
+        backs = []
+        for p in got:
+            a, b = p.direct_at
+            if p.healed_at is not None and a is not None and b is not None:
+                backs.append(max(a, b) - p.healed_at)
+        print(
+            f"{mode:>20} {f'{len(got)}/{len(done)}':>9} {p50(firsts):>9}"
+            f" {p50(rests):>8} {sum(p.relayed for p in got):>8}"
+            f" {relayed / 1024:>8.0f} {p50(backs):>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""Restart of the rendezvous server, with and without the journal
+
+One side of every pair JOINs and waits, then the server is killed and
+started again. The other side JOINs right after the restart, as fast as
+`--rate` allows, while the waiting side asks again only when its
+`first_peer_fetch` timeout (2 s) runs out. Both keep asking every 2 s
+until introduced.
+Without the journal the server has forgotten the waiting side, so pairs
+are introduced only on its next try, with the journal the first JOIN of
+the other side is enough.
+
+Times are from the restart: until the server answers at all, until the
+first pair is introduced, and until half and all of them are.
+
+Run from the project root:
+    $ python -m bench.restart --pairs 1000 10000
+"""
+
+import argparse
+import heapq
+import os
+import random
+import selectors
+import socket
+import statistics
+import tempfile
+import time
+
+from denat.net import parse_server_reply, peer_req
+
+from .server_load import start_server
+
+# how long first_peer_fetch waits before asking again
+RETRY = 2.0
+# pairs per socket, the server takes up to 64 per address
+PER_SOCKET = 50
+
+
+def sockets(count: int, sel: selectors.BaseSelector) -> list[socket.socket]:
+    made = []
+    for _ in range(count):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind(("127.0.0.1", 0))
+        s.setblocking(False)
+        sel.register(s, selectors.EVENT_READ)
+        made.append(s)
+    return made
+
+
+def run(
+    port: int, pairs: int, rate: int, flags: list[str], seed: int
+) -> list[float]:
+    """Returns when each pair got introduced, counting from the restart"""
+    rng = random.Random(seed)
+    remote = ("127.0.0.1", port)
+    sel = selectors.DefaultSelector()
+    waiting = sockets(pairs // PER_SOCKET + 1, sel)
+    coming = sockets(pairs // PER_SOCKET + 1, sel)
+
+    def join(side: list[socket.socket], i: int, our: str, their: str) -> None:
+        msg = peer_req(f"{our}{i}", f"{their}{i}")
+        side[i // PER_SOCKET].sendto(msg, remote)
+
+    server = start_server(port, flags)
+    for i in range(pairs):
+        join(waiting, i, "a", "b")
+        if i % 100 == 0:
+            # don't overflow the server's socket buffer
+            time.sleep(100 / rate)
+    # let it handle them all
+    time.sleep(0.5)
+    server.kill()
+    server.wait()
+
+    restart = time.perf_counter()
+    server = start_server(port, flags)
+    up = time.perf_counter() - restart
+    # the waiting side asked last just before the crash, some time ago
+    retries = [(restart + rng.uniform(0, RETRY), True, i) for i in range(pairs)]
+    ready = restart + up
+    retries += [(ready + i / rate, False, i) for i in range(pairs)]
+    heapq.heapify(retries)
+
+    introduced: dict[int, float] = {}
+    try:
+        while len(introduced) < pairs:
+            now = time.perf_counter()
+            if now - ready > 3 * RETRY + pairs / rate:
+                break
+            while retries and retries[0][0] <= now:
+                _, is_waiting, i = heapq.heappop(retries)
+                if i in introduced:
+                    continue
+                if is_waiting:
+                    join(waiting, i, "a", "b")
+                else:
+                    join(coming, i, "b", "a")
+                heapq.heappush(retries, (now + RETRY, is_waiting, i))
+            timeout = retries[0][0] - now if retries else 0.1
+            for key, _ in sel.select(max(0.0, timeout)):
+                s = key.fileobj
+                assert isinstance(s, socket.socket)
+                while True:
+                    try:
+                        data = s.recv(100)
+                    except BlockingIOError:
+                        break
+                    _, _, peer_id = parse_server_reply(data)
+                    if peer_id is not None and peer_id.startswith("b"):
+                        i = int(peer_id[1:])
+                        got = time.perf_counter() - restart
+                        introduced.setdefault(i, got)
+    finally:
+        server.terminate()
+        server.wait()
+        for s in waiting + coming:
+            sel.unregister(s)
+            s.close()
+        sel.close()
+
+    return [up, *sorted(introduced.values())]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--pairs", type=int, nargs="+", default=[1_000, 10_000]
+    )
+    parser.add_argument(
+        "--rate", type=int, default=10_000, help="JOINs per second"
+    )
+    parser.add_argument("--port", type=int, default=19_150)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(
+        f"{'journal':>8} {'pairs':>7} {'up ms':>7} {'first ms':>9}"
+        f" {'half ms':>8} {'all ms':>8} {'lost':>6}"
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        for pairs in args.pairs:
+            for journal in (False, True):
+                path = os.path.join(tmp, f"journal-{pairs}")
+                flags = ["--log-level", "warning"]
+                if journal:
+                    flags += ["--journal", path]
+
+                up, *times = run(args.port, pairs, args.rate, flags, args.seed)
+                lost = 1 - len(times) / pairs
+                if not times:
+                    print(f"{'yes' if journal else 'no':>8} {pairs:>7} none")
+                    continue
+                half = statistics.median(times)
+                print(
+                    f"{'yes' if journal else 'no':>8} {pairs:>7}"
+                    f" {up * 1000:>7.0f} {times[0] * 1000:>9.0f}"
+                    f" {half * 1000:>8.0f} {times[-1] * 1000:>8.0f}"
+                    f" {lost:>6.1%}"
+                )
+
+
+if __name__ == "__main__":
+    main()
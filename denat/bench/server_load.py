@@ -0,0 +1,163 @@
+"""JOIN to reply latency of the rendezvous server under load
+
+Starts `python -m denat.server` in every mode and fires pairs of JOINs at
+it at a steady `--rate` pairs per second, from `--sockets` client sockets.
+Latency is counted from the second JOIN of a pair, the one that completes
+it, to the reply on the first client's socket. Both clients leave with
+EXIT once they hear back, so the mapping stays small.
+
+Run from the project root:
+    $ python -m bench.server_load --rate 2000 10000
+"""
+
+import argparse
+import selectors
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+from denat.net import Addr, exit_req, parse_server_reply, peer_req
+
+MODES = {
+    "select": [],
+    "asyncio": ["--asyncio"],
+    "select, debug": ["--log-level", "debug"],
+    "select, off": ["--log-level", "off"],
+    "asyncio, off": ["--asyncio", "--log-level", "off"],
+}
+
+
+def percentiles(samples: list[float]) -> tuple[float, float, float]:
+    """p50, p90 and p99, in milliseconds"""
+    cuts = statistics.quantiles(samples, n=100)
+    return cuts[49] * 1000, cuts[89] * 1000, cuts[98] * 1000
+
+
+def start_server(port: int, flags: list[str]) -> subprocess.Popen:
+    server = subprocess.Popen(
+        [sys.executable, "-m", "denat.server", str(port), *flags],
+        stdout=subprocess.DEVNULL,
+    )
+    remote = ("127.0.0.1", port)
+
+    # JOIN both sides of a pair from one socket until the server answers
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.settimeout(0.1)
+    with s:
+        for _ in range(50):
+            s.sendto(peer_req("ready", "probe"), remote)
+            s.sendto(peer_req("probe", "ready"), remote)
+            try:
+                s.recv(100)
+                s.sendto(exit_req("ready", "probe"), remote)
+                s.sendto(exit_req("probe", "ready"), remote)
+                return server
+            except TimeoutError:
+                pass
+    server.kill()
+    raise RuntimeError("server didn't come up")
+
+
+def load(
+    remote: Addr, rate: int, duration: float, sockets: int
+) -> tuple[list[float], int]:
+    """Returns latency samples and how many pairs were sent"""
+    clients = []
+    sel = selectors.DefaultSelector()
+    for _ in range(2 * sockets):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind(("127.0.0.1", 0))
+        s.setblocking(False)
+        sel.register(s, selectors.EVENT_READ)
+        clients.append(s)
+
+    # pair -> when its second JOIN went out
+    sent_at: dict[str, float] = {}
+    samples = []
+    pairs = 0
+
+    start = time.perf_counter()
+    deadline = start + duration
+    next_pair = start
+    while True:
+        now = time.perf_counter()
+        while next_pair <= now and next_pair < deadline:
+            # pairs are spread over the sockets to stay under the server's
+            # per address cap
+            a = clients[2 * (pairs % sockets)]
+            b = clients[2 * (pairs % sockets) + 1]
+            a.sendto(peer_req(f"a{pairs}", f"b{pairs}"), remote)
+            b.sendto(peer_req(f"b{pairs}", f"a{pairs}"), remote)
+            sent_at[f"b{pairs}"] = time.perf_counter()
+            pairs += 1
+            next_pair += 1 / rate
+
+        if now >= deadline + 1.0 or (now >= deadline and not sent_at):
+            break
+        for key, _ in sel.select(max(0.0, min(next_pair, deadline) - now)):
+            client = key.fileobj
+            assert isinstance(client, socket.socket)
+            while True:
+                try:
+                    data = client.recv(100)
+                except BlockingIOError:
+                    break
+                got = time.perf_counter()
+                _, _, peer_id = parse_server_reply(data)
+                if peer_id is not None and peer_id in sent_at:
+                    samples.append(got - sent_at.pop(peer_id))
+                    i = peer_id[1:]
+                    client.sendto(exit_req(f"a{i}", f"b{i}"), remote)
+                    client.sendto(exit_req(f"b{i}", f"a{i}"), remote)
+
+    for s in clients:
+        sel.unregister(s)
+        s.close()
+    sel.close()
+    return samples, pairs
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--rate", type=int, nargs="+", default=[2_000, 10_000, 20_000]
+    )
+    parser.add_argument("--duration", type=float, default=3.0)
+    parser.add_argument("--sockets", type=int, default=16)
+    parser.add_argument("--port", type=int, default=19_100)
+    parser.add_argument("--modes", nargs="+", default=list(MODES))
+    args = parser.parse_args()
+
+    print(
+        f"{'mode':>14} {'pairs/s':>8} {'p50 ms':>8} {'p90 ms':>8}"
+        f" {'p99 ms':>8} {'lost':>6}"
+    )
+    for mode in args.modes:
+        for rate in args.rate:
+            server = start_server(args.port, MODES[mode])
+            try:
+                samples, pairs = load(
+                    ("127.0.0.1", args.port),
+                    rate,
+                    args.duration,
+                    args.sockets,
+                )
+            finally:
+                server.terminate()
+                server.wait()
+
+            lost = 1 - len(samples) / pairs
+            if len(samples) < 2:
+                print(f"{mode:>14} {rate:>8} {'server fell over':>26}")
+                continue
+            p50, p90, p99 = percentiles(samples)
+            print(
+                f"{mode:>14} {rate:>8} {p50:>8.2f} {p90:>8.2f}"
+                f" {p99:>8.2f} {lost:>6.1%}"
+            )
+
+
+if __name__ == "__main__":
+    main()
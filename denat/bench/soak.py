@@ -0,0 +1,72 @@
+"""Long-running one-way stream, prints RSS as it goes
+
+Memory should stay flat no matter how many messages went through.
+
+Run from the project root:
+    $ python -m bench.soak
+"""
+
+import argparse
+import resource
+import sys
+import threading
+import time
+
+from ._link import lossy_pair
+
+
+def rss_mb() -> float:
+    """Peak resident set size of the process, in megabytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux says kilobytes, macos says bytes
+    if sys.platform == "darwin":
+        return peak / 2**20
+    return peak / 2**10
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=10_000_000)
+    parser.add_argument("--step", type=int, default=500_000)
+    parser.add_argument("--loss", type=float, default=0.01)
+    parser.add_argument("--window", type=int, default=64)
+    args = parser.parse_args()
+
+    sender, receiver = lossy_pair(args.loss, window=args.window)
+    done = threading.Event()
+
+    def pump() -> None:
+        for i in range(args.count):
+            sender.send(f"{i}")
+            # don't let send_queue pile up the whole stream upfront
+            while len(sender.send_queue) > args.window:
+                sender.handle_messages(timeout=0.01)
+                sender.service_timers()
+        while not done.is_set():
+            sender.handle_messages(timeout=0.01)
+            sender.service_timers()
+
+    print(f"{'messages':>10} {'msg/s':>8} {'peak rss, MB':>13}")
+    thread = threading.Thread(target=pump)
+    thread.start()
+    try:
+        start = last = time.monotonic()
+        for i in range(args.count):
+            msg, _ = receiver.get_blocking()
+            assert msg == f"{i}", f"{msg} != {i}"
+
+            if (i + 1) % args.step == 0:
+                now = time.monotonic()
+                rate = args.step / (now - last)
+                last = now
+                print(f"{i + 1:>10} {rate:>8.0f} {rss_mb():>13.1f}")
+        elapsed = time.monotonic() - start
+    finally:
+        done.set()
+        thread.join()
+
+    print(f"total: {args.count / elapsed:.0f} msg/s")
+
+
+if __name__ == "__main__":
+    main()
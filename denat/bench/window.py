@@ -0,0 +1,37 @@
+"""Goodput of ReUDP against the window size under injected loss
+
+Run from the project root:
+    $ python -m bench.window
+"""
+
+import argparse
+
+from denat.congestion import CongestionControl
+
+from ._link import lossy_pair, transfer
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=2_000)
+    parser.add_argument(
+        "--windows", type=int, nargs="+", default=[1, 4, 16, 64]
+    )
+    parser.add_argument(
+        "--losses", type=float, nargs="+", default=[0.0, 0.01, 0.05]
+    )
+    args = parser.parse_args()
+
+    print(f"{'window':>8} {'loss':>6} {'msg/s':>10}")
+    for loss in args.losses:
+        for window in args.windows:
+            # only the window limits what's in flight here
+            sender, receiver = lossy_pair(
+                loss, window=window, congestion=CongestionControl()
+            )
+            goodput = transfer(sender, receiver, args.count)
+            print(f"{window:>8} {loss:>6.2f} {goodput:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
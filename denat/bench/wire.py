@@ -0,0 +1,58 @@
+"""Encode/decode cost per packet, old text format against the binary one
+
+Run from the project root:
+    $ python -m bench.wire
+"""
+
+import argparse
+import timeit
+
+from denat import wire
+
+
+def text_encode(i: int, cum: int, sack: int, msg: str) -> bytes:
+    return f"msg:{i}:{cum}:{sack:x}:{msg}".encode()
+
+
+def text_decode(payload: bytes) -> tuple[int, int, int, str]:
+    match payload.decode("utf-8").split(":", 4):
+        case ["msg", i, cum, sack, msg]:
+            return int(i), int(cum), int(sack, 16), msg
+        case _:
+            raise ValueError(payload)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=200_000)
+    parser.add_argument("--size", type=int, default=100)
+    parser.add_argument("--sack", action="store_true")
+    args = parser.parse_args()
+
+    text = "x" * args.size
+    raw = text.encode()
+    i, cum = 123_456, 123_400
+    # mostly nothing is missing
+    sack = 0b1011 if args.sack else 0
+
+    text_packet = text_encode(i, cum, sack, text)
+    binary_packet = wire.msg(i, cum, sack, raw)
+
+    cases = {
+        "text encode": lambda: text_encode(i, cum, sack, text),
+        "text decode": lambda: text_decode(text_packet),
+        "binary encode": lambda: wire.msg(i, cum, sack, raw),
+        "binary decode": lambda: wire.decode(binary_packet),
+    }
+
+    print(f"payload: {args.size} bytes")
+    print(f"text packet: {len(text_packet)} bytes")
+    print(f"binary packet: {len(binary_packet)} bytes")
+    for name, case in cases.items():
+        elapsed = min(timeit.repeat(case, number=args.number, repeat=5))
+        ns = elapsed / args.number * 10**9
+        print(f"{name:>14}: {ns:>6.0f} ns/packet")
+
+
+if __name__ == "__main__":
+    main()
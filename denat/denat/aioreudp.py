@@ -0,0 +1,553 @@
+"""ReUDP on top of asyncio
+
+Same protocol as `denat.reudp`, but instead of blocking in `select` every
+tunnel is a datagram protocol with its timers scheduled on the event loop,
+so thousands of them fit into one thread.
+
+    async with await AsyncReUDP.connect(s, our_id, peer_id, remote) as tun:
+        await tun.send("hi")
+        async for msg, addr in tun:
+            ...
+"""
+
+from __future__ import annotations
+
+import asyncio
+import errno
+import logging
+import socket
+import time
+from collections.abc import Sequence
+from typing import Any, Optional, Self, cast
+
+from . import wire
+from .net import (
+    FETCH_TIMEOUT,
+    PREDICT,
+    PUNCH_EVERY,
+    PUNCH_TIMEOUT,
+    Addr,
+    Backoff,
+    alive_req,
+    conn_id,
+    exit_req,
+    parse_server_history,
+    peer_req,
+    predict_ports,
+)
+from .pmtu import dont_fragment
+from .session import BytesLike, Session
+from .wire import HEADER, WireError
+
+logger = logging.getLogger(__name__)
+
+
+class ReUDPProtocol(asyncio.DatagramProtocol):
+    """Forwards datagrams to the tunnel, or to whoever waits for the server
+    before there's a tunnel
+    """
+
+    def __init__(self) -> None:
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self.tunnel: Optional[AsyncReUDP] = None
+        self.remotes: Sequence[Addr] = ()
+        # reply and the server it came from
+        self.server_reply: Optional[asyncio.Future[tuple[bytes, Addr]]] = None
+        # where the peer got through from while punching, see `race`
+        self.conn: Optional[int] = None
+        self.punched: Optional[asyncio.Future[Addr]] = None
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        # selector transports don't actually subclass DatagramTransport
+        self.transport = cast(asyncio.DatagramTransport, transport)
+
+    def datagram_received(self, data: bytes, addr: Addr) -> None:
+        if self.tunnel is not None:
+            self.tunnel.datagram_received(data, addr)
+        elif (
+            addr in self.remotes
+            and self.server_reply is not None
+            and not self.server_reply.done()
+        ):
+            self.server_reply.set_result((data, addr))
+        elif (
+            addr not in self.remotes
+            and self.punched is not None
+            and not self.punched.done()
+            and self.is_peer(data)
+        ):
+            self.punched.set_result(addr)
+        else:
+            # peer may be faster than the server, it'll resend the syn
+            logger.debug(f"early {addr}: {data!r}")
+
+    def is_peer(self, data: bytes) -> bool:
+        try:
+            return wire.conn_of(data) == self.conn
+        except WireError:
+            return False
+
+    def error_received(self, exc: Exception) -> None:
+        if self.tunnel is not None:
+            self.tunnel.error_received(exc)
+        else:
+            logger.error(f"<> {exc}")
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        if self.tunnel is not None:
+            self.tunnel.connection_lost(exc)
+
+    async def fetch_peer(
+        self,
+        our_id: str,
+        peer_id: str,
+        remotes: Sequence[Addr],
+        *,
+        punch: bool = True,
+        predict: int = PREDICT,
+    ) -> tuple[Addr, Addr]:
+        """Async version of `net.first_peer_fetch`, returns the peer and the
+        server that answered
+        """
+        assert self.transport is not None
+        loop = asyncio.get_running_loop()
+        self.remotes = remotes
+        attempt = 0
+        while True:
+            attempt += 1
+            self.server_reply = loop.create_future()
+            # declare that we exist
+            req = peer_req(our_id, peer_id)
+            for remote in remotes:
+                self.transport.sendto(req, remote)
+            logger.info(f"<> requesting the connection #{attempt}")
+            try:
+                reply, remote = await asyncio.wait_for(
+                    self.server_reply, timeout=FETCH_TIMEOUT
+                )
+            except TimeoutError:
+                continue
+
+            try:
+                _, peer, _, history = parse_server_history(reply)
+            except ValueError as e:
+                logger.error(f"<> {e}")
+                continue
+            if not punch:
+                return peer, remote
+            conn = conn_id(our_id, peer_id)
+            return await self.race(conn, peer, history, predict), remote
+
+    async def race(
+        self, conn: int, peer: Addr, history: list[int], predict: int
+    ) -> Addr:
+        """Async version of `net.race`, falls back to `peer`
+
+        The peer's datagrams aren't left for the tunnel, a SYN that comes
+        while punching gets resent anyway.
+        """
+        assert self.transport is not None
+        loop = asyncio.get_running_loop()
+        self.conn = conn
+        self.punched = loop.create_future()
+        punch = wire.probe(HEADER.size, conn)
+        candidates = predict_ports(peer, history, predict)
+        deadline = loop.time() + PUNCH_TIMEOUT
+        while (left := deadline - loop.time()) > 0:
+            for addr in candidates:
+                self.transport.sendto(punch, addr)
+            try:
+                punched = await asyncio.wait_for(
+                    asyncio.shield(self.punched), min(left, PUNCH_EVERY)
+                )
+            except TimeoutError:
+                continue
+            # in case our punches haven't made it yet
+            self.transport.sendto(punch, punched)
+            logger.info(f"<> peer got through from {punched[0]}:{punched[1]}")
+            return punched
+
+        self.punched.cancel()
+        logger.warning("<> no punch got through, trusting the server")
+        return peer
+
+
+class AsyncReUDP(Session):
+    """Re_liable_UDP tunnel driven by the asyncio event loop
+
+    Guarantees are the same as for `ReUDP`, see README.md for how the
+    protocol works and what the knobs do.
+
+    `send` waits while a whole window is queued up, `recv` waits for the
+    next message, iterating over the tunnel yields messages until it's
+    closed. Nothing blocks the loop, retransmits, delayed acks, mtu
+    probes and heartbeats are loop callbacks.
+
+    There's no way to tell if more datagrams are about to arrive, so
+    standalone acks wait for `ACK_DELAY` instead of a quiet socket.
+
+    If nothing comes from the peer for `SILENCE` seconds while we wait
+    for acks, we reconnect the same way the blocking one does, going
+    through `remote` and `servers` in turn, as often as `backoff` allows,
+    and fall back to the server relaying after
+    `relay_after` seconds of that.
+    """
+
+    ACK_DELAY = 0.002
+    SYN_RESEND = 0.15
+    SILENCE = 1.5
+
+    def __init__(
+        self,
+        transport: asyncio.DatagramTransport,
+        peer: Addr,
+        remote: Optional[Addr] = None,
+        *,
+        ids: Optional[tuple[str, str]] = None,
+        servers: Sequence[Addr] = (),
+        backoff: Optional[Backoff] = None,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(peer, remote, **kwargs)
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+        # our id and peer id, to talk to the server
+        self.ids = ids
+        # other nodes of the cluster to fail over to
+        self.servers = [remote, *servers] if remote is not None else []
+
+        # switches
+        self.closed = False
+        self.error: Optional[Exception] = None
+        # set by error_received while a probe is being sent
+        self.too_big = False
+
+        # wake-ups
+        self.readable = asyncio.Event()
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+        # timers
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.timer_at = 0.0
+        self.ack_timer: Optional[asyncio.TimerHandle] = None
+
+        # state
+        self.backoff = backoff if backoff is not None else Backoff()
+        # or since we started waiting for it
+        self.last_heard = time.monotonic()
+        self.last_syn = 0.0
+
+        # start a handshake
+        self.send_syn()
+        self.arm()
+
+    @classmethod
+    async def connect(
+        cls,
+        s: socket.socket,
+        our_id: str,
+        peer_id: str,
+        remote: Addr,
+        *,
+        servers: Sequence[Addr] = (),
+        punch: bool = True,
+        **kwargs: Any,
+    ) -> Self:
+        """Find the peer through the server at `remote` and open a tunnel
+
+        `servers` are more nodes of the same `cluster`, asked together
+        with `remote`, the tunnel stays with the first to answer. With
+        `punch`, the peer is raced for at the ports its NAT may have
+        given it for us, see `net.first_peer_fetch`.
+        """
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(
+            ReUDPProtocol, sock=s
+        )
+        remotes = [remote, *servers]
+        peer, remote = await protocol.fetch_peer(
+            our_id, peer_id, remotes, punch=punch
+        )
+        tunnel = cls(
+            transport,
+            peer,
+            remote,
+            ids=(our_id, peer_id),
+            servers=[server for server in remotes if server != remote],
+            conn=conn_id(our_id, peer_id),
+            **kwargs,
+        )
+        protocol.tunnel = tunnel
+        return tunnel
+
+    @classmethod
+    async def open_direct(
+        cls, s: socket.socket, peer: Addr, **kwargs: Any
+    ) -> Self:
+        """Open a tunnel to the peer we already know, no server involved"""
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(
+            ReUDPProtocol, sock=s
+        )
+        tunnel = cls(transport, peer, **kwargs)
+        protocol.tunnel = tunnel
+        return tunnel
+
+    async def __aenter__(self) -> Self:
+        return self
+
+    async def __aexit__(self, *args: Any) -> None:
+        # try to ensure that all the messages are sent at the end
+        # won't work if our peer is disconnected first, of course
+        await self.drain(timeout=0.5)
+        self.close()
+
+        # print stats, because why not :3
+        self.stats.print_results()
+
+    def __aiter__(self) -> Self:
+        return self
+
+    async def __anext__(self) -> tuple[bytes, Addr]:
+        try:
+            return await self.recv_bytes()
+        except ConnectionError as e:
+            raise StopAsyncIteration from e
+
+    # protocol callbacks
+    def datagram_received(self, data: bytes, addr: Addr) -> None:
+        payload = memoryview(data)
+        ours = self.is_ours(payload)
+        self.handle_datagram(payload, addr)
+        # after, the peer may have just moved here, and while relayed the
+        # server is the peer
+        if ours and addr == self.peer:
+            self.last_heard = time.monotonic()
+            self.backoff.reset()
+
+        if self.read_queue:
+            self.readable.set()
+        self.wake_writers()
+        self.arm()
+
+    def error_received(self, exc: Exception) -> None:
+        if isinstance(exc, OSError) and exc.errno == errno.EMSGSIZE:
+            self.too_big = True
+        else:
+            logger.error(f"<> {exc}")
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        if exc is not None:
+            self.fail(exc)
+        else:
+            self.close()
+
+    # session hooks
+    def raw_send(self, msg: bytes) -> None:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"-> {msg!r}")
+        self.last_sent = time.monotonic()
+        self.transport.sendto(msg, self.peer)
+
+    def send_probe(self, probe: bytes) -> bool:
+        # the transport reports send errors through error_received instead
+        # of raising, and does it right away if the socket is writable
+        self.too_big = False
+        with dont_fragment(self.transport.get_extra_info("socket")):
+            self.transport.sendto(probe, self.peer)
+        return not self.too_big
+
+    def quiet(self) -> bool:
+        # we can't peek, so let the ack timer decide
+        return False
+
+    def send_alive(self) -> None:
+        if self.remote is not None and self.ids is not None:
+            self.transport.sendto(alive_req(self.ids[0]), self.remote)
+
+    def binding_lost(self) -> None:
+        # the answer comes to handle_remote, which updates the peer
+        self.send_resume()
+        if self.remote is not None and self.ids is not None:
+            self.rejoining = True
+            self.transport.sendto(peer_req(*self.ids), self.remote)
+
+    def flush_ack(self) -> None:
+        super().flush_ack()
+        if self.ack_pending and self.ack_timer is None:
+            self.ack_timer = self.loop.call_later(
+                self.ACK_DELAY, self.ack_timeout
+            )
+
+    def ack_timeout(self) -> None:
+        self.ack_timer = None
+        if self.ack_pending:
+            self.send_ack()
+
+    def next_deadline(self) -> Optional[float]:
+        deadlines = []
+        if (deadline := super().next_deadline()) is not None:
+            deadlines.append(deadline)
+        if not self.us_ok:
+            deadlines.append(self.last_syn + self.SYN_RESEND)
+        if self.stalled():
+            silence = self.last_heard + self.SILENCE
+            deadlines.append(max(silence, self.backoff.next_at))
+
+        return min(deadlines, default=None)
+
+    # timers
+    def arm(self) -> None:
+        """Make sure the timer fires by the next deadline"""
+        if self.closed:
+            return
+        deadline = self.next_deadline()
+        if deadline is None:
+            return
+        if self.timer is not None:
+            if self.timer_at <= deadline:
+                # it'll re-arm itself when it fires
+                return
+            self.timer.cancel()
+
+        # loop.time() is time.monotonic()
+        self.timer = self.loop.call_at(deadline, self.on_timer)
+        self.timer_at = deadline
+
+    def on_timer(self) -> None:
+        self.timer = None
+        now = time.monotonic()
+
+        self.service_timers()
+        if not self.us_ok and now - self.last_syn >= self.SYN_RESEND:
+            self.send_syn()
+        if (
+            self.stalled()
+            and now - self.last_heard >= self.SILENCE
+            and self.backoff.due(now)
+        ):
+            self.try_to_reconnect()
+
+        self.wake_writers()
+        self.arm()
+
+    def send_syn(self) -> None:
+        self.last_syn = time.monotonic()
+        self.raw_send(self.syn_msg())
+
+    def try_to_reconnect(self) -> None:
+        now = time.monotonic()
+        if self.backoff.expired(now):
+            self.fail(RuntimeError("i'm tired"))
+            return
+        self.backoff.attempt(now)
+
+        logger.error(
+            f"<> connection has failed, reconnecting #{self.backoff.attempts}"
+        )
+        assert self.backoff.started is not None
+        if (
+            self.relay_after is not None
+            and now - self.backoff.started >= self.relay_after
+        ):
+            self.start_relay()
+        assert self.remote is not None and self.ids is not None
+        if len(self.servers) > 1 and not self.relayed:
+            # the server may be what's gone, ask the next one this time
+            i = self.servers.index(self.remote)
+            self.remote = self.servers[(i + 1) % len(self.servers)]
+        self.send_resume()
+        # the answer comes to handle_remote, which updates the peer
+        self.rejoining = True
+        self.transport.sendto(peer_req(*self.ids), self.remote)
+
+    def wake_writers(self) -> None:
+        if len(self.send_queue) < self.window:
+            self.writable.set()
+        if not self.sent and not self.send_queue:
+            self.idle.set()
+
+    # user api
+    def check(self) -> None:
+        if self.error is not None:
+            raise self.error
+        if self.closed:
+            raise ConnectionError("tunnel is closed")
+
+    async def send(self, msg: str) -> None:
+        await self.send_bytes(msg.encode("utf-8"))
+
+    async def send_bytes(self, msg: BytesLike) -> None:
+        """Queue the message, waiting while a whole window is queued up"""
+        while len(self.send_queue) >= self.window:
+            self.check()
+            self.writable.clear()
+            await self.writable.wait()
+        self.check()
+
+        if not self.sent:
+            # silence counts from now on, not from the last time we talked
+            self.last_heard = time.monotonic()
+        self.push_bytes(msg)
+        if self.sent or self.send_queue:
+            self.idle.clear()
+        self.arm()
+
+    async def recv(self) -> tuple[str, Addr]:
+        msg, addr = await self.recv_bytes()
+        return str(msg, "utf-8"), addr
+
+    async def recv_bytes(self) -> tuple[bytes, Addr]:
+        """Wait for the next message
+
+        Messages that arrived before the tunnel closed are still returned,
+        after that raises ConnectionError.
+        """
+        while not self.read_queue:
+            self.check()
+            self.readable.clear()
+            await self.readable.wait()
+
+        res = self.get_bytes()
+        assert res is not None
+        return res
+
+    async def drain(self, *, timeout: Optional[float] = None) -> bool:
+        """Wait until everything sent is acked, False on timeout"""
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+        except TimeoutError:
+            return False
+        return True
+
+    def fail(self, exc: Exception) -> None:
+        logger.error(f"<> tunnel failed: {exc}")
+        self.error = exc
+        self.close()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+
+        # don't make the peer resend what we've got already
+        if self.ack_pending:
+            self.send_ack()
+        # exit from the remote server mapping
+        # NOTE: using UDP, packet may or may not be delivered
+        if self.remote is not None and self.ids is not None:
+            self.transport.sendto(exit_req(*self.ids), self.remote)
+
+        for timer in (self.timer, self.ack_timer):
+            if timer is not None:
+                timer.cancel()
+        self.timer = self.ack_timer = None
+        self.transport.close()
+
+        # wake everyone up, so they can see it's over
+        self.readable.set()
+        self.writable.set()
+        self.idle.set()
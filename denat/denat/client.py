@@ -6,9 +6,10 @@ import random
 import socket
 import sys
 import tomllib
+from collections.abc import Sequence
 from typing import Optional
 
-from .net import Addr, prepare_socket
+from .net import Addr, parse_addr, prepare_socket
 from .reudp import ReUDP
 
 # utils
@@ -20,6 +21,8 @@ def game_loop(
     our_id: str,
     peer_id: str,
     remote: Addr,
+    servers: Sequence[Addr] = (),
+    relay_after: Optional[float] = None,
 ) -> None:
     def we_won(our_pick: str, their_pick: str) -> Optional[bool]:
         if our_pick == their_pick:
@@ -40,7 +43,9 @@ def game_loop(
         print(f"<*> on turn {turn} we picked: {pick}")
         return pick
 
-    with ReUDP(s, our_id, peer_id, remote) as tunnel:
+    with ReUDP(
+        s, our_id, peer_id, remote, servers=servers, relay_after=relay_after
+    ) as tunnel:
         for game in range(5):
             print(f"<> it's a {game+1}th game")
             for turn in itertools.count():
@@ -76,12 +81,16 @@ def main() -> None:
             peer_id = sys.argv[3]
             logger.info(f"<> rewrite peer_id with {peer_id}")
 
+        rcvbuf = data.get("rcvbuf")
+        servers = [parse_addr(server) for server in data.get("servers", [])]
+        relay_after = data.get("relay_after")
+
     except Exception as e:
         logger.error("couldn't read the config.toml")
         logger.error(f"{e=}")
         sys.exit(1)
 
-    s = prepare_socket()
+    s = prepare_socket(rcvbuf=rcvbuf)
     logger.info(f"<> good, ready to connect to {remote_host}:{remote_port}")
 
     game_loop(
@@ -89,6 +98,8 @@ def main() -> None:
         our_id,
         peer_id,
         remote,
+        servers,
+        relay_after,
     )
 
 
@@ -0,0 +1,173 @@
+"""Several rendezvous servers acting as one
+
+Every node is started with the same list of nodes. The id pair is hashed
+onto a ring of the nodes that are alive, and the node it lands on owns
+the pair (consistent hashing). Clients may talk to any node, JOINs and
+EXITs for pairs of another node are forwarded to the owner together with
+the client address. The owner replies back through the node the client
+talked to, because the client's NAT only lets that one through.
+
+Nodes send each other heartbeats. When a node goes quiet, its pairs move
+to the next node on the ring and the pairs of other nodes stay put, so
+clients that fail over to another node get introduced again.
+
+Between nodes, on the same UDP port as the clients:
+    NODE#                       heartbeat
+    FWD#<host>:<port>\\n<msg>    datagram from the client at host:port
+    RELAY#<host>:<port>\\n<msg>  reply to send to the client at host:port
+
+Anyone can send from a node's address, so every one of them ends with
+the first `TAG` bytes of its HMAC-SHA256 under the secret all the nodes
+share, and what doesn't check out is dropped. Replays aren't caught, but
+all they do is repeat what a node has already said.
+"""
+
+from __future__ import annotations
+
+import bisect
+import hashlib
+import hmac
+import logging
+import socket
+import time
+import zlib
+from collections.abc import Callable, Container, Sequence
+from typing import Optional
+
+from .net import Addr, parse_addr
+
+logger = logging.getLogger(__name__)
+
+# points per node on the ring, more spreads the pairs more evenly
+VNODES = 64
+# how often nodes tell each other they're alive
+HEARTBEAT = 1.0
+# how long a node may be silent before it's considered gone
+NODE_TIMEOUT = 3.5
+# a client datagram with the FWD header, or a reply with the RELAY one
+MAX_DATAGRAM = 256
+# bytes of the HMAC at the end of every datagram between nodes
+TAG = 16
+
+
+def key_hash(key: bytes) -> int:
+    # hash() is salted per process, nodes need to agree
+    return zlib.crc32(key)
+
+
+class Ring:
+    """Consistent hash ring of `nodes`"""
+
+    def __init__(self, nodes: Sequence[Addr]) -> None:
+        points = sorted(
+            (key_hash(f"{host}:{port}#{i}".encode()), (host, port))
+            for host, port in nodes
+            for i in range(VNODES)
+        )
+        self.hashes = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def owner(self, key: bytes) -> Addr:
+        i = bisect.bisect(self.hashes, key_hash(key)) % len(self.hashes)
+        return self.nodes[i]
+
+
+class Cluster:
+    """Membership and routing of the node `us`, talking through `s`
+
+    Also a `server.Sender`: replies to clients that came through another
+    node go back through it, see `via`. What goes to other nodes is signed
+    with `secret`.
+    """
+
+    def __init__(
+        self,
+        s: socket.socket,
+        us: Addr,
+        nodes: Sequence[Addr],
+        *,
+        secret: bytes,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.s = s
+        self.us = us
+        self.secret = secret
+        self.clock = clock
+
+        now = clock()
+        # everyone is assumed alive at the start, so that nodes started
+        # together agree on the ring right away
+        self.last_heard = {node: now for node in nodes if node != us}
+        self.alive = set(self.last_heard)
+        self.ring = Ring([us, *self.alive])
+        self.last_beat = 0.0
+
+        # node every forwarded client came through
+        self.via: dict[Addr, Addr] = {}
+
+    def is_node(self, addr: Addr) -> bool:
+        return addr in self.last_heard
+
+    def tag(self, data: bytes) -> bytes:
+        return hmac.new(self.secret, data, hashlib.sha256).digest()[:TAG]
+
+    def seal(self, data: bytes) -> bytes:
+        return data + self.tag(data)
+
+    def unseal(self, payload: bytes) -> Optional[bytes]:
+        """What the node sent, None if it isn't signed with our secret"""
+        data, tag = payload[:-TAG], payload[-TAG:]
+        if len(tag) < TAG or not hmac.compare_digest(tag, self.tag(data)):
+            return None
+        return data
+
+    def owner(self, key: bytes) -> Addr:
+        return self.ring.owner(key)
+
+    def heard(self, node: Addr) -> None:
+        self.last_heard[node] = self.clock()
+        if node not in self.alive:
+            logger.warning(f"<> node {node} is back")
+            self.alive.add(node)
+            self.ring = Ring([self.us, *self.alive])
+
+    def service(self, known: Container[Addr]) -> None:
+        """Heartbeats and failure detection, `known` are live clients"""
+        now = self.clock()
+        if now - self.last_beat < HEARTBEAT:
+            return
+        self.last_beat = now
+
+        for node, heard in self.last_heard.items():
+            self.s.sendto(self.seal(b"NODE#"), node)
+            if node in self.alive and now - heard > NODE_TIMEOUT:
+                logger.warning(f"<> node {node} went silent")
+                self.alive.discard(node)
+                self.ring = Ring([self.us, *self.alive])
+
+        # forget clients whose entries are gone
+        self.via = {
+            client: node for client, node in self.via.items() if client in known
+        }
+
+    def forward(self, node: Addr, client: Addr, payload: bytes) -> None:
+        host, port = client
+        forwarded = b"FWD#%s:%d\n%s" % (host.encode(), port, payload)
+        self.s.sendto(self.seal(forwarded), node)
+
+    def broadcast(self, client: Addr, payload: bytes) -> None:
+        for node in self.alive:
+            self.forward(node, client, payload)
+
+    def relay(self, msg: bytes) -> None:
+        """Send the reply another node asked us to"""
+        addr_string, _, reply = msg.partition(b"\n")
+        self.s.sendto(reply, parse_addr(addr_string.decode("utf-8")))
+
+    def sendto(self, data: bytes | memoryview, addr: Addr) -> int:
+        if (node := self.via.get(addr)) is None:
+            return self.s.sendto(data, addr)
+
+        host, port = addr
+        relayed = b"RELAY#%s:%d\n%s" % (host.encode(), port, data)
+        return self.s.sendto(self.seal(relayed), node)
@@ -0,0 +1,51 @@
+"""Congestion controllers for ReUDP
+
+Controller decides how many messages may be in flight at once, ReUDP tells
+it when messages get acked and when they get lost.
+"""
+
+from __future__ import annotations
+
+
+class CongestionControl:
+    """Base controller that doesn't control anything
+
+    Subclass it and override the hooks to get a real one.
+    """
+
+    def __init__(self) -> None:
+        self.cwnd = float("inf")
+
+    def on_ack(self, acked: int, in_flight: int) -> None:
+        """`acked` new messages were acked, `in_flight` are still out"""
+
+    def on_loss(self, in_flight: int) -> None:
+        """Loss detected by the acks, once per recovery episode"""
+
+    def on_timeout(self, in_flight: int) -> None:
+        """Retransmission timer fired, once per recovery episode"""
+
+
+class NewReno(CongestionControl):
+    """AIMD with slow start, counted in messages instead of bytes"""
+
+    def __init__(self, *, initial: float = 4, min_cwnd: float = 2) -> None:
+        self.cwnd = initial
+        self.ssthresh = float("inf")
+        self.min_cwnd = min_cwnd
+
+    def on_ack(self, acked: int, in_flight: int) -> None:
+        if self.cwnd < self.ssthresh:
+            # slow start, double every round trip
+            self.cwnd += acked
+        else:
+            # congestion avoidance, one message every round trip
+            self.cwnd += acked / self.cwnd
+
+    def on_loss(self, in_flight: int) -> None:
+        self.ssthresh = max(in_flight / 2, self.min_cwnd)
+        self.cwnd = self.ssthresh
+
+    def on_timeout(self, in_flight: int) -> None:
+        self.ssthresh = max(in_flight / 2, self.min_cwnd)
+        self.cwnd = 1
@@ -0,0 +1,170 @@
+"""Append-only log of the server mapping, so a restart doesn't lose it
+
+Every change of an entry is appended as a record, PUT with the entry as
+it is now or DEL with just the ids. Replaying the log gives the mapping
+back, the last record of every pair wins. Once the log has grown well
+past the number of live entries, it's compacted: written anew as one PUT
+per entry into a temporary file, which then replaces the log.
+
+Records are binary, IPv4 only like the server itself:
+    kind u8 | len u8 | id | len u8 | id [| ip 4s | port u16 | ip | port]
+an empty side is 0.0.0.0:0.
+
+Writes are buffered and flushed once per loop iteration (every 50 ms on
+asyncio), so a killed server loses next to nothing, a power cut may lose
+the last moments. Compaction is fsynced.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import logging
+import os
+import socket
+import struct
+from collections.abc import Iterable
+from typing import BinaryIO, Optional
+
+from .net import Addr
+
+logger = logging.getLogger(__name__)
+
+# one side of the entry: id and its address, if any
+Side = tuple[str, Optional[Addr]]
+
+PUT = 1
+DEL = 2
+
+HEADER = struct.Struct("!BBB")
+ADDR = struct.Struct("!4sH")
+
+NOWHERE = bytes(4), 0
+
+
+def encode_addr(addr: Optional[Addr]) -> tuple[bytes, int]:
+    if addr is None:
+        return NOWHERE
+    host, port = addr
+    return socket.inet_aton(host), port
+
+
+def decode_addr(raw: bytes) -> Optional[Addr]:
+    ip, port = ADDR.unpack(raw)
+    if (ip, port) == NOWHERE:
+        return None
+    return socket.inet_ntoa(ip), port
+
+
+def encode(kind: int, a: Side, b: Side) -> bytes:
+    id_a, id_b = a[0].encode("utf-8"), b[0].encode("utf-8")
+    record = HEADER.pack(kind, len(id_a), len(id_b)) + id_a + id_b
+    if kind == PUT:
+        record += ADDR.pack(*encode_addr(a[1])) + ADDR.pack(*encode_addr(b[1]))
+    return record
+
+
+def load(path: str) -> tuple[list[tuple[Side, Side]], int]:
+    """Entries in the log, least recently changed first, and its good size
+
+    A record torn by a crash can only be at the end, the size is where
+    it starts.
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return [], 0
+
+    entries: dict[tuple[str, str], tuple[Side, Side]] = {}
+    # clients register many pairs from one address, parse it once
+    addrs: dict[bytes, Optional[Addr]] = {}
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        kind, len_a, len_b = HEADER.unpack_from(data, offset)
+        start = offset + HEADER.size
+        middle = start + len_a
+        end = middle + len_b
+        if kind == PUT:
+            end += 2 * ADDR.size
+        if end > len(data) or kind not in (PUT, DEL):
+            break
+
+        id_a = data[start:middle].decode("utf-8")
+        id_b = data[middle : middle + len_b].decode("utf-8")
+        key = (id_a, id_b) if id_a <= id_b else (id_b, id_a)
+        # the order is by the last record
+        entries.pop(key, None)
+        if kind == PUT:
+            raw_a = data[end - 2 * ADDR.size : end - ADDR.size]
+            raw_b = data[end - ADDR.size : end]
+            if raw_a not in addrs:
+                addrs[raw_a] = decode_addr(raw_a)
+            if raw_b not in addrs:
+                addrs[raw_b] = decode_addr(raw_b)
+            entries[key] = ((id_a, addrs[raw_a]), (id_b, addrs[raw_b]))
+        offset = end
+
+    if offset < len(data):
+        # torn write at the end, whatever came before is good
+        logger.warning(f"<> journal {path} is cut at {offset}")
+    return list(entries.values()), offset
+
+
+class Journal:
+    """Log of the mapping at `path`, appended to from `size` on
+
+    `records` counts what was written since the last compaction, to know
+    when it's time for the next one. The file stays open until `close`.
+    """
+
+    def __init__(self, path: str, size: int = 0) -> None:
+        self.path = path
+        self.file: BinaryIO = open(path, "ab")  # noqa: SIM115
+        try:
+            # whatever is past it is torn
+            self.file.truncate(size)
+        except BaseException:
+            self.file.close()
+            raise
+        self.records = 0
+        self.dirty = False
+
+    def put(self, a: Side, b: Side) -> None:
+        self.file.write(encode(PUT, a, b))
+        self.records += 1
+        self.dirty = True
+
+    def delete(self, a: Side, b: Side) -> None:
+        self.file.write(encode(DEL, a, b))
+        self.records += 1
+        self.dirty = True
+
+    def flush(self) -> None:
+        if self.dirty:
+            self.file.flush()
+            self.dirty = False
+
+    def compact(self, entries: Iterable[tuple[Side, Side]]) -> None:
+        """Replace the log with `entries`, in order"""
+        tmp = f"{self.path}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(b"".join(encode(PUT, a, b) for a, b in entries))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except BaseException:
+            # the old log is still there, and still open
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp)
+            raise
+
+        # the old file is only open here now, move on to the new one
+        file = open(self.path, "ab")  # noqa: SIM115
+        self.file.close()
+        self.file = file
+        self.records = 0
+        self.dirty = False
+
+    def close(self) -> None:
+        self.file.close()
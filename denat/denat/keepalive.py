@@ -0,0 +1,144 @@
+"""Keeping NAT bindings open while tunnels are idle
+
+A NAT forgets the UDP binding after a while without outgoing traffic.
+RFC 4787 asks for two minutes at least, plenty of home routers give 30
+seconds or less. Once it's gone, the peer's datagrams are dropped and the
+first message after the pause has to go through the server again.
+
+So an idle tunnel sends the peer a heartbeat a bit before the binding
+would expire, a PROBE of the smallest size, which every peer echoes
+anyway, and the server an ALIVE. How long "a bit before" is gets learned
+by `Lifetime`: a heartbeat the peer answered right away proves the binding
+survives that much silence, so the next wait is longer, and one that got lost
+means it didn't, so the wait falls back under it.
+
+Heartbeats are due on multiples of `slot`, so tunnels that went quiet
+at about the same time send theirs on the same wakeup, and tunnels on one
+socket (`Mux`) share the `Lifetime` and a single ALIVE to the server.
+"""
+
+from __future__ import annotations
+
+import enum
+import math
+from typing import Optional
+
+
+class Lifetime:
+    """How long a NAT binding survives without traffic, as far as we know
+
+    `interval` is how long a tunnel may stay quiet before it sends a
+    heartbeat. It starts at `initial` and grows by `GROWTH` with every
+    heartbeat that got through, but stays at `MARGIN` of the shortest
+    silence that lost the binding, and between `floor` and `ceiling`. Once
+    a heartbeat is lost, it's back to the longest silence that kept the
+    binding, or half of what lost it if there's none yet.
+    """
+
+    GROWTH = 1.25
+    MARGIN = 0.8
+
+    def __init__(
+        self,
+        initial: float = 15.0,
+        *,
+        floor: float = 5.0,
+        ceiling: float = 120.0,
+        slot: float = 1.0,
+    ) -> None:
+        self.interval = initial
+        self.floor = floor
+        self.ceiling = ceiling
+        self.slot = slot
+
+        # the longest silence that kept the binding, the shortest one that
+        # lost it
+        self.survived = 0.0
+        self.lost = math.inf
+
+    def due(self, last_sent: float) -> float:
+        """When to send a heartbeat if nothing went out since `last_sent`"""
+        # rounded down, it's better to be early than late
+        due = math.floor((last_sent + self.interval) / self.slot) * self.slot
+        return max(due, last_sent + self.floor)
+
+    def kept(self, silence: float) -> None:
+        self.survived = max(self.survived, silence)
+        if silence >= self.lost:
+            # whatever lost it back then, it wasn't the NAT timeout
+            self.lost = math.inf
+        grown = min(self.interval * self.GROWTH, self.lost * self.MARGIN)
+        self.interval = max(self.interval, min(grown, self.ceiling))
+
+    def broke(self, silence: float) -> None:
+        self.lost = min(self.lost, silence)
+        # back to what's known to work, or halfway down if nothing is
+        fallback = self.survived if self.survived else silence / 2
+        self.interval = max(self.floor, min(fallback, silence * self.MARGIN))
+
+
+class Beat(enum.Enum):
+    # time to send a heartbeat
+    Send = enum.auto()
+    # the heartbeat wasn't answered, the binding is likely gone
+    Lost = enum.auto()
+
+
+class Heartbeat:
+    """Heartbeats of one tunnel, which learn into `lifetime`
+
+    Each heartbeat is tried `ATTEMPTS` times before the binding is
+    considered lost, because it may be lost for reasons that have nothing
+    to do with the NAT. Only an echo of the first try says the binding
+    held, if it took a resend, the first one most likely ran into
+    a binding that was gone and the peer's traffic opened it again.
+    """
+
+    ATTEMPTS = 3
+
+    def __init__(self, lifetime: Lifetime) -> None:
+        self.lifetime = lifetime
+
+        # how long the tunnel was quiet before the heartbeat in flight
+        self.silence: Optional[float] = None
+        self.attempts = 0
+        self.sent_at = 0.0
+
+    def deadline(self, last_sent: float, timeout: float) -> float:
+        if self.silence is not None:
+            return self.sent_at + timeout
+        return self.lifetime.due(last_sent)
+
+    def poll(
+        self, now: float, last_sent: float, timeout: float
+    ) -> Optional[Beat]:
+        """What to do now, if anything"""
+        if self.silence is not None:
+            if now - self.sent_at < timeout:
+                return None
+            self.attempts += 1
+            if self.attempts >= self.ATTEMPTS:
+                self.lifetime.broke(self.silence)
+                self.silence = None
+                return Beat.Lost
+        elif now >= self.lifetime.due(last_sent):
+            self.silence = now - last_sent
+            self.attempts = 0
+        else:
+            return None
+
+        self.sent_at = now
+        return Beat.Send
+
+    def cancel(self) -> None:
+        """Forget the heartbeat in flight, there's other traffic now"""
+        self.silence = None
+
+    def answered(self) -> None:
+        if self.silence is None:
+            return
+        if self.attempts == 0:
+            self.lifetime.kept(self.silence)
+        else:
+            self.lifetime.broke(self.silence)
+        self.silence = None
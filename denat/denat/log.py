@@ -0,0 +1,97 @@
+"""Logging that doesn't slow down the hot loop
+
+Records are put into a queue and written by a background thread, at most
+`rate` lines per second, the rest is counted and reported with the next
+line that makes it through. Every line looks the same:
+
+    2024-01-01 12:00:00,000 INFO denat.server: registered a @ b dropped=12
+
+`setup(None)` turns logging off altogether.
+"""
+
+from __future__ import annotations
+
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+from typing import IO, Optional
+
+LEVELS = {
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+    "off": None,
+}
+
+
+class RateLimit(logging.Filter):
+    """Token bucket, lets through `rate` records per second on average"""
+
+    def __init__(self, rate: float) -> None:
+        super().__init__()
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        now = time.monotonic()
+        refill = (now - self.last) * self.rate
+        self.tokens = min(self.rate, self.tokens + refill)
+        self.last = now
+        if self.tokens < 1:
+            self.dropped += 1
+            return False
+
+        self.tokens -= 1
+        record.dropped = self.dropped
+        self.dropped = 0
+        return True
+
+
+class Formatter(logging.Formatter):
+    def __init__(self) -> None:
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        if dropped := getattr(record, "dropped", 0):
+            line += f" dropped={dropped}"
+        return line
+
+
+def setup(
+    level: Optional[int],
+    *,
+    rate: float = 100.0,
+    stream: IO[str] = sys.stdout,
+) -> Optional[logging.handlers.QueueListener]:
+    """Route everything through the queue, None for `level` is off
+
+    Replaces whatever handlers were there, so it's safe to call again in
+    a forked process. What's left in the queue is written at exit.
+    """
+    root = logging.getLogger()
+    root.handlers.clear()
+    if level is None:
+        logging.disable(logging.CRITICAL)
+        return None
+
+    logging.disable(logging.NOTSET)
+    records: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(records)
+    # drop before queueing, so a flood costs as little as possible
+    handler.addFilter(RateLimit(rate))
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    out = logging.StreamHandler(stream)
+    out.setFormatter(Formatter())
+    listener = logging.handlers.QueueListener(records, out)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,239 @@
+"""recvmmsg/sendmmsg through ctypes, Linux only
+
+Python has no binding for these, so we call libc directly. One call moves
+up to `count` datagrams, which saves a syscall per datagram at high
+packet rates. IPv4 only, `available` is False wherever it can't work and
+`net.BatchIO` falls back to plain loops.
+"""
+
+from __future__ import annotations
+
+import ctypes
+import errno
+import os
+import socket
+import sys
+from typing import TYPE_CHECKING, Any, Optional
+
+if TYPE_CHECKING:
+    from .net import Addr, BufferPool
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),
+        ("iov_len", ctypes.c_size_t),
+    ]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_hdr", msghdr),
+        ("msg_len", ctypes.c_uint),
+    ]
+
+
+# struct sockaddr_in
+SOCKADDR_LEN = 16
+
+_libc: Optional[ctypes.CDLL] = None
+if sys.platform == "linux":
+    try:
+        _libc = ctypes.CDLL(None, use_errno=True)
+        for _name in ("recvmmsg", "sendmmsg"):
+            _func = getattr(_libc, _name)
+            _func.restype = ctypes.c_int
+        _libc.recvmmsg.argtypes = [
+            ctypes.c_int,
+            ctypes.POINTER(mmsghdr),
+            ctypes.c_uint,
+            ctypes.c_int,
+            ctypes.c_void_p,
+        ]
+        _libc.sendmmsg.argtypes = [
+            ctypes.c_int,
+            ctypes.POINTER(mmsghdr),
+            ctypes.c_uint,
+            ctypes.c_int,
+        ]
+    except (OSError, AttributeError):
+        # no libc symbols, musl without them or something exotic
+        _libc = None
+
+available = _libc is not None
+
+
+def sockaddr(addr: Addr) -> bytes:
+    host, port = addr
+    family = socket.AF_INET.to_bytes(2, sys.byteorder)
+    return (
+        family
+        + port.to_bytes(2, "big")
+        + socket.inet_aton(host)
+        + bytes(SOCKADDR_LEN - 8)
+    )
+
+
+def parse_sockaddr(raw: bytes) -> Addr:
+    return socket.inet_ntoa(raw[4:8]), int.from_bytes(raw[2:4], "big")
+
+
+def _check(ret: int) -> int:
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return ret
+
+
+class Slots:
+    """Headers of an arena, and what they point at
+
+    ctypes doesn't keep the iovecs and the arena alive for the headers,
+    so they stay here, together with them.
+    """
+
+    __slots__ = ("hdrs", "iovs", "arena")
+
+    def __init__(self, hdrs: Any, iovs: Any, arena: Any) -> None:
+        self.hdrs = hdrs
+        self.iovs = iovs
+        self.arena = arena
+
+
+class MmsgIO:
+    """Preallocated headers and buffers for up to `count` datagrams each way
+
+    The kernel fills one fixed arena of `count` slots, each datagram is
+    then copied out into a buffer from `pool`. Copying a datagram is much
+    cheaper than pointing ctypes at a fresh buffer, and sends go through
+    an arena of their own for the same reason.
+    """
+
+    def __init__(self, pool: BufferPool, count: int) -> None:
+        if _libc is None:
+            raise RuntimeError("recvmmsg/sendmmsg are not available")
+        self.pool = pool
+        self.count = count
+        self.size = size = pool.size
+
+        # receiving
+        self.recv_arena = bytearray(size * count)
+        self.recv_view = memoryview(self.recv_arena)
+        self.recv_slots = self.headers(self.recv_arena)
+        self.recv_hdrs = self.recv_slots.hdrs
+        self.names = ctypes.create_string_buffer(SOCKADDR_LEN * count)
+        names = ctypes.addressof(self.names)
+        for i in range(count):
+            hdr = self.recv_hdrs[i].msg_hdr
+            hdr.msg_name = names + SOCKADDR_LEN * i
+            hdr.msg_namelen = SOCKADDR_LEN
+        # peers are few, no need to parse their addresses every time
+        self.addrs: dict[bytes, Addr] = {}
+
+        # sending
+        self.send_arena = bytearray(size * count)
+        self.send_slots = self.headers(self.send_arena)
+        self.send_hdrs = self.send_slots.hdrs
+        self.send_iovs = []
+        for i in range(count):
+            hdr = self.send_hdrs[i].msg_hdr
+            hdr.msg_namelen = SOCKADDR_LEN
+            self.send_iovs.append(hdr.msg_iov[0])
+        # what's in msg_name of every slot
+        self.send_addrs: list[Optional[Addr]] = [None] * count
+        self.sockaddrs: dict[Addr, Any] = {}
+
+    def headers(self, arena: bytearray) -> Slots:
+        """Headers for every slot of the arena, one iovec each"""
+        hdrs = (mmsghdr * self.count)()
+        iovs = (iovec * self.count)()
+        # also stops the arena from being resized under the kernel's feet
+        view = (ctypes.c_char * len(arena)).from_buffer(arena)
+        base = ctypes.addressof(view)
+        for i in range(self.count):
+            iovs[i].iov_base = base + self.size * i
+            iovs[i].iov_len = self.size
+            hdrs[i].msg_hdr.msg_iov = ctypes.pointer(iovs[i])
+            hdrs[i].msg_hdr.msg_iovlen = 1
+        return Slots(hdrs, iovs, view)
+
+    def recv(self, s: socket.socket) -> list[tuple[memoryview, Addr]]:
+        assert _libc is not None
+        n = _libc.recvmmsg(
+            s.fileno(), self.recv_hdrs, self.count, socket.MSG_DONTWAIT, None
+        )
+        if n < 0:
+            if ctypes.get_errno() in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            _check(n)
+
+        batch = []
+        raw_names = self.names.raw
+        for i in range(n):
+            raw = raw_names[SOCKADDR_LEN * i : SOCKADDR_LEN * i + 8]
+            if (addr := self.addrs.get(raw)) is None:
+                addr = self.addrs[raw] = parse_sockaddr(raw)
+            hdr = self.recv_hdrs[i]
+            nbytes = hdr.msg_len
+            hdr.msg_hdr.msg_namelen = SOCKADDR_LEN
+
+            buf = self.pool.take()
+            start = self.size * i
+            buf[:nbytes] = self.recv_view[start : start + nbytes]
+            batch.append((memoryview(buf)[:nbytes], addr))
+
+        return batch
+
+    def sockaddr_of(self, addr: Addr) -> int:
+        if (name := self.sockaddrs.get(addr)) is None:
+            name = ctypes.create_string_buffer(sockaddr(addr), SOCKADDR_LEN)
+            self.sockaddrs[addr] = name
+        return ctypes.addressof(name)
+
+    def send(self, s: socket.socket, packets: list[tuple[bytes, Addr]]) -> None:
+        assert _libc is not None
+        n = 0
+        for data, addr in packets:
+            if len(data) > self.size:
+                # doesn't fit into the slot, rare enough to not bother
+                self.flush(s, n)
+                n = 0
+                s.sendto(data, addr)
+                continue
+
+            start = self.size * n
+            self.send_arena[start : start + len(data)] = data
+            self.send_iovs[n].iov_len = len(data)
+            if self.send_addrs[n] != addr:
+                self.send_hdrs[n].msg_hdr.msg_name = self.sockaddr_of(addr)
+                self.send_addrs[n] = addr
+            n += 1
+            if n == self.count:
+                self.flush(s, n)
+                n = 0
+        self.flush(s, n)
+
+    def flush(self, s: socket.socket, n: int) -> None:
+        """Send the first `n` slots"""
+        assert _libc is not None
+        sent = 0
+        while sent < n:
+            # blocking socket, so it waits for space instead of failing
+            hdrs = ctypes.cast(
+                ctypes.addressof(self.send_hdrs)
+                + sent * ctypes.sizeof(mmsghdr),
+                ctypes.POINTER(mmsghdr),
+            )
+            sent += _check(_libc.sendmmsg(s.fileno(), hdrs, n - sent, 0))
@@ -0,0 +1,304 @@
+"""Many ReUDP sessions over one UDP socket
+
+One bound port, one NAT mapping, any number of peers. Every packet carries
+the connection id both peers derive from their ids (see `net.conn_id`), so
+`Mux` reads the socket and hands each datagram to the session it belongs
+to. Server replies name the peer, so they're routed by peer id, and a
+single keep-alive holds the binding to the server open for everyone.
+Sessions learn how long the binding lives together, see `keepalive`.
+
+    with Mux(s, "alice", remote) as mux:
+        bob = mux.connect("bob")
+        carol = mux.connect("carol")
+        bob.send("hi")
+        msg, addr = carol.get_blocking()
+"""
+
+from __future__ import annotations
+
+import logging
+import socket
+import time
+from typing import Any, Optional, Self
+
+from . import wire
+from .keepalive import Lifetime
+from .net import (
+    Addr,
+    BufferPool,
+    alive_req,
+    conn_id,
+    exit_req,
+    parse_server_reply,
+    peer_req,
+    ready,
+    timeout_recv_into,
+)
+from .pmtu import MAX_MTU, send_df
+from .session import BytesLike, Session, TickResult
+from .wire import WireError
+
+logger = logging.getLogger(__name__)
+
+
+class MuxSession(Session):
+    """Tunnel to one of the `Mux` peers, sends through the shared socket"""
+
+    def __init__(
+        self, mux: Mux, peer_id: str, peer: Addr, **kwargs: Any
+    ) -> None:
+        self.mux = mux
+        self.peer_id = peer_id
+        # server messages go through the mux, hence no remote
+        super().__init__(
+            peer, None, conn=conn_id(mux.our_id, peer_id), **kwargs
+        )
+        # datagrams are received before we know whose they are
+        self.pool = mux.pool
+        self.last_heard = time.monotonic()
+
+        # start a handshake
+        self.raw_send(self.syn_msg())
+
+    def raw_send(self, msg: bytes) -> None:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"-> {self.peer_id} {msg!r}")
+        self.last_sent = time.monotonic()
+        self.mux.s.sendto(msg, self.peer)
+
+    def send_probe(self, probe: bytes) -> bool:
+        return send_df(self.mux.s, probe, self.peer)
+
+    def quiet(self) -> bool:
+        return self.mux.quiet()
+
+    def binding_lost(self) -> None:
+        self.send_resume()
+        self.rejoining = True
+        self.mux.to_server(peer_req(self.mux.our_id, self.peer_id))
+
+    def wait(self) -> None:
+        """Block until there's something in read_queue"""
+        while not self.read_queue:
+            self.mux.poll()
+
+    def get_blocking(self) -> tuple[str, Addr]:
+        self.wait()
+
+        res = self.get()
+        assert res is not None
+        return res
+
+    def send(self, msg: str) -> None:
+        self.send_bytes(msg.encode("utf-8"))
+
+    def send_bytes(self, msg: BytesLike) -> None:
+        if not self.sent:
+            # silence counts from now on, not from the last time we talked
+            self.last_heard = time.monotonic()
+        self.push_bytes(msg)
+
+    def close(self) -> None:
+        self.mux.disconnect(self.peer_id)
+
+
+class Mux:
+    """Demultiplexer of ReUDP sessions sharing the socket `s`
+
+    `connect` asks the server at `remote` for the peer and blocks until
+    it answers, `poll` reads one datagram, routes it and services the
+    timers of every session. Sessions are blocking ReUDP lookalikes, their
+    `wait` and `get_blocking` poll the mux.
+
+    `kwargs` are passed to every `Session`.
+    """
+
+    # how long to wait for the server before asking again
+    JOIN_RESEND = 2.0
+    # how long a session may wait for the peer before asking the server
+    # where it went
+    SILENCE = 1.5
+
+    def __init__(
+        self,
+        s: socket.socket,
+        our_id: str,
+        remote: Addr,
+        **kwargs: Any,
+    ) -> None:
+        self.s = s
+        self.our_id = our_id
+        self.remote = remote
+        self.kwargs = kwargs
+        # one binding for everyone, so one lifetime to learn
+        self.lifetime: Lifetime = kwargs.setdefault("lifetime", Lifetime())
+
+        # sessions by connection id and by peer id
+        self.sessions: dict[int, MuxSession] = {}
+        self.by_peer: dict[str, MuxSession] = {}
+        # peers we asked the server for, and when
+        self.pending: dict[str, float] = {}
+        self.last_server = 0.0
+
+        # grows with every session, see `add_session`
+        self.pool = BufferPool(0, kwargs.get("max_mtu", MAX_MTU))
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        for peer_id in list(self.by_peer):
+            self.disconnect(peer_id, forget=False)
+
+        # try to ensure that all the messages are sent at the end
+        for _ in range(10):
+            self.poll(timeout=0.05)
+            resent = sum(
+                session.try_resend_lost(timeout=0.05)
+                for session in self.sessions.values()
+            )
+            if resent == 0:
+                break
+
+        for session in self.sessions.values():
+            session.stats.print_results()
+
+    def to_server(self, msg: bytes) -> None:
+        self.s.sendto(msg, self.remote)
+        self.last_server = time.monotonic()
+
+    def join(self, peer_id: str) -> None:
+        """Ask the server for the peer, session appears once it answers"""
+        self.pending[peer_id] = time.monotonic()
+        self.to_server(peer_req(self.our_id, peer_id))
+        logger.info(f"<> requesting the connection to {peer_id}")
+
+    def connect(self, peer_id: str) -> MuxSession:
+        """Open a session to the peer, blocks until the server answers"""
+        if (session := self.by_peer.get(peer_id)) is not None:
+            return session
+
+        self.join(peer_id)
+        while (session := self.by_peer.get(peer_id)) is None:
+            self.poll()
+        return session
+
+    def disconnect(self, peer_id: str, *, forget: bool = True) -> None:
+        """Leave the server mapping for the peer
+
+        The session is dropped too, unless it needs to stay around to
+        deliver the rest of its messages.
+        """
+        # NOTE: using UDP, packet may or may not be delivered
+        self.to_server(exit_req(self.our_id, peer_id))
+        logger.info(f"<> requested exit from {peer_id}")
+
+        self.pending.pop(peer_id, None)
+        if forget and (session := self.by_peer.pop(peer_id, None)) is not None:
+            del self.sessions[session.conn]
+            self.pool.count -= 2 * session.window
+
+    def add_session(self, peer_id: str, peer: Addr) -> MuxSession:
+        session = MuxSession(self, peer_id, peer, **self.kwargs)
+        if (other := self.sessions.get(session.conn)) is not None:
+            # astronomically unlikely, but two peers can't share an id
+            raise RuntimeError(
+                f"{peer_id} and {other.peer_id} hash to the same connection id"
+            )
+
+        self.sessions[session.conn] = session
+        self.by_peer[peer_id] = session
+        # early and read_queue may hold up to a window each
+        self.pool.count += 2 * session.window
+        return session
+
+    def quiet(self) -> bool:
+        return not ready(self.s)
+
+    def handle_server(self, payload: bytes) -> None:
+        try:
+            our, peer, peer_id = parse_server_reply(payload)
+        except ValueError as e:
+            logger.error(f"<> {e}")
+            return
+        if peer_id is None:
+            logger.error("<> server doesn't say whose address it is")
+            return
+
+        if (session := self.by_peer.get(peer_id)) is not None:
+            # we asked again, the peer may have moved
+            session.handle_remote(payload)
+            session.last_heard = time.monotonic()
+        elif self.pending.pop(peer_id, None) is not None:
+            logger.info(f"<> server says we are {our[0]}:{our[1]}")
+            logger.info(f"<> server says {peer_id} is {peer[0]}:{peer[1]}")
+            self.add_session(peer_id, peer)
+        else:
+            logger.error(f"<> server sent {peer_id}, we didn't ask")
+
+    def handle_datagram(
+        self, payload: memoryview, addr: Addr
+    ) -> Optional[tuple[MuxSession, TickResult]]:
+        if addr == self.remote:
+            self.handle_server(bytes(payload))
+            self.pool.release(payload)
+            return None
+
+        try:
+            conn = wire.conn_of(payload)
+        except WireError as e:
+            logger.error(f"malformed packet from {addr}: {e}")
+            self.pool.release(payload)
+            return None
+
+        if (session := self.sessions.get(conn)) is None:
+            # could be the peer's syn, which came before the server did
+            logger.error(f"unknown connection {conn} from {addr}")
+            self.pool.release(payload)
+            return None
+
+        if addr == session.peer:
+            session.last_heard = time.monotonic()
+        ret = session.handle_datagram(payload, addr)
+        return None if ret is None else (session, ret)
+
+    def service_timers(self, *, idle: bool = False) -> None:
+        """Do what's due, `idle` is whether nothing came on the last poll"""
+        now = time.monotonic()
+        for session in self.sessions.values():
+            session.service_timers()
+            if idle and not session.us_ok:
+                session.raw_send(session.syn_msg())
+            if session.sent and now - session.last_heard >= self.SILENCE:
+                logger.error(f"<> {session.peer_id} went silent, asking again")
+                session.send_resume()
+                session.rejoining = True
+                self.to_server(peer_req(self.our_id, session.peer_id))
+                session.last_heard = now
+                # maybe new path
+                session.start_probe()
+
+        for peer_id, asked in list(self.pending.items()):
+            if now - asked >= self.JOIN_RESEND:
+                self.join(peer_id)
+        if now >= self.lifetime.due(self.last_server):
+            # one for all the peers, the binding is the same
+            self.to_server(alive_req(self.our_id))
+
+    def poll(
+        self, *, timeout: float = 0.15
+    ) -> Optional[tuple[MuxSession, TickResult]]:
+        """Handle one datagram if it comes in time, then do what's due"""
+        buf = self.pool.take()
+        ret = None
+        if (res := timeout_recv_into(self.s, buf, timeout=timeout)) is not None:
+            nbytes, addr = res
+            view = memoryview(buf)[:nbytes]
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"<- {bytes(view)!r}")
+            ret = self.handle_datagram(view, addr)
+        else:
+            self.pool.give(buf)
+
+        self.service_timers(idle=res is None)
+        return ret
@@ -2,38 +2,235 @@ import itertools
 import logging
 import random
 import select
+import selectors
 import socket
 import sys
+import time
+import zlib
+from collections.abc import Sequence
 from typing import Optional
 
+from . import wire
+from .mmsg import MmsgIO
+from .mmsg import available as mmsg_available
+from .wire import HEADER, Kind, WireError
+
 logger = logging.getLogger(__name__)
 
 Addr = tuple[str, int]
 
+# how much we're ready to receive in one datagram
+BUFF_LEN = 1000
+# how many datagrams to read or write at once
+BATCH = 64
+
+# how long to wait for the server before asking again
+FETCH_TIMEOUT = 2.0
+# ports to try past the last one the peer's NAT was seen on
+PREDICT = 8
+# NATs that count up do it in small steps, a bigger one is somebody else's
+MAX_STEP = 32
+# how long to punch before falling back to the address the server saw
+PUNCH_TIMEOUT = 1.0
+# how often the punches go out meanwhile
+PUNCH_EVERY = 0.1
+
+
+class BufferPool:
+    """Preallocated receive buffers, so receiving doesn't allocate
+
+    Taken buffers should be given back once nobody looks at them anymore.
+    If the pool runs dry, fresh buffers are allocated, but only `count` of
+    them are kept when given back.
+    """
+
+    def __init__(self, count: int, size: int = BUFF_LEN) -> None:
+        self.count = count
+        self.size = size
+        self.free = [bytearray(size) for _ in range(count)]
+
+    def take(self) -> bytearray:
+        if self.free:
+            return self.free.pop()
+        else:
+            # everything is in use, somebody isn't reading
+            return bytearray(self.size)
+
+    def give(self, buf: bytearray) -> None:
+        if len(self.free) < self.count:
+            self.free.append(buf)
+
+    def release(self, view: memoryview) -> None:
+        """Give back the buffer behind the view, if it's one of ours"""
+        if isinstance(view.obj, bytearray) and len(view.obj) == self.size:
+            self.give(view.obj)
+
+
+class BatchIO:
+    """Reads and writes datagrams in bursts instead of one by one
+
+    `recv` takes whatever is queued on the socket, up to `count`
+    datagrams, without blocking, so it's meant to be called once the
+    socket is readable. Received buffers come from `pool`.
+
+    With `mmsg` (on by default where it's available) a burst is one
+    recvmmsg/sendmmsg call, otherwise it's a loop of nonblocking
+    `recvfrom_into` or `sendto`, which still saves a readiness check per
+    datagram.
+    """
+
+    def __init__(
+        self,
+        pool: BufferPool,
+        *,
+        count: int = BATCH,
+        mmsg: Optional[bool] = None,
+    ) -> None:
+        self.pool = pool
+        self.count = count
+        if mmsg is None:
+            mmsg = mmsg_available
+        self.mmsg = MmsgIO(pool, count) if mmsg else None
+
+    def recv(self, s: socket.socket) -> list[tuple[memoryview, Addr]]:
+        if self.mmsg is not None and s.family == socket.AF_INET:
+            return self.mmsg.recv(s)
+
+        batch: list[tuple[memoryview, Addr]] = []
+        while len(batch) < self.count:
+            buf = self.pool.take()
+            try:
+                nbytes, addr = s.recvfrom_into(buf, 0, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                self.pool.give(buf)
+                break
+            batch.append((memoryview(buf)[:nbytes], addr))
+
+        return batch
+
+    def send(self, s: socket.socket, packets: list[tuple[bytes, Addr]]) -> None:
+        if self.mmsg is not None and s.family == socket.AF_INET:
+            self.mmsg.send(s, packets)
+            return
+
+        for data, addr in packets:
+            s.sendto(data, addr)
+
+
+class Waiter:
+    """Waits for the socket to become readable
+
+    The socket is registered with the best selector the platform has
+    (epoll on Linux) once, instead of handing it to `select` on every
+    wait.
+    """
+
+    def __init__(self, s: socket.socket) -> None:
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(s, selectors.EVENT_READ)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return bool(self.selector.select(timeout))
+
+    def close(self) -> None:
+        self.selector.close()
+
+
+def set_rcvbuf(s: socket.socket, size: int) -> int:
+    """Ask for a bigger receive buffer, so bursts aren't dropped
+
+    Returns what we got, the kernel may double it (Linux) or cap it
+    (net.core.rmem_max).
+    """
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+    got = s.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    if got < size:
+        logger.warning(f"<> asked for {size} bytes of SO_RCVBUF, got {got}")
+    return got
+
+
+def wait_readable(s: socket.socket, timeout: Optional[float] = None) -> bool:
+    ok_read, _, _ = select.select([s], [], [], timeout)
+    return bool(ok_read)
+
 
 def timeout_recv(
     s: socket.socket,
     *,
     timeout: Optional[float] = None,
-    buff_len: int = 1000,
+    buff_len: int = BUFF_LEN,
 ) -> Optional[tuple[bytes, Addr]]:
-    ok_read, _, _ = select.select([s], [], [], timeout)
-    if ok_read:
-        s = ok_read[0]
+    # if something is queued already, there's nothing to wait for
+    try:
+        return s.recvfrom(buff_len, socket.MSG_DONTWAIT)
+    except BlockingIOError:
+        pass
+
+    if wait_readable(s, timeout):
         msg, addr = s.recvfrom(buff_len)
         return msg, addr
     else:
         return None
 
 
+def timeout_recv_into(
+    s: socket.socket,
+    buf: bytearray,
+    *,
+    timeout: Optional[float] = None,
+) -> Optional[tuple[int, Addr]]:
+    """Like `timeout_recv`, but fills the buffer instead of allocating"""
+    try:
+        return s.recvfrom_into(buf, 0, socket.MSG_DONTWAIT)
+    except BlockingIOError:
+        pass
+
+    if wait_readable(s, timeout):
+        nbytes, addr = s.recvfrom_into(buf)
+        return nbytes, addr
+    else:
+        return None
+
+
+def ready(s: socket.socket) -> bool:
+    """Check whether there's something to read without blocking"""
+    ok_read, _, _ = select.select([s], [], [], 0)
+    return bool(ok_read)
+
+
+# separate the ids in requests and the fields of replies, so ids can't
+# have them
+ID_SEPARATORS = "@;"
+
+
+def peer_req(our_id: str, peer_id: str) -> bytes:
+    for id_ in (our_id, peer_id):
+        if any(sep in id_ for sep in ID_SEPARATORS):
+            raise ValueError(f"{id_!r} has one of {ID_SEPARATORS!r} in it")
+    return f"JOIN#{our_id}@{peer_id}".encode()
+
+
+def exit_req(our_id: str, peer_id: str) -> bytes:
+    return f"EXIT#{our_id}@{peer_id}".encode()
+
+
+def alive_req(our_id: str) -> bytes:
+    return f"ALIVE#{our_id}".encode()
+
+
+def conn_id(our_id: str, peer_id: str) -> int:
+    """Connection id both peers derive from their ids, without asking"""
+    a, b = sorted((our_id, peer_id))
+    return zlib.crc32(f"{a}@{b}".encode())
+
+
 def make_peer_req(
     s: socket.socket,
     our_id: str,
     peer_id: str,
     remote: Addr,
 ) -> None:
-    req = f"JOIN#{our_id}@{peer_id}"
-    s.sendto(req.encode("utf-8"), remote)
+    s.sendto(peer_req(our_id, peer_id), remote)
 
 
 def parse_addr(addr_string: str) -> Addr:
@@ -44,30 +241,159 @@ def parse_addr(addr_string: str) -> Addr:
 
 
 def parse_server_msg(msg: bytes) -> tuple[Addr, Addr]:
-    our_addr_string, peer_addr_string = msg.decode("utf-8").split(";")
+    our, peer, _ = parse_server_reply(msg)
+
+    return our, peer
+
+
+def parse_server_reply(msg: bytes) -> tuple[Addr, Addr, Optional[str]]:
+    """Our address, peer address and peer id, if the server told it"""
+    our, peer, peer_id, _ = parse_server_history(msg)
+
+    return our, peer, peer_id
+
+
+def parse_server_history(
+    msg: bytes,
+) -> tuple[Addr, Addr, Optional[str], list[int]]:
+    """Same as `parse_server_reply`, plus the ports the peer had before"""
+    match msg.decode("utf-8").split(";"):
+        case [our_addr_string, peer_addr_string]:
+            peer_id = None
+            ports_string = ""
+        case [our_addr_string, peer_addr_string, peer_id]:
+            ports_string = ""
+        case [our_addr_string, peer_addr_string, peer_id, ports_string]:
+            pass
+        case _:
+            raise ValueError(f"unexpected server message: {msg!r}")
     our = parse_addr(our_addr_string)
     peer = parse_addr(peer_addr_string)
+    ports = [int(port) for port in ports_string.split(",") if port]
+
+    return our, peer, peer_id, ports
 
-    return our, peer
+
+def predict_ports(
+    peer: Addr, history: Sequence[int], count: int = PREDICT
+) -> list[Addr]:
+    """Where the peer may be reachable from us, the address the server saw
+    first
+
+    A symmetric NAT maps every destination to a port of its own, so the
+    peer talks to us from a port the server has never seen. Most of them
+    hand out ports in order though, so the ports it had before (for other
+    nodes, or before a rebind) tell the step, and the next `count` ports
+    after the last one are where it'll be once it punches towards us.
+    """
+    host, port = peer
+    ports = sorted({port, *history})
+    steps = [b - a for a, b in itertools.pairwise(ports)]
+    if not steps or min(steps) > MAX_STEP:
+        return [peer]
+
+    step = min(steps)
+    last = ports[-1]
+    predicted = [
+        (host, last + k * step)
+        for k in range(1, count + 1)
+        if last + k * step < 65_536
+    ]
+    return [peer, *predicted]
+
+
+def race(
+    s: socket.socket,
+    conn: int,
+    peer: Addr,
+    history: Sequence[int],
+    remotes: Sequence[Addr],
+    *,
+    predict: int = PREDICT,
+    timeout: float = PUNCH_TIMEOUT,
+) -> Optional[Addr]:
+    """Punch the peer and `predict` ports after it (see `predict_ports`)
+    until it gets through from somewhere
+
+    Returns where the first datagram of the peer came from, it's the port
+    its NAT gave it for us, or None if nothing came in time. Punches are
+    PROBEs, they open our NAT for the peer, and the peer takes them for
+    heartbeats if they come late. Anything else of the peer, like a SYN of
+    a peer that's done already, is left on the socket for the session.
+    """
+    punch = wire.probe(HEADER.size, conn)
+    candidates = predict_ports(peer, history, predict)
+    deadline = time.monotonic() + timeout
+    next_punch = 0.0
+    while (now := time.monotonic()) < deadline:
+        if now >= next_punch:
+            for addr in candidates:
+                s.sendto(punch, addr)
+            next_punch = now + PUNCH_EVERY
+        if not wait_readable(s, min(deadline, next_punch) - now):
+            continue
+
+        msg, addr = s.recvfrom(BUFF_LEN, socket.MSG_PEEK)
+        if addr in remotes:
+            s.recvfrom(BUFF_LEN)
+            # the other nodes answer too, and they may know more by now
+            try:
+                _, peer, _, history = parse_server_history(msg)
+            except ValueError:
+                continue
+            for addr in predict_ports(peer, history, predict):
+                if addr not in candidates:
+                    candidates.append(addr)
+            continue
+
+        try:
+            ours = wire.conn_of(msg) == conn
+        except WireError:
+            ours = False
+        if not ours or msg[0] == Kind.PROBE:
+            s.recvfrom(BUFF_LEN)
+        if ours:
+            # in case our punches haven't made it yet
+            s.sendto(punch, addr)
+            return addr
+
+    return None
 
 
 def first_peer_fetch(
     s: socket.socket,
     our_id: str,
     peer_id: str,
-    remote: Addr,
-) -> tuple[str, int]:
+    remotes: Sequence[Addr],
+    *,
+    punch: bool = True,
+    predict: int = PREDICT,
+) -> tuple[Addr, Addr]:
+    """Ask the servers for the peer, returns it and the server that answered
+
+    Every server is asked at once, and again whenever none answered in
+    time, so any node of a cluster will do. Nodes are different
+    destinations to our NAT, so the server gets to see how it maps them,
+    see `predict_ports`.
+
+    With `punch`, the peer is raced for at the address the server saw and
+    `predict` ports after it, see `race`. Without, or if the peer didn't
+    get through, it's the address the server saw, as before. A NAT that
+    maps every destination to a port of its own won't let us in there.
+    """
     server_msg = None
     for i in itertools.count():
         # declare that we exist
-        make_peer_req(s, our_id, peer_id, remote)
+        for remote in remotes:
+            make_peer_req(s, our_id, peer_id, remote)
         logger.info(f"<> requesting the connection #{i + 1}")
 
         # check the mailbox
-        if (res := timeout_recv(s, timeout=2)) is not None:
+        if (res := timeout_recv(s, timeout=FETCH_TIMEOUT)) is not None:
             msg, sender_addr = res
             # if the message from server, we got it
-            if sender_addr == remote:
+            if sender_addr in remotes:
+                remote = sender_addr
                 server_msg = msg
                 break
 
@@ -75,14 +401,23 @@ def first_peer_fetch(
         raise RuntimeError("couldn't get the server message")
 
     # parse server message
-    our, peer = parse_server_msg(server_msg)
+    our, peer, _, history = parse_server_history(server_msg)
 
     # print response
     logger.info(f"<> server says we are {our[0]}:{our[1]}")
     logger.info(f"<> server says our peer is {peer[0]}:{peer[1]}")
 
+    if punch:
+        conn = conn_id(our_id, peer_id)
+        punched = race(s, conn, peer, history, remotes, predict=predict)
+        if punched is None:
+            logger.warning("<> no punch got through, trusting the server")
+        else:
+            peer = punched
+            logger.info(f"<> peer got through from {peer[0]}:{peer[1]}")
+
     # finally return response
-    return peer
+    return peer, remote
 
 
 def disconnect(
@@ -91,12 +426,13 @@ def disconnect(
     peer_id: str,
     remote: Addr,
 ) -> None:
-    req = f"EXIT#{our_id}@{peer_id}"
-    s.sendto(req.encode("utf-8"), remote)
+    s.sendto(exit_req(our_id, peer_id), remote)
     logger.info("<> requested exit")
 
 
-def prepare_socket(port: Optional[int] = None) -> socket.socket:
+def prepare_socket(
+    port: Optional[int] = None, *, rcvbuf: Optional[int] = None
+) -> socket.socket:
     if port is None:
         try:
             port = int(sys.argv[1])
@@ -121,19 +457,48 @@ def prepare_socket(port: Optional[int] = None) -> socket.socket:
                 port += 1
             else:
                 raise e
+    if rcvbuf is not None:
+        set_rcvbuf(s, rcvbuf)
     return s
 
 
-def try_to_reconnect(
-    s: socket.socket, our_id: str, peer_id: str, remote: Addr
-) -> socket.socket:
-    # because both peers probably will try to reconnect
-    # add some randomness to the process
-    #
-    # hint: the lower is the cap, the higher is the chance
-    if random.random() >= 0.60:
-        _, port = s.getsockname()
-        s = prepare_socket(port + 1)
-    # send peer request anyway though
-    make_peer_req(s, our_id, peer_id, remote)
-    return s
+class Backoff:
+    """Jittered exponential backoff between reconnect attempts
+
+    The wait after attempt `n` is between half and all of `base * 2**n`,
+    but no more than `cap`, so peers that lost each other at the same
+    moment don't keep asking in lockstep. `expired` says whether it's been
+    `give_up` seconds since the first attempt.
+    """
+
+    def __init__(
+        self, *, base: float = 0.1, cap: float = 5.0, give_up: float = 60.0
+    ) -> None:
+        self.base = base
+        self.cap = cap
+        self.give_up = give_up
+
+        self.attempts = 0
+        self.started: Optional[float] = None
+        self.next_at = 0.0
+
+    def due(self, now: float) -> bool:
+        return now >= self.next_at
+
+    def expired(self, now: float) -> bool:
+        return self.started is not None and now - self.started > self.give_up
+
+    def attempt(self, now: float) -> None:
+        """Count the attempt made now and schedule the next one"""
+        if self.started is None:
+            self.started = now
+        # past that it would be over any sane cap anyway
+        growth = 2 ** min(self.attempts, 32)
+        half = min(self.cap, self.base * growth) / 2
+        self.next_at = now + half + random.uniform(0, half)
+        self.attempts += 1
+
+    def reset(self) -> None:
+        self.attempts = 0
+        self.started = None
+        self.next_at = 0.0
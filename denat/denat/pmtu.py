@@ -0,0 +1,121 @@
+"""Path MTU discovery for ReUDP
+
+Peers send padded PROBE datagrams to each other and echo the size of the
+ones that made it. Binary search between a size known to work and the
+biggest one we'd want finds the largest datagram the path can carry.
+
+On Linux probes go out with the Don't Fragment bit, so a probe that's
+bigger than what the kernel already knows about the path fails right away
+instead of timing out.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import errno
+import socket
+import sys
+from asyncio.trsock import TransportSocket
+from collections.abc import Iterator
+from typing import Optional
+
+from .net import Addr
+
+# 1500 byte ethernet frame minus IPv4 and UDP headers
+MAX_MTU = 1472
+
+IP_MTU_DISCOVER: Optional[int] = None
+IP_PMTUDISC_DO: Optional[int] = None
+if sys.platform == "linux":
+    # socket module doesn't always export these, values from <linux/in.h>
+    IP_MTU_DISCOVER = getattr(socket, "IP_MTU_DISCOVER", 10)
+    IP_PMTUDISC_DO = getattr(socket, "IP_PMTUDISC_DO", 2)
+
+
+@contextlib.contextmanager
+def dont_fragment(s: socket.socket | TransportSocket) -> Iterator[None]:
+    """Set the Don't Fragment bit for what's sent inside, where we know how"""
+    if IP_MTU_DISCOVER is None or IP_PMTUDISC_DO is None:
+        yield
+        return
+
+    old = s.getsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER)
+    s.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+    try:
+        yield
+    finally:
+        # everything else may be fragmented as usual
+        s.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, old)
+
+
+def send_df(s: socket.socket, data: bytes, addr: Addr) -> bool:
+    """Send with the Don't Fragment bit set
+
+    Returns False if the kernel refused because it's too big for the path.
+    """
+    with dont_fragment(s):
+        return try_send(s, data, addr)
+
+
+def try_send(s: socket.socket, data: bytes, addr: Addr) -> bool:
+    try:
+        s.sendto(data, addr)
+    except OSError as e:
+        if e.errno == errno.EMSGSIZE:
+            return False
+        raise e
+
+    return True
+
+
+class MtuProber:
+    """Binary search for the biggest datagram that reaches the peer
+
+    `low` always works, nothing above `high` is needed. Each size is tried
+    `ATTEMPTS` times before it's considered too big, because a probe may
+    be lost for reasons that have nothing to do with its size.
+    """
+
+    ATTEMPTS = 3
+
+    def __init__(self, low: int, high: int, *, step: int = 16) -> None:
+        self.low = low
+        self.high = high
+        self.step = step
+
+        # probe in flight
+        self.size: Optional[int] = None
+        self.attempts = 0
+        self.sent_at = 0.0
+
+    @property
+    def done(self) -> bool:
+        return self.high - self.low < self.step
+
+    def poll(self, now: float, timeout: float) -> Optional[int]:
+        """Size of the probe to send now, if any"""
+        if self.size is not None:
+            if now - self.sent_at < timeout:
+                return None
+            self.attempts += 1
+            if self.attempts >= self.ATTEMPTS:
+                self.too_big(self.size)
+
+        if self.done:
+            return None
+
+        if self.size is None:
+            self.size = (self.low + self.high + 1) // 2
+            self.attempts = 0
+        self.sent_at = now
+        return self.size
+
+    def fits(self, size: int) -> None:
+        self.low = max(self.low, size)
+        if self.size is not None and self.size <= size:
+            self.size = None
+
+    def too_big(self, size: int) -> None:
+        self.high = min(self.high, size - 1)
+        if self.size is not None and self.size >= size:
+            self.size = None
@@ -0,0 +1,181 @@
+"""Relaying datagrams between the two sides of a mapping entry
+
+When the peers can't reach each other directly, they send their packets
+to the server instead and the server passes each one on to the other
+address of the entry, the way TURN does. Nothing past the connection id
+in the header is looked at (see `wire.conn_of`), it tells the entries of
+the address apart (see `net.conn_id`), and the packet goes out of the
+very buffer it was received into, nothing is copied.
+
+Relaying costs the server the bandwidth of both peers, so each pair may
+send `rate` bytes per second, with bursts of up to `burst` bytes (a token
+bucket), the rest is dropped. What got through and what didn't is
+counted per pair, and logged once the pair is gone.
+
+Relayed traffic keeps the entry fresh, the same as ALIVE does.
+"""
+
+from __future__ import annotations
+
+import logging
+from collections.abc import Callable
+from typing import TYPE_CHECKING, Optional
+
+from . import wire
+from .net import Addr, conn_id
+
+if TYPE_CHECKING:
+    from .server import Entry, Mapping, Sender
+
+logger = logging.getLogger(__name__)
+
+# bytes per second each pair gets, by default
+RATE = 1024 * 1024
+# how often pairs are checked, there's no need to look every datagram
+EXPIRE_EVERY = 1.0
+# biggest datagram relayed, path mtu probes go up to `pmtu.MAX_MTU`
+MAX_DATAGRAM = 2048
+
+
+class Pair:
+    """Relayed traffic of one entry, both ways"""
+
+    __slots__ = (
+        "key",
+        "entry",
+        "allowance",
+        "refilled",
+        "last_used",
+        "datagrams",
+        "bytes",
+        "dropped",
+    )
+
+    def __init__(
+        self, key: tuple[str, str], entry: Entry, now: float, burst: float
+    ) -> None:
+        self.key = key
+        self.entry = entry
+        # token bucket, in bytes, full to begin with
+        self.allowance = burst
+        self.refilled = now
+        self.last_used = now
+
+        self.datagrams = 0
+        self.bytes = 0
+        self.dropped = 0
+
+    def allow(self, size: int, now: float, rate: float, burst: float) -> bool:
+        """Take `size` bytes out of the bucket, False if they aren't there"""
+        self.allowance = min(
+            burst, self.allowance + (now - self.refilled) * rate
+        )
+        self.refilled = now
+        if self.allowance < size:
+            return False
+        self.allowance -= size
+        return True
+
+
+class Relay:
+    """Relays for the entries of `mapping`, `rate` bytes per second each"""
+
+    def __init__(
+        self,
+        mapping: Mapping,
+        *,
+        rate: float = RATE,
+        burst: Optional[float] = None,
+        clock: Optional[Callable[[], float]] = None,
+    ) -> None:
+        self.mapping = mapping
+        self.rate = rate
+        # a quarter of a second of it by default, but a whole datagram
+        if burst is None:
+            burst = max(rate / 4, MAX_DATAGRAM)
+        self.burst = burst
+        self.clock = clock if clock is not None else mapping.clock
+
+        self.pairs: dict[tuple[str, str], Pair] = {}
+        # the pair by the sender address and the connection id
+        self.routes: dict[tuple[Addr, int], Pair] = {}
+        # datagrams of nobody we know
+        self.unknown = 0
+        self.expired_at = self.clock()
+
+    def route(self, addr: Addr, conn: int) -> Optional[Pair]:
+        if (pair := self.routes.get((addr, conn))) is not None:
+            return pair
+
+        for entry in self.mapping.entries_of(addr):
+            key = entry.key()
+            if conn_id(*key) != conn:
+                continue
+            if (pair := self.pairs.get(key)) is None or pair.entry is not entry:
+                pair = Pair(key, entry, self.clock(), self.burst)
+                self.pairs[key] = pair
+            self.routes[addr, conn] = pair
+            return pair
+        return None
+
+    def forward(
+        self, s: Sender, payload: bytes | memoryview, addr: Addr
+    ) -> bool:
+        """Pass the packet to the other side, False if it's dropped"""
+        if len(payload) > MAX_DATAGRAM:
+            self.unknown += 1
+            return False
+        try:
+            conn = wire.conn_of(payload)
+        except wire.WireError:
+            self.unknown += 1
+            return False
+        if (pair := self.route(addr, conn)) is None:
+            self.unknown += 1
+            return False
+        if (other := pair.entry.other_addr(addr)) is None:
+            # moved on, or the other side isn't there (anymore)
+            pair.dropped += 1
+            return False
+
+        now = self.clock()
+        if not pair.allow(len(payload), now, self.rate, self.burst):
+            pair.dropped += 1
+            return False
+        s.sendto(payload, other)
+        pair.datagrams += 1
+        pair.bytes += len(payload)
+        pair.last_used = now
+        return True
+
+    def expire(self) -> int:
+        """Forget pairs whose entries are gone, returns how many
+
+        Entries of the rest are refreshed if they relayed something since
+        they were last seen. Does nothing until `EXPIRE_EVERY` passes.
+        """
+        now = self.clock()
+        if now - self.expired_at < EXPIRE_EVERY:
+            return 0
+        self.expired_at = now
+
+        gone = []
+        for key, pair in self.pairs.items():
+            if self.mapping.find_entry(key) is not pair.entry:
+                gone.append(key)
+            elif pair.last_used > pair.entry.last_seen:
+                self.mapping.touch_entry(key)
+
+        for key in gone:
+            pair = self.pairs.pop(key)
+            logger.info(
+                f"<> relayed {pair.bytes} bytes in {pair.datagrams} datagrams"
+                f" for {key[0]}@{key[1]}, dropped {pair.dropped}"
+            )
+        if gone:
+            self.routes = {
+                route: pair
+                for route, pair in self.routes.items()
+                if self.pairs.get(pair.key) is pair
+            }
+        return len(gone)
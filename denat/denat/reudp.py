@@ -1,97 +1,97 @@
 from __future__ import annotations
 
-import enum
-import itertools
+import contextlib
 import logging
-import random
 import socket
 import time
-from typing import Literal, Optional, Self
+from collections.abc import Iterator, Sequence
+from typing import Any, Optional, Self
 
 from .net import (
+    BATCH,
     Addr,
+    Backoff,
+    BatchIO,
+    BufferPool,
+    Waiter,
+    alive_req,
+    conn_id,
     disconnect,
     first_peer_fetch,
-    parse_server_msg,
-    timeout_recv,
-    try_to_reconnect,
+    make_peer_req,
+    set_rcvbuf,
 )
-from .stats import Stats
-from .t import assert_never_seq, unreachable
+from .pmtu import send_df
+from .session import BytesLike, Session, TickResult
 
 logger = logging.getLogger(__name__)
 
 
-class TickResult(enum.Enum):
-    # handshake
-    GotInitAck = enum.auto()
-    GotInitSyn = enum.auto()
-    # messages
-    GotMsg = enum.auto()
-    GotAck = enum.auto()
-    # meta
-    DupOrEarly = enum.auto()
-    Timeout = enum.auto()
-
-
-HandleResult = Literal[
-    TickResult.GotInitSyn,
-    TickResult.GotInitAck,
-    TickResult.GotMsg,
-    TickResult.GotAck,
-    TickResult.DupOrEarly,
-]
-
-
-def register(stats: Stats, res: HandleResult) -> None:
-    match res:
-        case TickResult.GotInitSyn | TickResult.GotInitAck:
-            stats.meta()
-        case TickResult.GotMsg | TickResult.GotAck:
-            stats.got()
-        case TickResult.DupOrEarly:
-            stats.other()
-
-
-class ReUDP:
+class ReUDP(Session):
     """Re_liable_UDP object to use with deNAT
 
     Guarantees:
         - All messages will be delivered.
         - Message should arrive in order.
+
+    Blocking flavour, owns its socket and polls it in `tick`, so
+    heartbeats only go out while someone is blocked on it. See README.md
+    for the protocol, batching, reconnects and relaying.
+
+    Use `send_bytes`, `get_bytes` and `recv_into` to skip the text
+    conversion.
     """
 
+    SILENCE = 1.5
+
     def __init__(
         self,
         s: socket.socket,
         our_id: str,
         peer_id: str,
         remote: Addr,
+        *,
+        servers: Sequence[Addr] = (),
+        punch: bool = True,
+        backoff: Optional[Backoff] = None,
+        batch: int = BATCH,
+        mmsg: Optional[bool] = None,
+        rcvbuf: Optional[int] = None,
+        **kwargs: Any,
     ) -> None:
         # init data
-        self.remote = remote
         self.our_id = our_id
         self.peer_id = peer_id
 
-        # consts
-        self.init_x = random.randint(0, 100)
-
         # switches
         self.s = s
-        self.peer = self.first_peer_fetch()
-        self.us_ok = False
+        self.servers = [remote, *servers]
+        self.punching = punch
         self.end = False
+        if rcvbuf is not None:
+            set_rcvbuf(s, rcvbuf)
+        self.waiter = Waiter(s)
 
         # state
-        self.reconnects = 0
-        self.stats = Stats()
-
-        self.last_received_id = -1
-        self.received: dict[int, str] = {}
-        self.read_queue: list[tuple[str, Addr]] = []
-
-        self.last_sent_id = itertools.count()
-        self.sent: dict[int, tuple[str, float, bool]] = {}
+        self.backoff = backoff if backoff is not None else Backoff()
+        # packets held back until the end of the burst
+        self.outbox: Optional[list[tuple[bytes, Addr]]] = None
+        # in the middle of the burst, more datagrams are coming for sure
+        self.draining = False
+
+        peer, remote = self.first_peer_fetch()
+        super().__init__(
+            peer,
+            remote,
+            conn=conn_id(our_id, peer_id),
+            **kwargs,
+        )
+        # early and read_queue may hold up to a window each, and io keeps
+        # a buffer for every datagram of the burst
+        self.pool = BufferPool(2 * self.window + batch, self.max_mtu)
+        self.io = BatchIO(self.pool, count=batch, mmsg=mmsg)
+        # or since we started waiting for it
+        self.last_heard = time.monotonic()
 
         # start a handshake
         init_syn = self.syn_msg()
@@ -104,7 +104,8 @@ class ReUDP:
         self.end = True
         # exit from the remote server mapping
         # NOTE: using UDP, packet may or may not be delivered
-        disconnect(self.s, self.our_id, self.peer_id, self.remote)
+        if self.remote is not None:
+            disconnect(self.s, self.our_id, self.peer_id, self.remote)
 
         # try to ensure that all the messages are sent at the end
         # won't work if our peer is disconnected first, of course
@@ -113,172 +114,146 @@ class ReUDP:
             if self.try_resend_lost(timeout=0.05) == 0:
                 break
 
+        self.waiter.close()
+
         # print stats, because why not :3
         self.stats.print_results()
 
-    def first_peer_fetch(self) -> Addr:
+    def first_peer_fetch(self) -> tuple[Addr, Addr]:
         return first_peer_fetch(
             self.s,
             self.our_id,
             self.peer_id,
-            self.remote,
+            self.servers,
+            punch=self.punching,
         )
 
     def try_to_reconnect(self) -> None:
+        """Look for the peer, without giving up on the session
+
+        If it's our NAT that moved us, RESUME from the new address is
+        enough, if it's the peer who moved, the server tells us where to.
+        Either way whatever is in flight goes out again as soon as we know.
+        """
         if self.end:
             return
 
-        self.reconnects += 1
-        if self.reconnects > 5:
+        now = time.monotonic()
+        if self.backoff.expired(now):
             raise RuntimeError("i'm tired")
+        self.backoff.attempt(now)
 
-        logger.error("<> connection has failed, trying to reconnect")
-        self.s = try_to_reconnect(
-            self.s,
-            self.our_id,
-            self.peer_id,
-            self.remote,
+        logger.error(
+            f"<> connection has failed, reconnecting #{self.backoff.attempts}"
         )
+        assert self.backoff.started is not None
+        if (
+            self.relay_after is not None
+            and now - self.backoff.started >= self.relay_after
+        ):
+            self.start_relay()
+        assert self.remote is not None
+        if len(self.servers) > 1 and not self.relayed:
+            # the server may be what's gone, ask the next one this time
+            i = self.servers.index(self.remote)
+            self.remote = self.servers[(i + 1) % len(self.servers)]
+        self.send_resume()
+        self.rejoining = True
+        make_peer_req(self.s, self.our_id, self.peer_id, self.remote)
+
+    @contextlib.contextmanager
+    def batch(self) -> Iterator[None]:
+        """Hold back everything sent inside and send it in one burst"""
+        if self.outbox is not None:
+            # already batching, the outer one will flush
+            yield
+            return
 
-    def raw_send(self, msg: bytes) -> None:
-        logger.debug(f"-> {msg!r}")
-        self.s.sendto(msg, self.peer)
+        self.outbox = []
+        try:
+            yield
+        finally:
+            outbox, self.outbox = self.outbox, None
+            if outbox:
+                self.io.send(self.s, outbox)
 
-    def raw_get(self, *, timeout: float = 0.15) -> Optional[tuple[bytes, Addr]]:
-        if (res := timeout_recv(self.s, timeout=timeout)) is not None:
-            data, addr = res
-            logger.debug(f"<- {data!r}")
-            return res
+    def raw_send(self, msg: bytes) -> None:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"-> {msg!r}")
+        self.last_sent = time.monotonic()
+        if self.outbox is not None:
+            self.outbox.append((msg, self.peer))
         else:
-            return None
-
-    def syn_msg(self) -> bytes:
-        return f"init_syn:{self.init_x}".encode()
-
-    @staticmethod
-    def init_ack_msg(init_y: int) -> bytes:
-        return f"init_ack:{init_y}".encode()
-
-    @staticmethod
-    def packed_msg(i: int, msg: str) -> bytes:
-        return f"msg:{i}:{msg}".encode()
-
-    @staticmethod
-    def ack_msg(i: int) -> bytes:
-        return f"ack:{i}".encode()
-
-    def try_resend_lost(self, *, timeout=0.1) -> int:
-        to_resend = []
-        for i, (_, time_sent, is_done) in self.sent.items():
-            if is_done:
-                continue
-            if time.monotonic() - time_sent < timeout:
-                continue
-            to_resend.append(i)
-
-        for i in to_resend:
-            msg, _, _ = self.sent[i]
-            self.raw_send(self.packed_msg(i, msg))
-            self.sent[i] = msg, time.monotonic(), False
-
-        return len(to_resend)
-
-    def handle_remote(self, payload: bytes) -> None:
-        _, peer = parse_server_msg(payload)
-        logger.debug(f"new peer: {peer}")
-        self.peer = peer
-
-    def handle_peer(self, payload: bytes) -> HandleResult:
-        data = payload.decode("utf-8").split(":")
-        match data:
-            case ["init_ack", x_str] if int(x_str) == self.init_x:
-                self.us_ok = True
-
-                return TickResult.GotInitAck
-            case ["init_syn", y_str]:
-                init_ack = self.init_ack_msg(int(y_str))
-                self.raw_send(init_ack)
-
-                return TickResult.GotInitSyn
-            case ["msg", msg_id_str, msg]:
-                msg_id = int(msg_id_str)
-
-                expected_id = self.last_received_id + 1
-                if msg_id > expected_id:
-                    # no ack for you sommry, you're too early
-                    #
-                    # realistically speaking, we could have a queue for early
-                    # birds, so that you don't need to resend the message, but
-                    # idk, let's see how it will work without it
-                    return TickResult.DupOrEarly
-
-                # otherwise, acknowledge
-                ack = self.ack_msg(msg_id)
-                self.raw_send(ack)
-
-                # oh, you've arrived, we expected you
-                if msg_id not in self.received:
-                    self.received[msg_id] = msg
-                    self.last_received_id = msg_id
-
-                    # should we store addr in read_queue? probably not
-                    # but hell, I don't want to think about it right now
-                    self.read_queue.append((msg, self.peer))
-                    return TickResult.GotMsg
-                else:
-                    return TickResult.DupOrEarly
-            case ["ack", msg_id_str]:
-                msg_id = int(msg_id_str)
-                match self.sent.get(msg_id, None):
-                    case None:
-                        # sending ack to the message we haven't sent is the
-                        # error on the other side
-                        #
-                        # i'll leave a breakpoint just in case, but if it was
-                        # a "real" program, we'd probably ignore it, because
-                        # that's not our responsibility
-                        breakpoint()
-                        unreachable()
-                    case sent_msg, sent_time, acked:
-                        if not acked:
-                            self.sent[msg_id] = sent_msg, sent_time, True
-
-                            return TickResult.GotAck
-                        else:
-                            return TickResult.DupOrEarly
-                    case rest:
-                        breakpoint()
-                        assert_never_seq(rest)
-            case _:
-                breakpoint()
-                raise RuntimeError(f"unexpected message: {payload!r}")
+            self.s.sendto(msg, self.peer)
+
+    def raw_get(
+        self, *, timeout: float = 0.15
+    ) -> list[tuple[memoryview, Addr]]:
+        """Receive a burst of datagrams into buffers from the pool
+
+        Only waits if there's nothing queued already. It's up to the caller
+        to release the views back to the pool.
+        """
+        batch = self.io.recv(self.s)
+        if not batch and self.waiter.wait(timeout):
+            batch = self.io.recv(self.s)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            for view, _ in batch:
+                logger.debug(f"<- {bytes(view)!r}")
+        return batch
+
+    def send_probe(self, probe: bytes) -> bool:
+        return send_df(self.s, probe, self.peer)
+
+    def quiet(self) -> bool:
+        return not self.draining and not self.waiter.wait(0)
+
+    def send_alive(self) -> None:
+        assert self.remote is not None
+        self.s.sendto(alive_req(self.our_id), self.remote)
+
+    def binding_lost(self) -> None:
+        # the answer comes to handle_remote, which updates the peer
+        assert self.remote is not None
+        self.send_resume()
+        self.rejoining = True
+        make_peer_req(self.s, self.our_id, self.peer_id, self.remote)
 
     def handle_messages(self, *, timeout: float = 0.15) -> Optional[TickResult]:
-        if (res := self.raw_get(timeout=timeout)) is not None:
-            payload, addr = res
-            if addr == self.remote:
-                self.handle_remote(payload)
-                self.stats.remote()
-                return None
-            elif addr == self.peer:
-                ret = self.handle_peer(payload)
-                register(self.stats, ret)
-
-                match ret:
-                    case TickResult.GotAck | TickResult.GotMsg:
-                        return ret
-                    case (
-                        TickResult.GotInitSyn
-                        | TickResult.GotInitAck
-                        | TickResult.DupOrEarly
-                    ):
-                        return None
-                    case rest:
-                        assert_never_seq(rest)
-            else:
-                logger.error(f"unknown {addr}: {payload!r}")
-                self.stats.other()
-                return None
+        """Handle everything that came, returns the last useful result
+
+        Once something arrives, keeps reading bursts until the socket is
+        empty.
+        """
+        if batch := self.raw_get(timeout=timeout):
+            ret = None
+            heard = False
+            with self.batch():
+                self.draining = True
+                try:
+                    while batch:
+                        for payload, addr in batch:
+                            # before, the buffer goes back to the pool
+                            ours = self.is_ours(payload)
+                            res = self.handle_datagram(payload, addr)
+                            if res is not None:
+                                ret = res
+                            # after, the peer may have just moved here,
+                            # and while relayed the server is the peer
+                            heard = heard or (ours and addr == self.peer)
+                        if len(batch) < self.io.count:
+                            # fell short, so the socket is empty
+                            break
+                        batch = self.raw_get(timeout=0)
+                finally:
+                    self.draining = False
+                # acks held back while the burst was being handled
+                self.flush_ack()
+            if heard:
+                self.last_heard = time.monotonic()
+                self.backoff.reset()
+            return ret
         else:
             # NOTE: there's a high chance that this won't fire if
             # we didn't receive any "init_ack", because the packet got lost,
@@ -302,37 +277,68 @@ class ReUDP:
 
     def tick(self, *, attempts: int = 10) -> TickResult:
         for _ in range(attempts):
-            ret = self.handle_messages()
-            self.try_resend_lost()
+            with self.batch():
+                ret = self.handle_messages()
+                self.service_timers()
+                self.check_silence()
             if ret is not None:
                 return ret
         else:
-            self.try_to_reconnect()
-
             return TickResult.Timeout
 
-    def get(self) -> Optional[tuple[str, Addr]]:
-        if self.read_queue:
-            return self.read_queue.pop(0)
-        else:
-            return None
+    def check_silence(self) -> None:
+        """Reconnect if the peer has been silent for too long"""
+        if not self.stalled():
+            return
+        now = time.monotonic()
+        if now - self.last_heard >= self.SILENCE and self.backoff.due(now):
+            self.try_to_reconnect()
+
+    def wait(self) -> None:
+        """Block until there's something in read_queue"""
+        # poll until receive the message
+        #
+        # GotMsg alone isn't enough, it might've been just a fragment
+        while not self.read_queue:
+            self.tick()
 
     def get_blocking(self) -> tuple[str, Addr]:
-        if self.read_queue:
-            return self.read_queue.pop(0)
+        self.wait()
+
+        res = self.get()
+        if res is None:
+            breakpoint()
+            raise RuntimeError("got none")
         else:
-            # poll until receive the message
-            while self.tick() != TickResult.GotMsg:
-                pass
-            res = self.get()
-            if res is None:
-                breakpoint()
-                raise RuntimeError("got none")
-            else:
-                return res
+            return res
 
-    def send(self, msg: str) -> None:
-        i = next(self.last_sent_id)
+    def recv_into(self, buf: bytearray | memoryview) -> tuple[int, Addr]:
+        """Block until the next message and copy it into `buf`
 
-        self.raw_send(self.packed_msg(i, msg))
-        self.sent[i] = msg, time.monotonic(), False
+        Raises ValueError if the message doesn't fit, leaving it in place.
+        """
+        self.wait()
+
+        view, addr = self.read_queue[0]
+        nbytes = len(view)
+        if nbytes > len(buf):
+            raise ValueError(f"message is {nbytes} bytes, buffer is {len(buf)}")
+
+        self.read_queue.popleft()
+        buf[:nbytes] = view
+        self.pool.release(view)
+        return nbytes, addr
+
+    def send(self, msg: str) -> None:
+        self.send_bytes(msg.encode("utf-8"))
+
+    def service_timers(self) -> int:
+        with self.batch():
+            return super().service_timers()
+
+    def send_bytes(self, msg: BytesLike) -> None:
+        if not self.sent:
+            # silence counts from now on, not from the last time we talked
+            self.last_heard = time.monotonic()
+        with self.batch():
+            self.push_bytes(msg)
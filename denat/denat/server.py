@@ -1,12 +1,51 @@
+import argparse
+import asyncio
+import collections
+import logging
+import multiprocessing
 import select
+import signal
 import socket
 import sys
-from datetime import datetime
-from typing import Never, Optional
+import time
+import zlib
+from collections.abc import Callable
+from typing import Any, Never, Optional, Protocol
+
+from . import cluster, journal, log, wire
+from .relay import MAX_DATAGRAM as RELAY_DATAGRAM
+from .relay import RATE as RELAY_RATE
+from .relay import Relay
+
+logger = logging.getLogger(__name__)
 
 # pair of addresses
 Addr = tuple[str, int]
 
+# JOIN#<id>@<id> and friends fit, anything bigger isn't ours
+MAX_DATAGRAM = 100
+# earlier ports of each side told to the other one, see `Entry.replies`
+HISTORY = 3
+
+
+class Sender(Protocol):
+    """Socket or datagram transport, whatever can reply"""
+
+    def sendto(self, data: bytes | memoryview, addr: Addr, /) -> Any: ...
+
+
+class CachedClock:
+    """Monotonic time, read once per loop iteration instead of per packet"""
+
+    def __init__(self) -> None:
+        self.now = time.monotonic()
+
+    def tick(self) -> None:
+        self.now = time.monotonic()
+
+    def __call__(self) -> float:
+        return self.now
+
 
 class Entry:
     """Class representing mapping entry
@@ -14,13 +53,23 @@ class Entry:
     Conceptually maps a pair of ids to a pair of addresses.
     """
 
+    # there may be a lot of them, no need for a dict each
+    __slots__ = ("_a", "_b", "last_seen", "_ports", "_replies")
+
     def __init__(
         self,
         ids: tuple[str, str],
         addrs: tuple[Optional[Addr], Optional[Addr]],
+        last_seen: float = 0.0,
     ) -> None:
         self._a = (ids[0], addrs[0])
         self._b = (ids[1], addrs[1])
+        # when either side said something last
+        self.last_seen = last_seen
+        # ports each side had before on the same host, the latest last
+        self._ports: tuple[tuple[int, ...], tuple[int, ...]] = ((), ())
+        # see `replies`
+        self._replies: Optional[tuple[tuple[bytes, Addr], ...]] = None
 
     def _is_direct(self, ids: tuple[str, str]) -> bool:
         id1, id2 = ids
@@ -32,6 +81,19 @@ class Entry:
 
         return self._a[0] == id2 and self._b[0] == id1
 
+    def key(self) -> tuple[str, str]:
+        """Ids of both sides, the way `Mapping` keys the entry"""
+        return canonical((self._a[0], self._b[0]))
+
+    def other_addr(self, addr: Addr) -> Optional[Addr]:
+        """Addr of the other side, None if `addr` isn't one of them"""
+        if self._a[1] == addr:
+            return self._b[1]
+        elif self._b[1] == addr:
+            return self._a[1]
+        else:
+            return None
+
     def corresponds(self, ids: tuple[str, str]) -> bool:
         """Check whether the entry corresponds to id pair"""
 
@@ -48,13 +110,27 @@ class Entry:
 
     def set_addr_of(self, ident: str, addr: Optional[Addr]) -> None:
         """Set the addr for identifier"""
+        self._replies = None
         if self._a[0] == ident:
+            self._moved(0, self._a[1], addr)
             self._a = (self._a[0], addr)
         elif self._b[0] == ident:
+            self._moved(1, self._b[1], addr)
             self._b = (self._b[0], addr)
         else:
             raise AttributeError
 
+    def _moved(
+        self, side: int, old: Optional[Addr], new: Optional[Addr]
+    ) -> None:
+        if old is None or new is None or old == new:
+            # EXIT, or the first JOIN after it, says nothing about the NAT
+            return
+        a, b = self._ports
+        ports = (a, b)[side] if old[0] == new[0] else ()
+        ports = (*ports, old[1])[-HISTORY:]
+        self._ports = (ports, b) if side == 0 else (a, ports)
+
     def get_full_pair(
         self,
         ids: tuple[str, str],
@@ -68,121 +144,694 @@ class Entry:
 
         return first, second
 
+    def replies(self) -> Optional[tuple[tuple[bytes, Addr], ...]]:
+        """Reply and address for each side, None until both are there
+
+        Built once and kept until an address changes, clients ask again
+        and again when they reconnect. Each side also gets the ports the
+        other one had before, so it can guess where a NAT that maps every
+        destination to a new port puts it next, see
+        `net.predict_ports`.
+        """
+        if self._replies is None:
+            (id_a, addr_a), (id_b, addr_b) = self._a, self._b
+            if addr_a is None or addr_b is None:
+                return None
+            ports_a, ports_b = self._ports
+            self._replies = (
+                (encode_reply(addr_a, addr_b, id_b, ports_b), addr_a),
+                (encode_reply(addr_b, addr_a, id_a, ports_a), addr_b),
+            )
+        return self._replies
+
+
+def canonical(ids: tuple[str, str]) -> tuple[str, str]:
+    """Same key for the pair no matter who asks"""
+    id1, id2 = ids
+    return (id1, id2) if id1 <= id2 else (id2, id1)
+
 
 class Mapping:
-    def __init__(self) -> None:
-        self.mapping: list[Entry] = []
+    """Entries by their id pair, plus where each address is registered
+
+    Everything is a dict lookup, so JOIN and EXIT cost the same no matter
+    how many pairs are registered.
+
+    EXIT may never come, so entries nobody has JOINed (or sent ALIVE) for
+    `ttl` seconds are dropped by `expire`. Entries are kept in the order
+    they were last seen, so the expired ones are always at the front.
+    On top of that there are at most `max_entries` of them, the least
+    recently seen one goes when a new one doesn't fit, and one address
+    can't hold more than `max_per_addr`, so a flood of made up ids from
+    one place can't push everyone else out.
+
+    With a `journal` every change is logged, and `checkpoint` writes it
+    out, so that `restore` can bring the entries back after a restart.
+    """
+
+    # compact the journal once it has this many more records than entries
+    COMPACT_SLACK = 10_000
+
+    def __init__(
+        self,
+        *,
+        ttl: float = 120.0,
+        max_entries: int = 100_000,
+        max_per_addr: int = 64,
+        clock: Callable[[], float] = time.monotonic,
+        journal: Optional[journal.Journal] = None,
+    ) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_per_addr = max_per_addr
+        self.clock = clock
+        self.journal = journal
+
+        # least recently seen first
+        self.mapping: collections.OrderedDict[tuple[str, str], Entry] = (
+            collections.OrderedDict()
+        )
+        # keys of the entries where the address is registered
+        self.by_addr: dict[Addr, set[tuple[str, str]]] = {}
+
+    def __len__(self) -> int:
+        return len(self.mapping)
+
+    def _index(self, addr: Optional[Addr], key: tuple[str, str]) -> None:
+        if addr is not None:
+            self.by_addr.setdefault(addr, set()).add(key)
+
+    def _unindex(self, addr: Optional[Addr], key: tuple[str, str]) -> None:
+        if addr is None or (keys := self.by_addr.get(addr)) is None:
+            return
+        keys.discard(key)
+        if not keys:
+            del self.by_addr[addr]
+
+    def _drop(self, key: tuple[str, str]) -> None:
+        entry = self.mapping.pop(key)
+        self._unindex(entry._a[1], key)
+        self._unindex(entry._b[1], key)
+        if self.journal is not None:
+            self.journal.delete(entry._a, entry._b)
+
+    def _changed(self, entry: Entry) -> None:
+        if self.journal is not None:
+            self.journal.put(entry._a, entry._b)
+
+    def _touch(self, key: tuple[str, str], entry: Entry) -> None:
+        entry.last_seen = self.clock()
+        self.mapping.move_to_end(key)
 
     def register(
         self,
         ids: tuple[str, str],
         our_addr: Addr,
-    ) -> Entry:
-        entry = self.find_entry(ids)
+    ) -> Optional[Entry]:
+        """Add or refresh the entry, None if the address has too many"""
+        key = canonical(ids)
+        entry = self.mapping.get(key)
         if entry is None:
-            entry = Entry(ids, (our_addr, None))
-            self.mapping.append(entry)
+            if len(self.by_addr.get(our_addr, ())) >= self.max_per_addr:
+                return None
+            if len(self.mapping) >= self.max_entries:
+                # least recently seen goes
+                self._drop(next(iter(self.mapping)))
+            entry = Entry(ids, (our_addr, None), self.clock())
+            self.mapping[key] = entry
         else:
+            self._touch(key, entry)
             id1, id2 = ids
+            old = entry.get_addr_of(id1)
+            if old == our_addr:
+                return entry
+            self._unindex(old, key)
             entry.set_addr_of(id1, our_addr)
+        self._index(our_addr, key)
+        self._changed(entry)
 
         return entry
 
+    def touch_entry(self, key: tuple[str, str]) -> None:
+        """Refresh the entry, it's in use even without JOINs"""
+        if (entry := self.mapping.get(key)) is not None:
+            self._touch(key, entry)
+
+    def touch_addr(self, addr: Addr) -> None:
+        """Refresh every entry where the address is registered"""
+        for key in self.by_addr.get(addr, ()):
+            self._touch(key, self.mapping[key])
+
+    def expire(self) -> int:
+        """Drop entries not seen for `ttl`, returns how many"""
+        deadline = self.clock() - self.ttl
+        expired = 0
+        while self.mapping:
+            key, entry = next(iter(self.mapping.items()))
+            if entry.last_seen > deadline:
+                break
+            self._drop(key)
+            expired += 1
+
+        return expired
+
     def find_entry(self, ids: tuple[str, str]) -> Optional[Entry]:
-        for entry in self.mapping:
-            if entry.corresponds(ids):
-                return entry
-        else:
-            return None
+        return self.mapping.get(canonical(ids))
+
+    def entries_of(self, addr: Addr) -> list[Entry]:
+        """Every entry where the address is registered"""
+        return [self.mapping[key] for key in self.by_addr.get(addr, ())]
 
     def remove_from_entry(self, addr: Addr, ids: tuple[str, str]):
-        mark = None
-        for i, entry in enumerate(self.mapping):
-            if entry.corresponds(ids):
-                mark = i
-                break
+        key = canonical(ids)
+        entry = self.mapping.get(key)
+        if entry is None:
+            return
 
-        if mark is not None:
-            our_id, their_id = ids
-            entry = self.mapping[mark]
+        our_id, their_id = ids
+        if entry.get_addr_of(their_id) is None:
+            self._drop(key)
+            logger.debug(f"<> removed entry for {our_id}@{their_id}")
+        else:
+            self._unindex(entry.get_addr_of(our_id), key)
+            entry.set_addr_of(our_id, None)
+            self._changed(entry)
 
-            if entry.get_addr_of(their_id) is None:
-                self.mapping.pop(mark)
-                print(f"<> removed entry for {our_id}@{their_id}")
-            else:
-                entry.set_addr_of(our_id, None)
+    def restore(
+        self, entries: list[tuple[journal.Side, journal.Side]]
+    ) -> None:
+        """Put back entries from `journal.load`, as if they were just seen"""
+        now = self.clock()
+        for a, b in entries[-self.max_entries :]:
+            key = canonical((a[0], b[0]))
+            self.mapping[key] = Entry((a[0], b[0]), (a[1], b[1]), now)
+            self._index(a[1], key)
+            self._index(b[1], key)
+
+    def checkpoint(self) -> None:
+        """Write out the journal, compact it if it grew too much"""
+        if self.journal is None:
+            return
 
+        if self.journal.records > len(self.mapping) + self.COMPACT_SLACK:
+            self.journal.compact(
+                (entry._a, entry._b) for entry in self.mapping.values()
+            )
+        else:
+            self.journal.flush()
 
-def addrs_to_string(addr_a: Addr, addr_b: Addr) -> str:
-    def addr_to_string(addr: Addr) -> str:
-        host, port = addr
-        return ":".join((host, str(port)))
 
-    return ";".join((addr_to_string(addr_a), addr_to_string(addr_b)))
+def addr_to_string(addr: Addr) -> str:
+    host, port = addr
+    return ":".join((host, str(port)))
 
 
-def handle_join(s: socket.socket, mapping: Mapping, our_addr: Addr, msg: str):
-    our_id, their_id = msg.split("@")
-    id_pair = our_id, their_id
+def string_to_addr(addr_string: str) -> Addr:
+    host, port = addr_string.split(":")
+    return host, int(port)
 
-    if mapping.find_entry(id_pair) is None:
-        print(f"<> registered new mapping: {our_id} @ {their_id}")
-        mapping.register(id_pair, our_addr)
-    else:
-        entry = mapping.register(id_pair, our_addr)
 
-        addr_pair = entry.get_full_pair(id_pair)
-        if addr_pair is None:
-            print(f"<> another hit to {our_id} @ {their_id}")
-            print("<> but the mapping is incomplete")
-            return
+# our address, theirs and their id, the id lets clients with many peers
+# on one socket tell replies apart, then the ports they had before, if any
+REPLY = "%s:%d;%s:%d;%s"
 
-        our_addr, their_addr = addr_pair
-        s.sendto(
-            addrs_to_string(our_addr, their_addr).encode("utf-8"), our_addr
-        )
-        s.sendto(
-            addrs_to_string(their_addr, our_addr).encode("utf-8"), their_addr
-        )
-        print(f"<> send their addresses to both: {our_id} @ {their_id}")
 
+def encode_reply(
+    our_addr: Addr,
+    their_addr: Addr,
+    their_id: str,
+    their_ports: tuple[int, ...] = (),
+) -> bytes:
+    reply = REPLY % (*our_addr, *their_addr, their_id)
+    if their_ports:
+        reply += ";" + ",".join(map(str, their_ports))
+    return reply.encode("utf-8")
 
-def handle_exit(mapping: Mapping, our_addr: Addr, msg: str):
-    our_id, their_id = msg.split("@")
-    id_pair = our_id, their_id
 
-    mapping.remove_from_entry(our_addr, id_pair)
+def parse_ids(msg: bytes) -> tuple[str, str]:
+    """Ids of `<id>@<id>`, neither may have @ or ; in it
 
+    The id goes back in replies, where ; separates the fields.
+    """
+    our_id, sep, their_id = msg.decode("utf-8").partition("@")
+    if not sep:
+        raise ValueError(f"no @ in {msg!r}")
+    if "@" in their_id or ";" in our_id or ";" in their_id:
+        raise ValueError(f"@ or ; in the ids of {msg!r}")
+    return our_id, their_id
 
-def main() -> Never:
+
+def handle_join(s: Sender, mapping: Mapping, our_addr: Addr, msg: bytes):
+    id_pair = parse_ids(msg)
+
+    if (entry := mapping.register(id_pair, our_addr)) is None:
+        logger.warning(f"<> {our_addr} has too many mappings, ignored")
+        return
+    if (replies := entry.replies()) is None:
+        # the other one isn't there yet
+        return
+
+    for reply, addr in replies:
+        s.sendto(reply, addr)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"<> send their addresses to both: {id_pair}")
+
+
+def handle_exit(mapping: Mapping, our_addr: Addr, msg: bytes):
+    mapping.remove_from_entry(our_addr, parse_ids(msg))
+
+
+# how often to look for expired entries, at the latest
+EXPIRE_EVERY = 1.0
+
+
+def handle_datagram(
+    s: Sender, mapping: Mapping, our_addr: Addr, payload: bytes
+) -> None:
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"[{our_addr}]: {payload!r}")
+
+    # no decoding until we know what it is
+    cmd, _, msg = payload.partition(b"#")
     try:
-        port = int(sys.argv[1])
-        print(f"<> using port: {port}")
-    except (ValueError, IndexError):
-        port = 11_111
-        print("<err> couldn't get the port")
-        print(f"<> using default port: {port}")
+        if cmd == b"JOIN":
+            handle_join(s, mapping, our_addr, msg)
+        elif cmd == b"EXIT":
+            handle_exit(mapping, our_addr, msg)
+        elif cmd == b"ALIVE":
+            # keeps the NAT binding to us open, and the entries too
+            mapping.touch_addr(our_addr)
+    except ValueError as e:
+        logger.warning(f"<> malformed datagram from {our_addr}: {e}")
+
+
+def pair_key(payload: bytes) -> Optional[bytes]:
+    """Id pair the datagram is about, None if it's not about one"""
+    cmd, _, msg = payload.partition(b"#")
+    if cmd != b"JOIN" and cmd != b"EXIT":
+        return None
+
+    # utf-8 sorts the same way as the strings do
+    our_id, _, their_id = msg.partition(b"@")
+    if our_id > their_id:
+        our_id, their_id = their_id, our_id
+    return b"@".join((our_id, their_id))
+
+
+def open_journal(mapping: Mapping, path: str) -> None:
+    """Restore the mapping from the journal at `path` and keep it there"""
+    start = time.monotonic()
+    entries, size = journal.load(path)
+    mapping.restore(entries)
+    mapping.journal = journal.Journal(path, size)
+    took = (time.monotonic() - start) * 1000
+    logger.info(
+        f"<> restored {len(mapping)} entries from {path} in {took:.0f} ms"
+    )
+
+
+def owner_of(payload: bytes, workers: int) -> Optional[int]:
+    """Worker that keeps the pair, None if everyone should see it"""
+    if (key := pair_key(payload)) is None:
+        return None
+
+    # hash() is salted per process, workers need to agree
+    return zlib.crc32(key) % workers
+
+
+def handle_node(
+    members: cluster.Cluster, mapping: Mapping, node: Addr, payload: bytes
+) -> None:
+    if (data := members.unseal(payload)) is None:
+        # someone else using the node's address
+        logger.warning(f"<> unsigned datagram from node {node}, dropped")
+        return
+
+    cmd, _, msg = data.partition(b"#")
+    members.heard(node)
+    try:
+        if cmd == b"FWD":
+            addr_string, _, forwarded = msg.partition(b"\n")
+            our_addr = string_to_addr(addr_string.decode("utf-8"))
+            # replies go back the way it came
+            members.via[our_addr] = node
+            handle_datagram(members, mapping, our_addr, forwarded)
+        elif cmd == b"RELAY":
+            members.relay(msg)
+        # and NODE is a heartbeat, hearing it is enough
+    except ValueError as e:
+        logger.warning(f"<> malformed datagram from node {node}: {e}")
+
+
+def route(
+    members: cluster.Cluster, mapping: Mapping, our_addr: Addr, payload: bytes
+) -> None:
+    """Handle the client datagram here, or forward it to the owner"""
+    if (key := pair_key(payload)) is None:
+        # entries of the address may be anywhere, everyone should see it
+        members.broadcast(our_addr, payload)
+    elif (owner := members.owner(key)) != members.us:
+        members.forward(owner, our_addr, payload)
+        return
+
+    # the client talks to us directly now
+    members.via.pop(our_addr, None)
+    handle_datagram(members, mapping, our_addr, payload)
+
+
+def serve(
+    server: socket.socket,
+    *,
+    worker: int = 0,
+    inboxes: Optional[list[socket.socket]] = None,
+    outboxes: Optional[list[socket.socket]] = None,
+    node: Optional[Addr] = None,
+    nodes: Optional[list[Addr]] = None,
+    secret: Optional[bytes] = None,
+    journal_path: Optional[str] = None,
+    relay_rate: Optional[float] = None,
+) -> Never:
+    """Receive and handle datagrams forever
+
+    With several workers, each one owns the pairs that hash to it, see
+    `owner_of`. Datagrams for pairs of other workers are forwarded into
+    their inbox (through the other end, in `outboxes`), together with the
+    sender address, and the owner replies from its own socket. All of them
+    are bound to the same port, so clients can't tell.
+
+    With `nodes`, this is the `node` of a cluster of servers on different
+    ports or machines, see `cluster`. They sign what they send each other
+    with `secret`.
+
+    With `journal_path`, the mapping is restored from there and every
+    change is kept there, see `journal`.
+
+    With `relay_rate`, packets of peers are relayed to each other at up
+    to that many bytes per second per pair, see `relay`. They're received
+    into one buffer and sent out of it, the way they came.
+    """
+    inbox = inboxes[worker] if inboxes is not None else None
+    sockets = [server] if inbox is None else [server, inbox]
+
+    clock = CachedClock()
+    mapping = Mapping(clock=clock)
+    if journal_path is not None:
+        open_journal(mapping, journal_path)
+    relay = None
+    if relay_rate is not None:
+        relay = Relay(mapping, rate=relay_rate)
+    # a byte more, to tell what was cut short
+    relay_buf = bytearray(RELAY_DATAGRAM + 1)
+    members = None
+    max_datagram = MAX_DATAGRAM
+    if nodes is not None:
+        assert node is not None and secret is not None
+        members = cluster.Cluster(
+            server, node, nodes, secret=secret, clock=clock
+        )
+        max_datagram = cluster.MAX_DATAGRAM
+    while True:
+        # whatever the last round changed
+        mapping.checkpoint()
+        ok_read, ok_write, errs = select.select(sockets, [], [], EXPIRE_EVERY)
+        clock.tick()
+        if expired := mapping.expire():
+            logger.info(f"<> {expired} entries expired")
+        if relay is not None:
+            relay.expire()
+        if members is not None:
+            members.service(mapping.by_addr)
+        for s in ok_read:
+            if s is inbox:
+                # forwarded by another worker
+                forwarded, _ = s.recvfrom(200)
+                addr_string, _, payload = forwarded.partition(b"\n")
+                our_addr = string_to_addr(addr_string.decode("utf-8"))
+            elif relay is not None:
+                nbytes, our_addr = s.recvfrom_into(relay_buf)
+                view = memoryview(relay_buf)[:nbytes]
+                if wire.is_packet(view):
+                    relay.forward(s, view, our_addr)
+                    continue
+                payload = bytes(view[:max_datagram])
+            else:
+                payload, our_addr = s.recvfrom(max_datagram)
+
+            if members is not None:
+                if members.is_node(our_addr):
+                    handle_node(members, mapping, our_addr, payload)
+                elif len(payload) <= MAX_DATAGRAM:
+                    route(members, mapping, our_addr, payload)
+                continue
+
+            if s is server and outboxes is not None:
+                owner = owner_of(payload, len(outboxes))
+                if owner != worker:
+                    forward = b"%s\n%s" % (
+                        addr_to_string(our_addr).encode("utf-8"),
+                        payload,
+                    )
+                    for i, other in enumerate(outboxes):
+                        if i != worker and owner in (i, None):
+                            other.send(forward)
+                    if owner is not None:
+                        continue
+
+            handle_datagram(server, mapping, our_addr, payload)
+
+
+class ServerProtocol(asyncio.DatagramProtocol):
+    """Same server on the asyncio loop, datagrams come as callbacks"""
+
+    # how often the cached clock is updated
+    CLOCK_TICK = 0.05
+
+    def __init__(
+        self,
+        journal_path: Optional[str] = None,
+        relay_rate: Optional[float] = None,
+    ) -> None:
+        self.clock = CachedClock()
+        self.mapping = Mapping(clock=self.clock)
+        if journal_path is not None:
+            open_journal(self.mapping, journal_path)
+        self.relay = None
+        if relay_rate is not None:
+            self.relay = Relay(self.mapping, rate=relay_rate)
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self.last_expire = self.clock.now
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        # selector transports don't actually subclass DatagramTransport
+        self.transport = transport  # type: ignore[assignment]
+        self.tick()
+
+    def tick(self) -> None:
+        self.clock.tick()
+        if self.clock.now - self.last_expire >= EXPIRE_EVERY:
+            self.last_expire = self.clock.now
+            if expired := self.mapping.expire():
+                logger.info(f"<> {expired} entries expired")
+            if self.relay is not None:
+                self.relay.expire()
+        self.mapping.checkpoint()
+        asyncio.get_running_loop().call_later(self.CLOCK_TICK, self.tick)
+
+    def datagram_received(self, data: bytes, addr: Addr) -> None:
+        assert self.transport is not None
+        if self.relay is not None and wire.is_packet(data):
+            self.relay.forward(self.transport, data, addr)
+            return
+        if len(data) > MAX_DATAGRAM:
+            logger.warning(f"<> {len(data)} bytes from {addr}, too big")
+            return
+        handle_datagram(self.transport, self.mapping, addr, data)
+
+    def error_received(self, exc: Exception) -> None:
+        logger.error(f"<> {exc}")
+
+
+async def serve_async(
+    server: socket.socket,
+    journal_path: Optional[str] = None,
+    relay_rate: Optional[float] = None,
+) -> Never:
+    loop = asyncio.get_running_loop()
+    await loop.create_datagram_endpoint(
+        lambda: ServerProtocol(journal_path, relay_rate), sock=server
+    )
+    await loop.create_future()
+    raise RuntimeError("unreachable")
+
 
+def bind(port: int, *, reuse_port: bool = False) -> socket.socket:
     server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reuse_port:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     server.bind(("0.0.0.0", port))
-    print("<> bound and ready to receive messages")
+    return server
+
+
+def run_worker(
+    port: int,
+    worker: int,
+    inboxes: list[socket.socket],
+    outboxes: list[socket.socket],
+    level: Optional[int],
+    rate: float,
+    journal_path: Optional[str],
+) -> None:
+    # the listener thread didn't survive the fork
+    log.setup(level, rate=rate)
+    server = bind(port, reuse_port=True)
+    logger.info(f"<> worker {worker} bound and ready to receive messages")
+    if journal_path is not None:
+        # workers keep different pairs, each one needs a journal of its own
+        journal_path = f"{journal_path}.{worker}"
+    serve(
+        server,
+        worker=worker,
+        inboxes=inboxes,
+        outboxes=outboxes,
+        journal_path=journal_path,
+    )
 
-    mapping = Mapping()
-    while True:
-        ok_read, ok_write, errs = select.select([server], [], [])
-        if ok_read:
-            s: socket.socket = ok_read[0]
-            msg_bytes, our_addr = s.recvfrom(100)
-            payload = msg_bytes.decode("utf-8")
-
-            time = datetime.now()
-            print(f"<{time}> [{our_addr}]: {payload}")
-
-            cmd, msg = payload.split("#")
-            if cmd == "JOIN":
-                handle_join(s, mapping, our_addr, msg)
-            elif cmd == "EXIT":
-                handle_exit(mapping, our_addr, msg)
+
+def main() -> Never:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("port", type=int, nargs="?", default=11_111)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="processes sharing the port with SO_REUSEPORT",
+    )
+    parser.add_argument(
+        "--asyncio",
+        action="store_true",
+        help="run on the asyncio loop, single process only",
+    )
+    parser.add_argument(
+        "--log-level",
+        choices=log.LEVELS,
+        default="info",
+        help="debug logs every datagram, off turns logging off",
+    )
+    parser.add_argument(
+        "--log-rate", type=float, default=100.0, help="lines per second"
+    )
+    parser.add_argument(
+        "--cluster",
+        type=string_to_addr,
+        nargs="+",
+        metavar="HOST:PORT",
+        help="every node of the cluster, same list on each of them",
+    )
+    parser.add_argument(
+        "--node",
+        type=string_to_addr,
+        metavar="HOST:PORT",
+        help="this node in the --cluster list, 127.0.0.1:<port> by default",
+    )
+    parser.add_argument(
+        "--secret",
+        metavar="PATH",
+        help="file with the secret the --cluster nodes share, same on each",
+    )
+    parser.add_argument(
+        "--journal",
+        metavar="PATH",
+        help="keep the mapping in PATH, so a restart picks it up again",
+    )
+    parser.add_argument(
+        "--relay",
+        type=float,
+        nargs="?",
+        const=RELAY_RATE // 1024,
+        metavar="KB/S",
+        help="relay peers that can't punch through, at most KB/S per pair",
+    )
+    args = parser.parse_args()
+    level = log.LEVELS[args.log_level]
+    log.setup(level, rate=args.log_rate)
+
+    port = args.port
+    logger.info(f"<> using port: {port}")
+
+    relay_rate = None
+    if args.relay is not None:
+        if args.cluster is not None or args.workers > 1:
+            # the entry lives on one node or worker, its peers may not
+            sys.exit("<err> --relay only works with a single server")
+        relay_rate = args.relay * 1024
+
+    if args.cluster is not None:
+        node = args.node or ("127.0.0.1", port)
+        if node not in args.cluster:
+            sys.exit(f"<err> {addr_to_string(node)} isn't in the cluster")
+        if args.workers > 1 or args.asyncio:
+            sys.exit("<err> --cluster runs a single select loop per node")
+        if args.secret is None:
+            sys.exit("<err> --cluster needs --secret, nodes sign their talk")
+        with open(args.secret, "rb") as f:
+            secret = f.read().strip()
+        if not secret:
+            sys.exit(f"<err> {args.secret} is empty")
+
+        server = bind(port)
+        logger.info(f"<> node {addr_to_string(node)} ready")
+        serve(
+            server,
+            node=node,
+            nodes=args.cluster,
+            secret=secret,
+            journal_path=args.journal,
+        )
+
+    if args.workers <= 1:
+        server = bind(port)
+        logger.info("<> bound and ready to receive messages")
+        if args.asyncio:
+            asyncio.run(serve_async(server, args.journal, relay_rate))
+        serve(server, journal_path=args.journal, relay_rate=relay_rate)
+    if args.asyncio:
+        sys.exit("<err> --asyncio doesn't work with --workers")
+
+    if not hasattr(socket, "SO_REUSEPORT"):
+        sys.exit("<err> SO_REUSEPORT isn't supported here, can't use workers")
+
+    # one datagram inbox per worker for what other workers forward,
+    # whatever is sent into the other end of the pair lands there
+    pairs = [
+        socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        for _ in range(args.workers)
+    ]
+    inboxes = [inbox for inbox, _ in pairs]
+    outboxes = [outbox for _, outbox in pairs]
+
+    processes = [
+        multiprocessing.Process(
+            target=run_worker,
+            args=(
+                port,
+                worker,
+                inboxes,
+                outboxes,
+                level,
+                args.log_rate,
+                args.journal,
+            ),
+            daemon=True,
+        )
+        for worker in range(args.workers)
+    ]
+    # exiting normally takes the daemon workers down too, make SIGTERM do so
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    sys.exit(1)
 
 
 if __name__ == "__main__":
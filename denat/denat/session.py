@@ -0,0 +1,947 @@
+from __future__ import annotations
+
+import collections
+import enum
+import heapq
+import logging
+import random
+import time
+from typing import Literal, Optional
+
+from . import wire
+from .congestion import CongestionControl, NewReno
+from .keepalive import Beat, Heartbeat, Lifetime
+from .net import BUFF_LEN, Addr, BufferPool, parse_server_msg
+from .pmtu import MAX_MTU, MtuProber
+from .stats import Stats
+from .t import assert_never_seq
+from .wire import FLAG_MORE, HEADER, Kind, WireError
+
+logger = logging.getLogger(__name__)
+
+BytesLike = bytes | bytearray | memoryview
+
+
+class TickResult(enum.Enum):
+    # handshake
+    GotInitAck = enum.auto()
+    GotInitSyn = enum.auto()
+    # messages
+    GotMsg = enum.auto()
+    GotAck = enum.auto()
+    GotEarly = enum.auto()
+    # path mtu, keep-alive
+    GotProbe = enum.auto()
+    # resumption
+    GotResume = enum.auto()
+    # meta
+    DupOrEarly = enum.auto()
+    Timeout = enum.auto()
+
+
+HandleResult = Literal[
+    TickResult.GotInitSyn,
+    TickResult.GotInitAck,
+    TickResult.GotMsg,
+    TickResult.GotAck,
+    TickResult.GotEarly,
+    TickResult.GotProbe,
+    TickResult.GotResume,
+    TickResult.DupOrEarly,
+]
+
+
+def register(stats: Stats, res: HandleResult) -> None:
+    match res:
+        case (
+            TickResult.GotInitSyn
+            | TickResult.GotInitAck
+            | TickResult.GotProbe
+            | TickResult.GotResume
+        ):
+            stats.meta()
+        case TickResult.GotMsg | TickResult.GotAck | TickResult.GotEarly:
+            stats.got()
+        case TickResult.DupOrEarly:
+            stats.other()
+
+
+class RttEstimator:
+    """Smoothed RTT and retransmission timeout, Jacobson/Karn style
+
+    Follows RFC 6298, but with bounds that make sense for a toy tunnel
+    instead of the internet-wide 1 second minimum.
+    """
+
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+    # roughly how late our timers fire, stops rto hugging srtt on stable
+    # paths when rttvar goes to zero
+    G = 0.01
+
+    def __init__(
+        self,
+        *,
+        initial: float = 0.3,
+        min_rto: float = 0.01,
+        max_rto: float = 5.0,
+    ) -> None:
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+
+        self.srtt: Optional[float] = None
+        self.rttvar = 0.0
+        self.min_rtt = float("inf")
+
+        self.base_rto = initial
+        self.backoff = 0
+
+    @property
+    def rto(self) -> float:
+        return min(self.max_rto, self.base_rto * 2**self.backoff)
+
+    def sample(self, rtt: float) -> None:
+        """Feed an RTT measured on a message that was sent only once"""
+        self.min_rtt = min(self.min_rtt, rtt)
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += self.BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += self.ALPHA * (rtt - self.srtt)
+
+        rto = self.srtt + max(self.G, self.K * self.rttvar)
+        self.base_rto = min(self.max_rto, max(self.min_rto, rto))
+        # fresh sample means the path is alive again
+        self.backoff = 0
+
+    def expired(self) -> None:
+        """Back off exponentially after the timer has fired"""
+        if self.rto < self.max_rto:
+            self.backoff += 1
+
+    def new_path(self) -> None:
+        """Forget the backoff, the timeouts were on the old path"""
+        self.backoff = 0
+
+
+class Session:
+    """Protocol state of one ReUDP tunnel, without any I/O
+
+    Guarantees:
+        - All messages will be delivered.
+        - Message should arrive in order.
+
+    How the protocol works and what the knobs do is in README.md.
+
+    Subclasses bring the I/O: they implement `raw_send`, feed datagrams
+    into `handle_datagram` and call `service_timers` when `next_deadline`
+    comes. Whatever they send should update `last_sent`.
+    """
+
+    DUP_THRESH = 3
+    DIRECT_EVERY = 5.0
+
+    def __init__(
+        self,
+        peer: Addr,
+        remote: Optional[Addr],
+        *,
+        window: int = 32,
+        ack_every: int = 4,
+        congestion: Optional[CongestionControl] = None,
+        mtu: int = BUFF_LEN,
+        max_mtu: int = MAX_MTU,
+        probe: bool = True,
+        max_message: int = 16 * 2**20,
+        reassembly_timeout: float = 30.0,
+        conn: int = 0,
+        keepalive: bool = True,
+        lifetime: Optional[Lifetime] = None,
+        relay_after: Optional[float] = None,
+    ) -> None:
+        # consts
+        self.conn = conn
+        self.init_x = random.randint(0, 100)
+        self.token = random.getrandbits(63)
+        self.window = window
+        self.ack_every = ack_every
+        self.cc = congestion if congestion is not None else NewReno()
+        self.min_mtu = mtu
+        self.max_mtu = max(mtu, max_mtu)
+        self.probe = probe
+        self.max_message = max_message
+        self.reassembly_timeout = reassembly_timeout
+        self.relay_after = relay_after
+        self.set_mtu(mtu)
+
+        # switches
+        self.peer = peer
+        self.remote = remote
+        self.us_ok = False
+        # wire version, agreed on during the handshake
+        self.version: Optional[int] = None
+        # peer's session token, if it has one
+        self.peer_token: Optional[int] = None
+        # going through the server, `direct` is where the peer really is
+        self.relayed = False
+        self.direct: Optional[Addr] = None
+        self.direct_at = 0.0
+        # asked the server for the peer since we lost it, see `handle_remote`
+        self.rejoining = False
+
+        # state
+        self.stats = Stats()
+
+        # everything up to `last_received_id` is delivered, so that's
+        # all we need to remember about it, duplicates are recognized
+        # by the id alone
+        #
+        # bit `k` in `early_mask` means `last_received_id + 1 + k` is
+        # waiting in `early`
+        self.last_received_id = -1
+        # payload and flags
+        self.early: dict[int, tuple[memoryview, int]] = {}
+        self.early_mask = 0
+        self.ack_pending = 0
+        self.read_queue: collections.deque[tuple[memoryview, Addr]] = (
+            collections.deque()
+        )
+        # only receivers that read into buffers of their own fill it, see
+        # `ReUDP` and `Mux`, the rest have nothing to give back
+        #
+        # peer may be probing for bigger datagrams than we send
+        self.pool = BufferPool(0, self.max_mtu)
+        # fragments of the message being assembled, and when the last one
+        # arrived
+        self.partial = bytearray()
+        self.partial_time = 0.0
+        # skip fragments till the end of the message we gave up on
+        self.discarding = False
+
+        # `send_base` is the oldest unacked id, `next_id` is the id
+        # the next message will get
+        self.send_base = 0
+        self.next_id = 0
+        self.in_flight = 0
+        # last id sent before the loss, no more cwnd cuts until it's acked
+        self.recover = -1
+        # msg and flags
+        self.send_queue: collections.deque[tuple[bytes, int]] = (
+            collections.deque()
+        )
+        # only unacked messages: msg, flags, time sent, how many times resent
+        self.sent: dict[int, tuple[bytes, int, float, int]] = {}
+        # (time sent, id) heap for retransmits, ordered by deadline because
+        # rto is the same for everyone
+        #
+        # entries aren't removed on ack or resend, they're skipped when
+        # they no longer match self.sent
+        self.timers: list[tuple[float, int]] = []
+        self.rtt = RttEstimator()
+        self.prober: Optional[MtuProber] = None
+        self.heartbeat: Optional[Heartbeat] = None
+        if keepalive:
+            self.heartbeat = Heartbeat(
+                lifetime if lifetime is not None else Lifetime()
+            )
+        self.last_sent = time.monotonic()
+
+    def raw_send(self, msg: bytes) -> None:
+        raise NotImplementedError
+
+    def send_probe(self, probe: bytes) -> bool:
+        """Send mtu probe, False if it's known to be too big already"""
+        self.raw_send(probe)
+        return True
+
+    def quiet(self) -> bool:
+        """Whether nothing else is about to arrive, so acks shouldn't wait"""
+        return True
+
+    def send_alive(self) -> None:
+        """Let the server know we're still here, if there's one"""
+
+    def binding_lost(self) -> None:
+        """The peer stopped answering heartbeats, ask where it went"""
+
+    def set_mtu(self, mtu: int) -> None:
+        # the biggest payload that fits, even with the full SACK bitmap
+        chunk = mtu - HEADER.size - (self.window + 7) // 8
+        if chunk <= 0:
+            raise ValueError(f"{mtu=} is too small for window={self.window}")
+
+        self.mtu = mtu
+        self.chunk = chunk
+
+    def start_probe(self) -> None:
+        """Start looking for path mtu from scratch"""
+        if not self.probe:
+            return
+        self.set_mtu(self.min_mtu)
+        self.prober = MtuProber(self.min_mtu, self.max_mtu)
+
+    def probe_mtu(self) -> None:
+        """Send the next probe if it's time to"""
+        if self.prober is None:
+            return
+
+        size = self.prober.poll(time.monotonic(), self.rtt.rto)
+        if size is not None:
+            probe = wire.probe(size, self.conn)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"-> probe of {size} bytes")
+            if not self.send_probe(probe):
+                # kernel already knows it won't fit
+                self.prober.too_big(size)
+
+        if self.prober.done:
+            logger.info(f"<> path mtu is {self.prober.low}")
+            self.set_mtu(self.prober.low)
+            self.prober = None
+
+    def punch(self) -> None:
+        """Send the peer a heartbeat now, to open the binding towards it"""
+        self.raw_send(wire.probe(HEADER.size, self.conn))
+
+    def keep_alive(self) -> None:
+        """Send a heartbeat if the tunnel has been quiet for too long"""
+        if self.heartbeat is None or not self.us_ok:
+            # the handshake keeps it busy enough
+            return
+        if self.sent:
+            # and so do resends, which notice when the peer is gone
+            self.heartbeat.cancel()
+            return
+
+        now = time.monotonic()
+        match self.heartbeat.poll(now, self.last_sent, self.rtt.rto):
+            case Beat.Send:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("-> heartbeat")
+                self.punch()
+                self.send_alive()
+            case Beat.Lost:
+                interval = self.heartbeat.lifetime.interval
+                logger.error(
+                    "<> heartbeat wasn't answered, binding must be gone,"
+                    f" next one in {interval:.1f}s"
+                )
+                self.binding_lost()
+            case None:
+                pass
+
+    def send_resume(self) -> None:
+        """Ask the peer to carry on with us from wherever we are now"""
+        if self.version is not None and self.version >= wire.RESUME_VERSION:
+            self.raw_send(wire.resume(self.token, self.conn))
+
+    def resume(self) -> int:
+        """Resend everything in flight right away, the path has changed
+
+        What was lost, was lost to the old path and not to congestion, so
+        neither the timeout nor the window pay for it.
+        """
+        now = time.monotonic()
+        for i, (msg, flags, _, retries) in self.sent.items():
+            self.raw_send(self.packed_msg(i, msg, flags))
+            self.sent[i] = msg, flags, now, retries + 1
+        self.rtt.new_path()
+        if self.sent:
+            self.compact_timers()
+            self.stats.resent(len(self.sent))
+        return len(self.sent)
+
+    def meet(self, token: int) -> None:
+        """Remember the peer's token, start over if it's a new one
+
+        A new token means the peer restarted and remembers nothing, what
+        was in flight either way is lost, and the ids start from 0 again.
+        Messages that were delivered but not read yet stay.
+        """
+        if self.peer_token is not None and token != self.peer_token:
+            logger.warning(
+                f"<> peer restarted, {len(self.sent)} sent and"
+                f" {len(self.early)} received messages in flight are lost"
+            )
+            self.last_received_id = -1
+            for view, _ in self.early.values():
+                self.pool.release(view)
+            self.early.clear()
+            self.early_mask = 0
+            self.ack_pending = 0
+            self.partial = bytearray()
+            self.discarding = False
+
+            self.send_base = 0
+            self.next_id = 0
+            self.in_flight = 0
+            self.recover = -1
+            self.sent.clear()
+            self.timers.clear()
+            self.rtt = RttEstimator()
+            self.start_probe()
+        self.peer_token = token
+
+    def migrate(self, payload: memoryview, addr: Addr) -> bool:
+        """Move the session to `addr` if it's the peer resuming from there"""
+        try:
+            kind, _, conn, _, token, _, _ = wire.decode(payload)
+        except WireError:
+            return False
+        if (
+            kind != Kind.RESUME
+            or conn != self.conn
+            or self.peer_token is None
+            or token != self.peer_token
+        ):
+            return False
+
+        logger.warning(f"<> peer moved from {self.peer} to {addr}")
+        self.peer = addr
+        # it got to us directly, no need for the server anymore
+        self.relayed = False
+        self.direct = None
+        self.raw_send(wire.resume_ack(self.token, self.conn))
+        self.resume()
+        self.start_probe()
+        return True
+
+    def start_relay(self) -> None:
+        """Send everything through the server, the peer can't be reached"""
+        if self.relayed or self.remote is None:
+            return
+        logger.warning(f"<> can't reach {self.peer}, relaying through server")
+        self.relayed = True
+        self.direct = self.peer
+        self.direct_at = time.monotonic() + self.DIRECT_EVERY
+        self.peer = self.remote
+        self.start_probe()
+        if not self.us_ok:
+            self.raw_send(self.syn_msg())
+        self.send_resume()
+        self.resume()
+
+    def stop_relay(self, addr: Addr) -> None:
+        """Go back to sending to the peer directly, at `addr`"""
+        logger.warning(f"<> {addr} is reachable again, stopped relaying")
+        self.relayed = False
+        self.direct = None
+        self.peer = addr
+        self.start_probe()
+        # so that the peer follows, even if nothing is in flight
+        self.send_resume()
+        self.resume()
+
+    def retry_direct(self) -> None:
+        """Knock at where the peer really is, while relayed"""
+        if not self.relayed or self.direct is None:
+            return
+        now = time.monotonic()
+        if now < self.direct_at:
+            return
+        self.direct_at = now + self.DIRECT_EVERY
+
+        relay, self.peer = self.peer, self.direct
+        try:
+            self.punch()
+            self.send_resume()
+        finally:
+            self.peer = relay
+
+    def is_ours(self, payload: memoryview) -> bool:
+        """Whether it's a packet of this session, and not server text"""
+        return wire.is_packet(payload) and wire.conn_of(payload) == self.conn
+
+    def syn_msg(self) -> bytes:
+        return wire.syn(self.init_x, self.conn, self.token)
+
+    def init_ack_msg(self, init_y: int, version: int) -> bytes:
+        return wire.syn_ack(init_y, version, self.conn, self.token)
+
+    def packed_msg(self, i: int, msg: bytes, flags: int = 0) -> bytes:
+        # the ack rides along, so no need for a standalone one
+        cum, sack = self.ack_fields()
+        self.ack_pending = 0
+        return wire.msg(i, cum, sack, msg, flags, self.conn)
+
+    def ack_msg(self, cum: int, sack: int) -> bytes:
+        return wire.ack(cum, sack, self.conn)
+
+    def ack_fields(self) -> tuple[int, int]:
+        """Cumulative ack and SACK bitmap of early messages
+
+        Bit `k` in the bitmap means that message `cum + 1 + k` has arrived.
+        """
+        return self.last_received_id, self.early_mask
+
+    def send_ack(self) -> None:
+        self.raw_send(self.ack_msg(*self.ack_fields()))
+        self.ack_pending = 0
+
+    def flush_ack(self) -> None:
+        """Send delayed ack if enough messages piled up or it's quiet"""
+        if not self.ack_pending:
+            return
+        if self.ack_pending >= self.ack_every or self.quiet():
+            self.send_ack()
+
+    def try_resend_lost(self, *, timeout: Optional[float] = None) -> int:
+        if timeout is None:
+            timeout = self.rtt.rto
+
+        now = time.monotonic()
+        to_resend = []
+        while self.timers and now - self.timers[0][0] >= timeout:
+            time_sent, i = heapq.heappop(self.timers)
+            match self.sent.get(i, None):
+                case None:
+                    # acked already
+                    continue
+                case msg, flags, last_sent, retries:
+                    if last_sent != time_sent:
+                        # resent since then, there's a newer timer
+                        continue
+                    to_resend.append(i)
+                    self.raw_send(self.packed_msg(i, msg, flags))
+                    self.sent[i] = msg, flags, now, retries + 1
+                case rest:
+                    breakpoint()
+                    assert_never_seq(rest)
+
+        for i in to_resend:
+            heapq.heappush(self.timers, (now, i))
+
+        if to_resend:
+            self.rtt.expired()
+            if self.send_base > self.recover:
+                self.cc.on_timeout(self.in_flight)
+                self.recover = self.next_id - 1
+            self.stats.resent(len(to_resend))
+            self.stats.timing(self.rtt)
+
+        return len(to_resend)
+
+    def release_early(self) -> None:
+        """Move consecutive messages from the early buffer to read_queue"""
+        while self.early_mask & 1:
+            msg_id = self.last_received_id + 1
+            msg, flags = self.early.pop(msg_id)
+            self.early_mask >>= 1
+            self.last_received_id = msg_id
+
+            self.reassemble(msg, flags)
+
+    def reassemble(self, msg: memoryview, flags: int) -> None:
+        """Glue the fragment to the message and deliver it once complete"""
+        more = flags & FLAG_MORE
+        if self.discarding:
+            self.pool.release(msg)
+            self.discarding = bool(more)
+            return
+
+        if not more and not self.partial:
+            # whole message in one datagram, the usual case
+            #
+            # should we store addr in read_queue? probably not
+            # but hell, I don't want to think about it right now
+            self.read_queue.append((msg, self.peer))
+            return
+
+        if len(self.partial) + len(msg) > self.max_message:
+            logger.error(f"message is over {self.max_message} bytes, dropped")
+            self.pool.release(msg)
+            self.partial = bytearray()
+            self.discarding = bool(more)
+            return
+
+        self.partial += msg
+        self.partial_time = time.monotonic()
+        self.pool.release(msg)
+        if not more:
+            self.read_queue.append((memoryview(self.partial), self.peer))
+            self.partial = bytearray()
+
+    def expire_partial(self) -> None:
+        """Drop the half-assembled message if the rest isn't coming"""
+        if not self.partial:
+            return
+        if time.monotonic() - self.partial_time < self.reassembly_timeout:
+            return
+
+        logger.error(f"dropped incomplete message of {len(self.partial)} bytes")
+        self.partial = bytearray()
+        self.discarding = True
+
+    def mark_acked(self, i: int) -> Optional[tuple[bytes, int, float, int]]:
+        """Forget the message, returns the entry if it wasn't acked yet"""
+        return self.sent.pop(i, None)
+
+    def handle_ack(self, cum: int, sack: int) -> bool:
+        """Mark everything up to `cum` and everything in `sack` as done
+
+        Returns whether anything new got acked.
+        """
+        if cum >= self.next_id:
+            # acking the message we haven't sent, a stale or spoofed packet
+            # or a peer from before our restart, nothing to go by
+            logger.error(f"ack for {cum}, but we've only sent {self.next_id}")
+            return False
+
+        now = time.monotonic()
+        newly = []
+        for i in range(self.send_base, cum + 1):
+            if (entry := self.mark_acked(i)) is not None:
+                newly.append(entry)
+
+        i = cum + 1
+        while sack:
+            if sack & 1 and (entry := self.mark_acked(i)) is not None:
+                newly.append(entry)
+            sack >>= 1
+            i += 1
+        # the highest id peer has seen, either cumulative or selective
+        highest = i - 1
+
+        if not newly:
+            return False
+
+        self.in_flight -= len(newly)
+        self.cc.on_ack(len(newly), self.in_flight)
+
+        # Karn: resent messages are ambiguous, we can't tell which copy
+        # was acked, so measure only on the ones sent once
+        sent_once = [t for _, _, t, retries in newly if retries == 0]
+        if sent_once:
+            self.rtt.sample(now - max(sent_once))
+        for _, _, sent_time, retries in newly:
+            # the ack came faster than any round trip could, so it must be
+            # for the original and the resend was for nothing
+            if retries and now - sent_time < self.rtt.min_rtt:
+                self.stats.spurious()
+        self.stats.timing(self.rtt)
+
+        self.fast_resend(highest, now)
+        self.slide_window()
+        if len(self.timers) > 2 * self.window:
+            self.compact_timers()
+        return True
+
+    def compact_timers(self) -> None:
+        """Drop stale timers, so the heap stays bounded by the window"""
+        self.timers = [
+            (time_sent, i) for i, (_, _, time_sent, _) in self.sent.items()
+        ]
+        heapq.heapify(self.timers)
+
+    def fast_resend(self, highest: int, now: float) -> int:
+        """Resend holes with at least DUP_THRESH acked messages above them
+
+        `highest` is the highest acked id. A copy is considered lost only if
+        it was sent at least one smoothed RTT ago, so the same hole isn't
+        resent on every ack.
+        """
+        srtt = self.rtt.srtt if self.rtt.srtt is not None else self.rtt.rto
+        resent = 0
+        for i in range(self.send_base, highest - self.DUP_THRESH + 1):
+            if (entry := self.sent.get(i, None)) is None:
+                continue
+            msg, flags, sent_time, retries = entry
+            if now - sent_time < srtt:
+                continue
+            self.raw_send(self.packed_msg(i, msg, flags))
+            self.sent[i] = msg, flags, now, retries + 1
+            heapq.heappush(self.timers, (now, i))
+            resent += 1
+
+        if resent:
+            self.stats.resent(resent)
+            if self.send_base > self.recover:
+                self.cc.on_loss(self.in_flight)
+                self.recover = self.next_id - 1
+
+        return resent
+
+    def slide_window(self) -> None:
+        """Move send_base past acked messages and send what now fits"""
+        while self.send_base < self.next_id and self.send_base not in self.sent:
+            self.send_base += 1
+        self.flush_send_queue()
+
+    def can_send(self) -> bool:
+        return (
+            self.next_id < self.send_base + self.window
+            and self.in_flight < self.cc.cwnd
+        )
+
+    def flush_send_queue(self) -> int:
+        sent = 0
+        while self.send_queue and self.can_send():
+            msg, flags = self.send_queue.popleft()
+            i = self.next_id
+            self.next_id += 1
+            self.in_flight += 1
+
+            now = time.monotonic()
+            self.raw_send(self.packed_msg(i, msg, flags))
+            self.sent[i] = msg, flags, now, 0
+            heapq.heappush(self.timers, (now, i))
+            sent += 1
+
+        return sent
+
+    def handle_remote(self, payload: bytes) -> None:
+        _, peer = parse_server_msg(payload)
+        logger.debug(f"new peer: {peer}")
+        if self.relayed:
+            # keep relaying until it answers from there
+            if peer != self.direct:
+                self.direct = peer
+                self.direct_at = 0.0
+                self.retry_direct()
+            return
+        moved = peer != self.peer
+        if moved:
+            self.start_probe()
+        self.peer = peer
+        if self.us_ok:
+            # the peer is looking for us, our binding may be what's gone
+            self.punch()
+            # whatever is in flight went to the old address, or from our
+            # old binding, but a cluster answers one ask several times
+            if moved or self.rejoining:
+                self.resume()
+        self.rejoining = False
+
+    def handle_peer(self, payload: memoryview) -> HandleResult:
+        try:
+            kind, flags, conn, seq, cum, sack, msg = wire.decode(payload)
+            version = 0
+            if kind == Kind.SYN:
+                version = wire.negotiate(msg)
+            elif kind == Kind.SYN_ACK:
+                version = wire.agreed(msg)
+        except WireError as e:
+            logger.error(f"malformed packet: {e}")
+            return TickResult.DupOrEarly
+        if conn != self.conn:
+            logger.error(f"packet for connection {conn}, we're {self.conn}")
+            return TickResult.DupOrEarly
+
+        match kind:
+            case Kind.SYN_ACK if seq == self.init_x:
+                self.version = version
+                if cum >= 0:
+                    self.meet(cum)
+                if not self.us_ok:
+                    self.start_probe()
+                self.us_ok = True
+
+                return TickResult.GotInitAck
+            case Kind.SYN:
+                if cum >= 0:
+                    self.meet(cum)
+                init_ack = self.init_ack_msg(seq, version)
+                self.raw_send(init_ack)
+
+                return TickResult.GotInitSyn
+            case Kind.MSG:
+                msg_id = seq
+                self.handle_ack(cum, sack)
+
+                expected_id = self.last_received_id + 1
+                if msg_id >= expected_id + self.window:
+                    # no ack for you sommry, you're too early
+                    #
+                    # the sender shouldn't go past the window, but who knows
+                    return TickResult.DupOrEarly
+
+                offset = msg_id - expected_id
+                if offset < 0 or self.early_mask >> offset & 1:
+                    # delivered or waiting in the buffer already, so our ack
+                    # got lost, repeat it right away
+                    self.send_ack()
+                    return TickResult.DupOrEarly
+
+                # oh, you've arrived, we expected you
+                self.early[msg_id] = msg, flags
+                self.early_mask |= 1 << offset
+                if msg_id == expected_id:
+                    self.release_early()
+                    self.ack_pending += 1
+                    return TickResult.GotMsg
+                else:
+                    # wait in the buffer until the gap is filled, but let
+                    # the sender know what's missing as soon as possible
+                    self.send_ack()
+                    return TickResult.GotEarly
+            case Kind.PROBE:
+                self.raw_send(wire.probe_ack(seq, self.conn))
+
+                return TickResult.GotProbe
+            case Kind.PROBE_ACK:
+                if seq == HEADER.size and self.heartbeat is not None:
+                    self.heartbeat.answered()
+                elif self.prober is not None:
+                    # no need to wait for the search to end to use it
+                    self.prober.fits(seq)
+                    self.set_mtu(self.prober.low)
+
+                return TickResult.GotProbe
+            case Kind.RESUME if cum == self.peer_token:
+                # came from the same address, but it doesn't know that
+                self.raw_send(wire.resume_ack(self.token, self.conn))
+                self.resume()
+
+                return TickResult.GotResume
+            case Kind.RESUME_ACK if cum == self.peer_token:
+                self.resume()
+
+                return TickResult.GotResume
+            case Kind.RESUME | Kind.RESUME_ACK:
+                logger.error("<> resume with a wrong token")
+
+                return TickResult.DupOrEarly
+            case Kind.ACK:
+                if self.handle_ack(cum, sack):
+                    return TickResult.GotAck
+                else:
+                    return TickResult.DupOrEarly
+            case _:
+                # e.g. an unknown kind, or a SYN_ACK to someone else's SYN
+                logger.error(f"unexpected packet: {bytes(payload)!r}")
+                return TickResult.DupOrEarly
+
+    def handle_datagram(
+        self, payload: memoryview, addr: Addr
+    ) -> Optional[TickResult]:
+        """Handle whatever came, returns what happened if anything useful
+
+        Payload buffer is released to the pool, unless it's kept.
+        """
+        relayed = addr == self.remote and wire.is_packet(payload)
+        if relayed and not self.relayed and self.is_ours(payload):
+            # the peer couldn't reach us, so it can't be reached either
+            self.start_relay()
+        elif (
+            not relayed
+            and self.relayed
+            and addr == self.direct
+            and self.is_ours(payload)
+        ):
+            self.stop_relay(addr)
+
+        if addr == self.remote and not relayed:
+            self.handle_remote(bytes(payload))
+            self.pool.release(payload)
+            self.stats.remote()
+            return None
+        elif addr == self.peer:
+            ret = self.handle_peer(payload)
+            register(self.stats, ret)
+            self.flush_ack()
+            if ret not in (TickResult.GotMsg, TickResult.GotEarly):
+                # payload isn't stored anywhere, buffer can be reused
+                self.pool.release(payload)
+
+            match ret:
+                case (
+                    TickResult.GotAck
+                    | TickResult.GotMsg
+                    | TickResult.GotEarly
+                ):
+                    return ret
+                case (
+                    TickResult.GotInitSyn
+                    | TickResult.GotInitAck
+                    | TickResult.GotProbe
+                    | TickResult.GotResume
+                    | TickResult.DupOrEarly
+                ):
+                    return None
+                case rest:
+                    assert_never_seq(rest)
+        elif self.migrate(payload, addr):
+            self.pool.release(payload)
+            self.stats.meta()
+            return None
+        else:
+            logger.error(f"unknown {addr}: {bytes(payload)!r}")
+            self.pool.release(payload)
+            self.stats.other()
+            return None
+
+    def service_timers(self) -> int:
+        """Do whatever is due, returns the number of resent messages"""
+        resent = self.try_resend_lost()
+        self.expire_partial()
+        self.probe_mtu()
+        self.keep_alive()
+        self.retry_direct()
+        return resent
+
+    def next_deadline(self) -> Optional[float]:
+        """When `service_timers` should be called next, monotonic time"""
+        deadlines = []
+        if self.timers:
+            deadlines.append(self.timers[0][0] + self.rtt.rto)
+        if self.partial:
+            deadlines.append(self.partial_time + self.reassembly_timeout)
+        if self.prober is not None:
+            deadlines.append(self.prober.sent_at + self.rtt.rto)
+        if self.heartbeat is not None and self.us_ok and not self.sent:
+            deadlines.append(
+                self.heartbeat.deadline(self.last_sent, self.rtt.rto)
+            )
+        if self.relayed:
+            deadlines.append(self.direct_at)
+
+        return min(deadlines, default=None)
+
+    def stalled(self) -> bool:
+        """Whether we're waiting to hear from the peer"""
+        return self.remote is not None and (not self.us_ok or bool(self.sent))
+
+    def get_view(self) -> Optional[tuple[memoryview, Addr]]:
+        """Pop the next message as is, without giving its buffer back"""
+        if self.read_queue:
+            return self.read_queue.popleft()
+        else:
+            return None
+
+    def get(self) -> Optional[tuple[str, Addr]]:
+        if (res := self.get_view()) is not None:
+            view, addr = res
+            msg = str(view, "utf-8")
+            self.pool.release(view)
+            return msg, addr
+        else:
+            return None
+
+    def get_bytes(self) -> Optional[tuple[bytes, Addr]]:
+        if (res := self.get_view()) is not None:
+            view, addr = res
+            msg = bytes(view)
+            self.pool.release(view)
+            return msg, addr
+        else:
+            return None
+
+    def push_bytes(self, msg: BytesLike) -> None:
+        """Queue the message for sending, sending what fits right away"""
+        if len(msg) > self.max_message:
+            raise ValueError(
+                f"message is {len(msg)} bytes, limit is {self.max_message}"
+            )
+
+        # caller may reuse their buffer, so we need our own copy for resends
+        if len(msg) <= self.chunk:
+            self.send_queue.append((bytes(msg), 0))
+        else:
+            view = memoryview(msg)
+            for start in range(0, len(view), self.chunk):
+                end = start + self.chunk
+                flags = FLAG_MORE if end < len(view) else 0
+                self.send_queue.append((bytes(view[start:end]), flags))
+        self.flush_send_queue()
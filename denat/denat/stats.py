@@ -1,5 +1,11 @@
+from __future__ import annotations
+
 import copy
 import time
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    from .session import RttEstimator
 
 
 class Stats:
@@ -10,6 +16,13 @@ class Stats:
         self.remote_counter = 0
         self.meta_counter = 0
         self.other_counter = 0
+        self.resent_counter = 0
+        self.spurious_counter = 0
+
+        # latest timing, in seconds
+        self.srtt: Optional[float] = None
+        self.rttvar = 0.0
+        self.rto = 0.0
 
         # failure counters
         self.err_clock = 0
@@ -52,6 +65,26 @@ class Stats:
     def other(self):
         self.other_counter += 1
 
+    def resent(self, count: int = 1):
+        self.resent_counter += count
+
+    def spurious(self):
+        self.spurious_counter += 1
+
+    def timing(self, rtt: RttEstimator):
+        self.srtt = rtt.srtt
+        self.rttvar = rtt.rttvar
+        self.rto = rtt.rto
+
+    def format_timing(self) -> str:
+        if self.srtt is None:
+            return f"srtt: -, rto: {self.rto * 1000:.1f} ms"
+        return (
+            f"srtt: {self.srtt * 1000:.1f} ms,"
+            f" rttvar: {self.rttvar * 1000:.1f} ms,"
+            f" rto: {self.rto * 1000:.1f} ms"
+        )
+
     def failed_enough(self, err_limit: int) -> bool:
         if self.err_clock >= err_limit:
             self.err_clock = 0
@@ -72,15 +105,18 @@ class Stats:
             got = self.got_counter
             other = self.other_counter
             remote = self.remote_counter
+            resent = self.resent_counter
             ns_passed = time.time_ns() - self.start
         else:
             miss = self.miss_counter - self.last.miss_counter
             got = self.got_counter - self.last.got_counter
             other = self.other_counter - self.last.other_counter
             remote = self.remote_counter - self.last.remote_counter
+            resent = self.resent_counter - self.last.resent_counter
             ns_passed = time.time_ns() - self.last.ns
 
         print(f"miss/got/other/remote: {miss}/{got}/{other}/{remote}")
+        print(f"resent: {resent}, {self.format_timing()}")
         ms_passed = ns_passed / (10**6)
         print(f"time: {ms_passed} milliseconds")
 
@@ -95,5 +131,8 @@ class Stats:
         print(f"remote:\n\t{self.remote_counter}")
         print(f"meta:\n\t{self.meta_counter}")
         print(f"other:\n\t{self.other_counter}")
+        print(f"resent:\n\t{self.resent_counter}")
+        print(f"spurious resent:\n\t{self.spurious_counter}")
+        print(f"timing:\n\t{self.format_timing()}")
         ms_passed = (time.time_ns() - self.start) / (10**6)
         print(f"time:\n\t{ms_passed} miliseconds")
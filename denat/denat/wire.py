@@ -0,0 +1,216 @@
+"""Binary wire format for ReUDP
+
+Every datagram starts with a fixed header:
+
+    kind      u8   packet kind, see `Kind`
+    flags     u8   see FLAG_* below
+    sack_len  u16  length of the SACK bitmap following the header
+    length    u16  length of the payload following the bitmap
+    conn      u32  connection id, tells sessions sharing a socket apart
+    seq       u64  message id for MSG, handshake nonce for SYN/SYN_ACK,
+                   datagram size for PROBE/PROBE_ACK
+    cum       i64  cumulative ack, -1 if nothing arrived yet, session token
+                   of the sender for SYN/SYN_ACK/RESUME/RESUME_ACK
+
+all in network byte order. SACK bitmap is little-endian, bit `k` means
+message `cum + 1 + k` has arrived. Payload is raw bytes.
+
+SYN carries the highest version sender speaks as its payload, SYN_ACK
+carries the version both sides agreed on.
+
+PROBE is padded with zeros up to the size in question, PROBE_ACK echoes
+the size back once it made it through.
+
+RESUME asks the peer to carry on with the session from wherever it came
+from, the token proves it's the same peer, RESUME_ACK says it will.
+
+The server relays packets as they are between peers that can't reach
+each other, see `relay`, they tell them from its replies by `is_packet`.
+
+Version 2 added the connection id, version 1 peers can't parse the header
+anymore, so they aren't supported. Version 3 added RESUME and RESUME_ACK,
+version 2 peers send -1 instead of the token and never get either.
+"""
+
+from __future__ import annotations
+
+import enum
+import struct
+
+VERSION = 3
+MIN_VERSION = 2
+# the first version that knows RESUME
+RESUME_VERSION = 3
+
+HEADER = struct.Struct("!BBHHIQq")
+CONN = struct.Struct("!I")
+# where conn starts in the header
+CONN_OFFSET = 6
+VERSION_BYTE = struct.Struct("!B")
+
+# the message continues in the next MSG
+FLAG_MORE = 0x01
+
+
+class Kind(enum.IntEnum):
+    SYN = 1
+    SYN_ACK = 2
+    MSG = 3
+    ACK = 4
+    PROBE = 5
+    PROBE_ACK = 6
+    RESUME = 7
+    RESUME_ACK = 8
+
+
+_MSG = int(Kind.MSG)
+_ACK = int(Kind.ACK)
+
+
+class WireError(ValueError):
+    """Datagram doesn't look like a ReUDP packet"""
+
+
+Packet = tuple[int, int, int, int, int, int, memoryview]
+
+
+def encode(
+    kind: int,
+    seq: int = 0,
+    cum: int = -1,
+    sack: int = 0,
+    payload: bytes = b"",
+    flags: int = 0,
+    conn: int = 0,
+) -> bytes:
+    if not sack:
+        # the common case, nothing is missing
+        header = HEADER.pack(kind, flags, 0, len(payload), conn, seq, cum)
+        return header + payload
+
+    sack_bytes = sack.to_bytes((sack.bit_length() + 7) // 8, "little")
+    header = HEADER.pack(
+        kind, flags, len(sack_bytes), len(payload), conn, seq, cum
+    )
+    return b"".join((header, sack_bytes, payload))
+
+
+def msg(
+    seq: int,
+    cum: int,
+    sack: int,
+    payload: bytes,
+    flags: int = 0,
+    conn: int = 0,
+) -> bytes:
+    # packing IntEnum is twice as slow as packing int, hence _MSG
+    return encode(_MSG, seq, cum, sack, payload, flags, conn)
+
+
+def ack(cum: int, sack: int, conn: int = 0) -> bytes:
+    return encode(_ACK, 0, cum, sack, conn=conn)
+
+
+def decode(data: bytes | bytearray | memoryview) -> Packet:
+    """Split datagram into (kind, flags, conn, seq, cum, sack, payload)
+
+    Payload is a view into `data`, nothing is copied.
+    """
+    data = memoryview(data)
+    if len(data) < HEADER.size:
+        raise WireError(f"packet is too short: {len(data)} bytes")
+
+    kind, flags, sack_len, length, conn, seq, cum = HEADER.unpack_from(data)
+    sack_end = HEADER.size + sack_len
+    if len(data) != sack_end + length:
+        # most likely the receive buffer was too small
+        raise WireError(f"expected {sack_end + length} bytes, got {len(data)}")
+
+    if sack_len:
+        sack = int.from_bytes(data[HEADER.size : sack_end], "little")
+    else:
+        sack = 0
+    return kind, flags, conn, seq, cum, sack, data[sack_end:]
+
+
+def is_packet(data: bytes | bytearray | memoryview) -> bool:
+    """Whether it's ours and not text, like what the server says
+
+    Kinds are small numbers, text starts with a printable character.
+    """
+    return len(data) >= HEADER.size and data[0] < 0x20
+
+
+def conn_of(data: bytes | bytearray | memoryview) -> int:
+    """Connection id of the datagram, without decoding the rest"""
+    if len(data) < HEADER.size:
+        raise WireError(f"packet is too short: {len(data)} bytes")
+
+    (conn,) = CONN.unpack_from(data, CONN_OFFSET)
+    return conn
+
+
+def syn(nonce: int, conn: int = 0, token: int = -1) -> bytes:
+    return encode(
+        Kind.SYN,
+        nonce,
+        token,
+        payload=VERSION_BYTE.pack(VERSION),
+        conn=conn,
+    )
+
+
+def syn_ack(nonce: int, version: int, conn: int = 0, token: int = -1) -> bytes:
+    return encode(
+        Kind.SYN_ACK,
+        nonce,
+        token,
+        payload=VERSION_BYTE.pack(version),
+        conn=conn,
+    )
+
+
+def version_of(payload: bytes | memoryview) -> int:
+    """Version in the payload of SYN or SYN_ACK"""
+    try:
+        (version,) = VERSION_BYTE.unpack(payload)
+    except struct.error as e:
+        raise WireError(f"bad version payload: {e}") from e
+    return version
+
+
+def negotiate(payload: bytes | memoryview) -> int:
+    """Pick the version to speak given peer's SYN payload"""
+    theirs = version_of(payload)
+    version = min(VERSION, theirs)
+    if version < MIN_VERSION:
+        raise WireError(f"peer speaks wire version {theirs}, too old")
+
+    return version
+
+
+def agreed(payload: bytes | memoryview) -> int:
+    """Version the peer picked, from its SYN_ACK payload"""
+    version = version_of(payload)
+    if not MIN_VERSION <= version <= VERSION:
+        raise WireError(f"peer picked wire version {version}, we can't")
+
+    return version
+
+
+def probe(size: int, conn: int = 0) -> bytes:
+    return encode(
+        Kind.PROBE, size, payload=bytes(size - HEADER.size), conn=conn
+    )
+
+
+def probe_ack(size: int, conn: int = 0) -> bytes:
+    return encode(Kind.PROBE_ACK, size, conn=conn)
+
+
+def resume(token: int, conn: int = 0) -> bytes:
+    return encode(Kind.RESUME, 0, token, conn=conn)
+
+
+def resume_ack(token: int, conn: int = 0) -> bytes:
+    return encode(Kind.RESUME_ACK, 0, token, conn=conn)